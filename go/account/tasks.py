@@ -3,6 +3,7 @@ from celery.task import task
 from django.contrib.auth.models import User
 
 from go.account.utils import send_user_account_summary
+from go.base.utils import vumi_api_for_user
 
 
 @task(ignore_result=True)
@@ -24,7 +25,7 @@ def update_account_details(user_id, first_name=None, last_name=None,
     account.msisdn = unicode(msisdn)
     account.confirm_start_conversation = confirm_start_conversation
     account.email_summary = email_summary
-    account.save()
+    vumi_api_for_user(user).save_account(account)
 
 
 @task(ignore_result=True)
@@ -230,7 +230,7 @@ class GoApiServer(JSONRPC, GoApiSubHandler):
 
         def save_routing_table(user_account, routing_table):
             user_account.routing_table = routing_table
-            return user_account.save()
+            return user_api.save_routing_table(user_account)
 
         def swallow_result(result):
             return None
@@ -1,8 +1,10 @@
 from datetime import date
 from StringIO import StringIO
+from urlparse import urlparse
 from zipfile import ZipFile
 
 from django.core import mail
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
 from django.utils.unittest import skip
 
@@ -231,6 +233,52 @@ class BulkMessageTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(12, len(content.split('\n')))
         self.assertEqual(mime_type, 'application/zip')
 
+    def test_export_messages_too_large_to_attach(self):
+        self.patch_settings(EXPORT_ATTACHMENT_MAX_SIZE=0)
+        self.setup_conversation(started=True)
+        self.add_messages_to_conv(
+            5, start_date=date(2012, 1, 1), time_multiplier=12, reply=True)
+        self.client.post(self.get_view_url('message_list'), {
+            '_export_conversation_messages': True,
+        })
+        [email] = mail.outbox
+        self.assertEqual(email.attachments, [])
+        [token_url] = [line for line in email.body.splitlines()
+                       if line.startswith('http://')]
+
+        response = self.client.get(urlparse(token_url).path, follow=True)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        zipfile = ZipFile(StringIO(response.content), 'r')
+        content = zipfile.open('messages-export.csv', 'r').read()
+        self.assertEqual(12, len(content.split('\n')))
+
+        [export_dir] = default_storage.listdir('exports')[0]
+        default_storage.delete(
+            'exports/%s/messages-export.zip' % (export_dir,))
+
+    @patch('go.conversation.tasks.MESSAGE_EXPORT_PAGE_SIZE', 3)
+    def test_export_messages_sorted(self):
+        self.setup_conversation(started=True)
+        self.add_messages_to_conv(
+            5, start_date=date(2012, 1, 1), time_multiplier=12, reply=True)
+        self.client.post(self.get_view_url('message_list'), {
+            '_export_conversation_messages': True,
+        })
+        [email] = mail.outbox
+        [(file_name, zipcontent, mime_type)] = email.attachments
+        zipfile = ZipFile(StringIO(zipcontent), 'r')
+        content = zipfile.open('messages-export.csv', 'r').read()
+        [header] = content.split('\r\n')[:1]
+        rows = [row.split(',') for row in content.split('\r\n')[1:-1]]
+        self.assertTrue(header.startswith('from_addr,to_addr,'))
+        # Each end user's messages are grouped together. The replies have
+        # the same timestamps as the inbound messages and sent messages are
+        # listed first.
+        self.assertEqual([row[:2] for row in rows], sum([[
+            ['9292', 'from-%s' % (i,)],
+            ['from-%s' % (i,), '9292'],
+        ] for i in range(5)], []))
+
     def test_action_bulk_send_view(self):
         self.setup_conversation(started=True, with_group=True,
                                 with_channel=True)
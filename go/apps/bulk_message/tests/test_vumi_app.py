@@ -109,6 +109,10 @@ class TestBulkMessageApplication(AppWorkerTestCase):
         # We should have two in flight
         self.assertEqual(
             (yield self.app.window_manager.count_in_flight(window_id)), 2)
+        self.assertEqual(
+            (yield self.app.get_window_for_event(self.mkmsg_ack(
+                user_message_id=msg1['message_id'])))[0],
+            window_id)
 
         # Create an ack and a nack for the messages
         ack = self.mkmsg_ack(user_message_id=msg1['message_id'],
@@ -123,6 +127,104 @@ class TestBulkMessageApplication(AppWorkerTestCase):
         # We should have zero in flight
         self.assertEqual(
             (yield self.app.window_manager.count_in_flight(window_id)), 0)
+        self.assertEqual(
+            (yield self.app.event_index_redis.get(msg1['message_id'])), None)
+
+    @inlineCallbacks
+    def test_consume_unmatched_event(self):
+        ack = self.mkmsg_ack(user_message_id='unknown',
+            sent_message_id='unknown')
+        with LogCatcher() as logger:
+            yield self.app.handle_event(ack)
+            [err] = logger.errors
+        self.assertTrue('Unable to find message' in err['message'][0])
+        self.assertEqual(self.poll_metrics(), {
+            'bulk_message_application.events.unmatched': [1],
+        })
+
+    def mk_bulk_send_command(self, conversation, batch_id, dedupe=False):
+        return dict(
+            user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key,
+            batch_id=batch_id,
+            dedupe=dedupe,
+            content="hello world",
+            delivery_class="sms",
+            msg_options={},
+        )
+
+    @inlineCallbacks
+    def test_bulk_send_dedupe(self):
+        conversation = yield self.setup_conversation(
+            contact_count=3, from_addr=u'+27831234567')
+        yield self.start_conversation(conversation)
+        batch_id = yield conversation.get_latest_batch_key()
+        yield self.dispatch_command("bulk_send", **self.mk_bulk_send_command(
+            conversation, batch_id, dedupe=True))
+        yield self._amqp.kick_delivery()
+        self.clock.advance(self.app.monitor_interval + 1)
+
+        [msg] = yield self.get_dispatched_messages()
+        self.assertEqual(msg['to_addr'], u'+27831234567')
+
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+        self.assertEqual(
+            (yield self.app.bulk_send_redis.smembers('in_progress')), set())
+        self.assertEqual((yield self.app.bulk_send_redis.smembers(
+            self.app.bulk_send_key(window_id, 'addresses'))), set())
+
+    @inlineCallbacks
+    def test_resume_bulk_send(self):
+        conversation = yield self.setup_conversation()
+        yield self.start_conversation(conversation)
+        batch_id = yield conversation.get_latest_batch_key()
+        [contact1, contact2] = yield self.get_opted_in_contacts(conversation)
+
+        # Simulate a send that was interrupted after the first contact was
+        # added to the window.
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+        yield self.app.start_bulk_send(
+            window_id, self.mk_bulk_send_command(conversation, batch_id))
+        yield self.app.bulk_send_redis.sadd(
+            self.app.bulk_send_key(window_id, 'queued'), contact1.key)
+
+        yield self.app.resume_bulk_sends()
+        self.clock.advance(self.app.monitor_interval + 1)
+
+        [msg] = yield self.get_dispatched_messages()
+        self.assertEqual(msg['to_addr'], contact2.msisdn)
+        self.assertEqual(
+            (yield self.app.bulk_send_redis.smembers('in_progress')), set())
+
+    @inlineCallbacks
+    def test_resume_bulk_send_claimed_by_other_worker(self):
+        conversation = yield self.setup_conversation()
+        yield self.start_conversation(conversation)
+        batch_id = yield conversation.get_latest_batch_key()
+
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+        yield self.app.start_bulk_send(
+            window_id, self.mk_bulk_send_command(conversation, batch_id))
+        yield self.app.bulk_send_redis.setex(
+            self.app.bulk_send_key(window_id, 'owner'),
+            self.app.bulk_send_lease_ttl, 'other-worker')
+
+        yield self.app.resume_bulk_sends()
+        self.clock.advance(self.app.monitor_interval + 1)
+
+        self.assertEqual((yield self.get_dispatched_messages()), [])
+        self.assertEqual(
+            (yield self.app.bulk_send_redis.smembers('in_progress')),
+            set([window_id]))
+
+    @inlineCallbacks
+    def test_claim_bulk_send(self):
+        self.assertTrue((yield self.app.claim_bulk_send('window')))
+        self.assertTrue((yield self.app.claim_bulk_send('window')))
+        self.app.worker_id = 'other-worker'
+        self.assertFalse((yield self.app.claim_bulk_send('window')))
+        yield self.app.finish_bulk_send('window')
+        self.assertTrue((yield self.app.claim_bulk_send('window')))
 
     @inlineCallbacks
     def test_send_message_command(self):
@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 
 """Vumi application worker for the vumitools API."""
-from twisted.internet.defer import inlineCallbacks
+import json
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import LoopingCall
 
 from vumi.components.window_manager import WindowManager
+from vumi.blinkenlights.metrics import SUM
 from vumi import log
 
 from go.vumitools.app_worker import GoApplicationWorker
@@ -19,6 +25,10 @@ class BulkMessageApplication(GoApplicationWorker):
     max_ack_wait = 100
     monitor_interval = 20
     monitor_window_cleanup = True
+    event_index_ttl = 60 * 60 * 24 * 2
+    bulk_send_lease_ttl = 60
+
+    clock = reactor
 
     @inlineCallbacks
     def setup_application(self):
@@ -32,9 +42,24 @@ class BulkMessageApplication(GoApplicationWorker):
             interval=self.monitor_interval,
             cleanup=self.monitor_window_cleanup,
             cleanup_callback=self.on_window_cleanup)
+        self.bulk_send_redis = self.redis.sub_manager('%s:bulk_send' % (
+            self.worker_name,))
+        self.event_index_redis = self.redis.sub_manager('%s:event_index' % (
+            self.worker_name,))
+        self.worker_id = uuid4().hex
+        self.active_bulk_sends = set()
+        # Bulk sends left unfinished by a worker that has gone away are
+        # resumed once their lease expires, so we look for them regularly
+        # rather than only when we start.
+        self.resume_task = LoopingCall(self._resume_bulk_sends)
+        self.resume_task.clock = self.clock
+        self.resume_done = self.resume_task.start(self.bulk_send_lease_ttl)
 
     @inlineCallbacks
     def teardown_application(self):
+        if self.resume_task.running:
+            self.resume_task.stop()
+        yield self.resume_done
         yield super(BulkMessageApplication, self).teardown_application()
         self.window_manager.stop()
 
@@ -48,6 +73,9 @@ class BulkMessageApplication(GoApplicationWorker):
             to_addr, content, endpoint='default', **msg_options)
         yield self.window_manager.set_external_id(window_id, flight_key,
             msg['message_id'])
+        yield self.event_index_redis.setex(
+            msg['message_id'], self.event_index_ttl,
+            json.dumps([window_id, flight_key]))
 
     def on_window_cleanup(self, window_id):
         log.info('Finished window %s, removing.' % (window_id,))
@@ -59,13 +87,119 @@ class BulkMessageApplication(GoApplicationWorker):
     def send_message_via_window(self, conv, window_id, batch_id, to_addr,
                                 msg_options, content):
         yield self.window_manager.create_window(window_id, strict=False)
-        yield self.window_manager.add(window_id, {
+        yield self.add_to_window(
+            window_id, batch_id, to_addr, msg_options, content)
+
+    def add_to_window(self, window_id, batch_id, to_addr, msg_options,
+                      content):
+        return self.window_manager.add(window_id, {
             'batch_id': batch_id,
             'to_addr': to_addr,
             'content': content,
             'msg_options': msg_options,
             })
 
+    def bulk_send_key(self, window_id, *parts):
+        return ':'.join([window_id] + list(parts))
+
+    def start_bulk_send(self, window_id, command_kwargs):
+        """Record a bulk send so that it can be resumed if this worker
+        is restarted before all contacts have been added to the window.
+        """
+        d = self.bulk_send_redis.set(
+            self.bulk_send_key(window_id, 'command'),
+            json.dumps(command_kwargs))
+        d.addCallback(lambda _: self.bulk_send_redis.sadd(
+            'in_progress', window_id))
+        return d
+
+    @inlineCallbacks
+    def claim_bulk_send(self, window_id):
+        """Claim (or renew our claim on) a bulk send, returning ``False``
+        if another worker is already processing it.
+
+        Claims are leases that expire after `bulk_send_lease_ttl` seconds
+        unless they are renewed, so a send whose worker has gone away can
+        be resumed by another one.
+        """
+        owner_key = self.bulk_send_key(window_id, 'owner')
+        claimed = yield self.bulk_send_redis.setnx(owner_key, self.worker_id)
+        if not claimed:
+            owner = yield self.bulk_send_redis.get(owner_key)
+            if owner != self.worker_id:
+                ttl = yield self.bulk_send_redis.ttl(owner_key)
+                if ttl is None or ttl < 0:
+                    # The owner went away before giving its claim a TTL.
+                    yield self.bulk_send_redis.expire(
+                        owner_key, self.bulk_send_lease_ttl)
+                returnValue(False)
+        yield self.bulk_send_redis.expire(owner_key, self.bulk_send_lease_ttl)
+        returnValue(True)
+
+    @inlineCallbacks
+    def finish_bulk_send(self, window_id):
+        yield self.bulk_send_redis.srem('in_progress', window_id)
+        yield self.bulk_send_redis.delete(
+            self.bulk_send_key(window_id, 'command'))
+        yield self.bulk_send_redis.delete(
+            self.bulk_send_key(window_id, 'queued'))
+        yield self.bulk_send_redis.delete(
+            self.bulk_send_key(window_id, 'addresses'))
+        yield self.bulk_send_redis.delete(
+            self.bulk_send_key(window_id, 'owner'))
+
+    def _resume_bulk_sends(self):
+        d = self.resume_bulk_sends()
+        d.addErrback(lambda f: log.err(f, "Error resuming bulk sends."))
+        return d
+
+    @inlineCallbacks
+    def resume_bulk_sends(self):
+        """Resume unfinished bulk sends that no other worker has claimed.
+        """
+        window_ids = yield self.bulk_send_redis.smembers('in_progress')
+        for window_id in window_ids:
+            if window_id in self.active_bulk_sends:
+                continue
+            command_json = yield self.bulk_send_redis.get(
+                self.bulk_send_key(window_id, 'command'))
+            if command_json is None:
+                yield self.bulk_send_redis.srem('in_progress', window_id)
+                continue
+            claimed = yield self.claim_bulk_send(window_id)
+            if not claimed:
+                continue
+            log.info('Resuming bulk send for window %s.' % (window_id,))
+            # JSON object keys are unicode, which Python 2.6 doesn't accept
+            # as keyword argument names.
+            command_kwargs = dict(
+                (str(k), v) for k, v in json.loads(command_json).iteritems())
+            yield self.process_command_bulk_send(**command_kwargs)
+
+    @inlineCallbacks
+    def queue_contact(self, window_id, batch_id, contact, delivery_class,
+                      dedupe, msg_options, content):
+        """Add a message for `contact` to the window unless it has already
+        been added during this bulk send.
+
+        The Redis sets used here are shared by all workers, so a send that
+        is resumed never adds a contact (or, when deduping, an address)
+        twice.
+        """
+        is_new = yield self.bulk_send_redis.sadd(
+            self.bulk_send_key(window_id, 'queued'), contact.key)
+        if not is_new:
+            returnValue(False)
+        to_addr = contact.addr_for(delivery_class)
+        if dedupe:
+            is_new = yield self.bulk_send_redis.sadd(
+                self.bulk_send_key(window_id, 'addresses'), to_addr)
+            if not is_new:
+                returnValue(False)
+        yield self.add_to_window(
+            window_id, batch_id, to_addr, msg_options, content)
+        returnValue(True)
+
     @inlineCallbacks
     def process_command_bulk_send(self, user_account_key, conversation_key,
                                   batch_id, msg_options, content, dedupe,
@@ -77,19 +211,48 @@ class BulkMessageApplication(GoApplicationWorker):
                 conversation_key, user_account_key))
             return
 
-        to_addresses = []
-        for contacts_batch in (
-                yield conv.get_opted_in_contact_bunches(delivery_class)):
-            for contact in (yield contacts_batch):
-                to_addresses.append(contact.addr_for(delivery_class))
-        if dedupe:
-            to_addresses = set(to_addresses)
-
-        self.add_conv_to_msg_options(conv, msg_options)
         window_id = self.get_window_id(conversation_key, batch_id)
-        for to_addr in to_addresses:
-            yield self.send_message_via_window(
-                conv, window_id, batch_id, to_addr, msg_options, content)
+        if window_id in self.active_bulk_sends:
+            log.warning("Bulk send for window %s already in progress." % (
+                window_id,))
+            return
+        claimed = yield self.claim_bulk_send(window_id)
+        if not claimed:
+            log.warning("Bulk send for window %s claimed by another worker."
+                        % (window_id,))
+            return
+
+        self.active_bulk_sends.add(window_id)
+        try:
+            yield self.start_bulk_send(window_id, dict(
+                extra_params, user_account_key=user_account_key,
+                conversation_key=conversation_key, batch_id=batch_id,
+                msg_options=msg_options, content=content, dedupe=dedupe,
+                delivery_class=delivery_class))
+
+            self.add_conv_to_msg_options(conv, msg_options)
+            yield self.window_manager.create_window(window_id, strict=False)
+
+            # Each bunch of contacts is added to the window concurrently so
+            # that the Redis commands are pipelined on our connection, but
+            # we only hold one bunch in memory at a time.
+            for contacts_batch in (
+                    yield conv.get_opted_in_contact_bunches(delivery_class)):
+                contacts = yield contacts_batch
+                yield gatherResults([
+                    self.queue_contact(window_id, batch_id, contact,
+                                       delivery_class, dedupe, msg_options,
+                                       content)
+                    for contact in contacts])
+                claimed = yield self.claim_bulk_send(window_id)
+                if not claimed:
+                    log.warning("Lost claim on bulk send for window %s."
+                                % (window_id,))
+                    return
+
+            yield self.finish_bulk_send(window_id)
+        finally:
+            self.active_bulk_sends.discard(window_id)
 
     def consume_ack(self, event):
         return self.handle_event(event)
@@ -98,22 +261,48 @@ class BulkMessageApplication(GoApplicationWorker):
         return self.handle_event(event)
 
     @inlineCallbacks
-    def handle_event(self, event):
+    def get_window_for_event(self, event):
+        """Return the `(window_id, flight_key)` for the message this event
+        refers to, or `(None, None)` if it can't be found.
+
+        Messages sent from a window are indexed in Redis so that this is
+        usually a single lookup. Messages sent before the index existed
+        fall back to loading the message and its conversation.
+        """
+        message_id = event.get('user_message_id')
+        index_value = yield self.event_index_redis.get(message_id)
+        if index_value is not None:
+            window_id, flight_key = json.loads(index_value)
+            returnValue((window_id, flight_key))
+
         message = yield self.find_message_for_event(event)
         if message is None:
             log.error('Unable to find message for %s, user_message_id: %s' % (
-                event['event_type'], event.get('user_message_id')))
-            return
+                event['event_type'], message_id))
+            returnValue((None, None))
 
         msg_mdh = self.get_metadata_helper(message)
         conv = yield msg_mdh.get_conversation()
         # XXX: This is a really horrible idea.
         batch_key = yield conv.get_latest_batch_key()
-        if conv and batch_key:
-            window_id = self.get_window_id(conv.key, batch_key)
-            flight_key = yield self.window_manager.get_internal_id(window_id,
-                                message['message_id'])
-            yield self.window_manager.remove_key(window_id, flight_key)
+        if not (conv and batch_key):
+            returnValue((None, None))
+        window_id = self.get_window_id(conv.key, batch_key)
+        flight_key = yield self.window_manager.get_internal_id(window_id,
+                            message['message_id'])
+        returnValue((window_id, flight_key))
+
+    @inlineCallbacks
+    def handle_event(self, event):
+        window_id, flight_key = yield self.get_window_for_event(event)
+        if flight_key is None:
+            self.publish_metric('%s.events.unmatched' % (self.worker_name,),
+                                1, SUM)
+            return
+
+        yield self.window_manager.remove_key(window_id, flight_key)
+        yield self.event_index_redis.delete(event['user_message_id'])
+        self.publish_metric('%s.events.matched' % (self.worker_name,), 1, SUM)
 
     @inlineCallbacks
     def collect_metrics(self, user_api, conversation_key):
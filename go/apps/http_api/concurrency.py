@@ -0,0 +1,155 @@
+# -*- test-case-name: go.apps.http_api.tests.test_concurrency -*-
+
+"""Limits on the number of concurrent HTTP API requests per account."""
+
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+
+class ConcurrencyLimiter(object):
+    """
+    Counts the requests in progress for each key (e.g. an account) across
+    all the workers sharing a Redis server.
+
+    Acquiring a slot increments the shared count and checks it in a single
+    round trip, so concurrent requests can never take us over the limit.
+    Each worker also records the slots it holds under its own id. A worker
+    keeps a lease on its id alive while it is running, and the slots held by
+    a worker whose lease expires (because it crashed, for example) are
+    released by the next worker that notices. If the worker was only slow
+    rather than dead, its later releases of those slots are ignored.
+
+    :param redis:
+        Redis manager to keep the counts in.
+    :param int lease_ttl:
+        Number of seconds a worker's lease lasts for.
+    :param int heartbeat_interval:
+        Number of seconds between renewals of our lease (and checks for
+        expired leases).
+    """
+
+    LEASE_TTL = 60
+    HEARTBEAT_INTERVAL = 10
+    WORKERS_KEY = 'workers'
+
+    clock = reactor
+
+    def __init__(self, redis, lease_ttl=None, heartbeat_interval=None):
+        self.redis = redis
+        self.lease_ttl = lease_ttl or self.LEASE_TTL
+        self.heartbeat_interval = heartbeat_interval or min(
+            self.HEARTBEAT_INTERVAL, self.lease_ttl / 3.0)
+        self.worker_id = uuid4().hex
+        self.running = False
+        self._heartbeat_loop = None
+
+    def count_key(self, key):
+        return ':'.join(['count', key])
+
+    def lease_key(self, worker_id):
+        return ':'.join(['lease', worker_id])
+
+    def held_key(self, worker_id):
+        return ':'.join(['held', worker_id])
+
+    @inlineCallbacks
+    def start(self):
+        yield self.heartbeat()
+        self.running = True
+        self._heartbeat_loop = LoopingCall(self.heartbeat)
+        self._heartbeat_loop.clock = self.clock
+        d = self._heartbeat_loop.start(self.heartbeat_interval, now=False)
+        d.addErrback(
+            lambda f: log.err(f, "Error renewing concurrency lease."))
+
+    @inlineCallbacks
+    def stop(self):
+        self.running = False
+        if self._heartbeat_loop is not None and self._heartbeat_loop.running:
+            self._heartbeat_loop.stop()
+        # Release everything we hold now rather than when our lease expires.
+        # Requests that finish after this don't release their slots again.
+        yield self.reclaim(self.worker_id)
+        yield self.redis.delete(self.lease_key(self.worker_id))
+
+    @inlineCallbacks
+    def heartbeat(self):
+        """
+        Renew our lease and release the slots held by any workers whose
+        leases have expired.
+        """
+        yield gatherResults([
+            self.redis.setex(
+                self.lease_key(self.worker_id), self.lease_ttl, '1'),
+            self.redis.sadd(self.WORKERS_KEY, self.worker_id),
+        ])
+        worker_ids = yield self.redis.smembers(self.WORKERS_KEY)
+        for worker_id in list(worker_ids):
+            if worker_id == self.worker_id:
+                continue
+            if not (yield self.redis.exists(self.lease_key(worker_id))):
+                log.info('Releasing HTTP API requests held by expired'
+                         ' worker %s.' % (worker_id,))
+                yield self.reclaim(worker_id)
+
+    @inlineCallbacks
+    def reclaim(self, worker_id):
+        """
+        Release all the slots held by `worker_id`.
+        """
+        removed = yield self.redis.srem(self.WORKERS_KEY, worker_id)
+        if not removed:
+            # Someone else got here first.
+            return
+        held_key = self.held_key(worker_id)
+        held = yield self.redis.hgetall(held_key)
+        yield gatherResults([
+            self.redis.decr(self.count_key(key), int(count))
+            for key, count in held.iteritems() if int(count) > 0])
+        yield self.redis.delete(held_key)
+
+    @inlineCallbacks
+    def acquire(self, key, limit):
+        """
+        Take a slot for `key` if fewer than `limit` are in use, returning
+        ``True`` if we got one. A negative limit disables the limit.
+
+        Slots that are acquired must be released with :meth:`release`.
+        """
+        count, _ = yield gatherResults([
+            self.redis.incr(self.count_key(key)),
+            self.redis.hincrby(self.held_key(self.worker_id), key, 1),
+        ])
+        if limit >= 0 and count > limit:
+            yield self._release(key)
+            returnValue(False)
+        returnValue(True)
+
+    def release(self, key):
+        if not self.running:
+            # Our slots have already been released by :meth:`stop`.
+            return
+        return self._release(key)
+
+    @inlineCallbacks
+    def _release(self, key):
+        held_key = self.held_key(self.worker_id)
+        held = yield self.redis.hincrby(held_key, key, -1)
+        if held < 0:
+            # Our lease expired while we were still running and our slots
+            # have been reclaimed by another worker, so this one has already
+            # been released.
+            yield self.redis.hincrby(held_key, key, 1)
+            return
+        yield self.redis.decr(self.count_key(key))
+
+    @inlineCallbacks
+    def get_count(self, key):
+        count = yield self.redis.get(self.count_key(key))
+        returnValue(int(count or 0))
@@ -0,0 +1,284 @@
+# -*- test-case-name: go.apps.http_api.tests.test_push -*-
+
+"""Delivery of messages and events to conversations' push URLs."""
+
+import re
+import json
+import time
+from uuid import uuid4
+from functools import partial
+from urlparse import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore, DeferredList, inlineCallbacks, returnValue,
+    maybeDeferred, succeed)
+from twisted.internet.task import LoopingCall
+from twisted.web.client import Agent, HTTPConnectionPool
+
+from vumi.utils import http_request_full
+from vumi.blinkenlights.metrics import SUM, AVG
+from vumi import log
+
+
+def push_url_metric_name(url):
+    """
+    Return a name for the push URL that is safe to use as part of a metric
+    name.
+    """
+    parsed = urlparse(url)
+    name = re.sub(r'[^a-zA-Z0-9]+', '_', parsed.netloc + parsed.path)
+    return name.strip('_')
+
+
+class PushBatch(object):
+    """
+    Messages waiting to be pushed to a URL in a single request.
+    """
+
+    def __init__(self, conversation_key, url, batch_size):
+        self.conversation_key = conversation_key
+        self.url = url
+        self.batch_size = batch_size
+        self.messages = []
+        self.delayed_call = None
+
+    def is_full(self):
+        return len(self.messages) >= self.batch_size
+
+    def get_body(self):
+        if self.batch_size == 1:
+            [message] = self.messages
+            return message.to_json()
+        return u'[%s]' % (
+            u', '.join(msg.to_json() for msg in self.messages),)
+
+
+class PushDeliveryManager(object):
+    """
+    Pushes messages to HTTP URLs.
+
+    Requests are made over persistent connections which are pooled per
+    target host. At most `max_in_flight` requests are made for each
+    conversation at a time and :meth:`push` only waits until there is room
+    for the message, not for the response.
+
+    Messages may be batched, in which case up to `batch_size` messages for
+    the same URL are posted together as a JSON list. A batch that isn't full
+    is sent after `batch_wait` seconds.
+
+    Requests that fail with a connection error or a server error are
+    retried with exponential backoff, up to `max_retries` times. Retries are
+    stored in Redis, so they survive restarts and are shared by all workers
+    using the same Redis.
+
+    :param redis:
+        Redis manager the retry queue is stored in.
+    :param metric_callback:
+        Optional callable called with a metric name, value and aggregator
+        for the latency, failures and dropped messages for each push URL.
+    """
+
+    MAX_IN_FLIGHT = 10
+    MAX_PERSISTENT_PER_HOST = 10
+    BATCH_WAIT = 0.1
+    TIMEOUT = 30
+    MAX_RETRIES = 5
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 300
+    RETRY_INTERVAL = 1
+    RETRY_CHUNK_SIZE = 100
+    RETRY_KEY = 'retries'
+
+    clock = reactor
+
+    def __init__(self, redis, max_in_flight=None, max_persistent_per_host=None,
+                 batch_wait=None, timeout=None, max_retries=None,
+                 retry_delay=None, max_retry_delay=None, retry_interval=None,
+                 metric_callback=None):
+        self.redis = redis
+        self.max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        self.batch_wait = (
+            self.BATCH_WAIT if batch_wait is None else batch_wait)
+        self.timeout = timeout or self.TIMEOUT
+        self.max_retries = (
+            self.MAX_RETRIES if max_retries is None else max_retries)
+        self.retry_delay = (
+            self.RETRY_DELAY if retry_delay is None else retry_delay)
+        self.max_retry_delay = max_retry_delay or self.MAX_RETRY_DELAY
+        self.retry_interval = retry_interval or self.RETRY_INTERVAL
+        self.metric_callback = metric_callback
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = (
+            max_persistent_per_host or self.MAX_PERSISTENT_PER_HOST)
+        self.semaphores = {}
+        self.batches = {}
+        self.deliveries = set()
+        self._retry_loop = None
+
+    def start(self):
+        self._retry_loop = LoopingCall(self.process_retries)
+        self._retry_loop.clock = self.clock
+        d = self._retry_loop.start(self.retry_interval, now=False)
+        d.addErrback(lambda f: log.err(f, "Error processing push retries."))
+
+    @inlineCallbacks
+    def stop(self):
+        if self._retry_loop is not None and self._retry_loop.running:
+            self._retry_loop.stop()
+        # Anything that was waiting to be batched is sent as a retry when
+        # we (or another worker) start again.
+        for batch in self.batches.values():
+            batch.delayed_call.cancel()
+            yield self.queue_retry(
+                batch.conversation_key, batch.url, batch.get_body(), 0)
+        self.batches.clear()
+        yield self.wait_for_deliveries()
+        yield self.pool.closeCachedConnections()
+
+    def _fire_metric(self, url, name, value, agg):
+        if self.metric_callback is not None:
+            self.metric_callback('push.%s.%s' % (
+                push_url_metric_name(url), name), value, agg)
+
+    def get_semaphore(self, conversation_key):
+        semaphore = self.semaphores.get(conversation_key)
+        if semaphore is None:
+            semaphore = DeferredSemaphore(self.max_in_flight)
+            self.semaphores[conversation_key] = semaphore
+        return semaphore
+
+    def release(self, conversation_key):
+        semaphore = self.semaphores[conversation_key]
+        semaphore.release()
+        if semaphore.tokens == semaphore.limit and not semaphore.waiting:
+            del self.semaphores[conversation_key]
+
+    def push(self, conversation_key, url, message, batch_size=1):
+        """
+        Push `message` to `url`.
+
+        Returns a deferred that fires once the message has been added to a
+        batch or its request has been started.
+        """
+        key = (conversation_key, url)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = PushBatch(conversation_key, url, max(batch_size, 1))
+            if batch.batch_size > 1:
+                self.batches[key] = batch
+                batch.delayed_call = self.clock.callLater(
+                    self.batch_wait, self.send_batch, key)
+        batch.messages.append(message)
+        if batch.is_full():
+            return self.send_batch(key, batch)
+        return succeed(None)
+
+    def send_batch(self, key, batch=None):
+        if batch is None or self.batches.get(key) is batch:
+            batch = self.batches.pop(key)
+        if batch.delayed_call is not None and batch.delayed_call.active():
+            batch.delayed_call.cancel()
+        return self.send(batch.conversation_key, batch.url, batch.get_body())
+
+    def send(self, conversation_key, url, body, attempts=0):
+        d = self.get_semaphore(conversation_key).acquire()
+        d.addCallback(
+            lambda _: self.deliver(conversation_key, url, body, attempts))
+        return d
+
+    def deliver(self, conversation_key, url, body, attempts):
+        d = maybeDeferred(self.post_timed, url, body)
+        self.deliveries.add(d)
+        d.addBoth(self._delivered, conversation_key, url, body, attempts)
+        d.addErrback(lambda f: log.err(f, "Error handling push response."))
+        d.addBoth(lambda _: self.release(conversation_key))
+        d.addBoth(lambda _: self.deliveries.discard(d))
+        # We don't return the request's deferred because we don't want our
+        # caller to wait for the response.
+
+    def wait_for_deliveries(self):
+        """
+        Return a deferred that fires once the requests that are currently in
+        flight have been handled (and retries queued, if necessary).
+        """
+        return DeferredList(list(self.deliveries))
+
+    def post(self, url, body):
+        return http_request_full(
+            url.encode('utf-8'), data=body.encode('utf-8'), headers={
+                'Content-Type': 'application/json; charset=utf-8',
+            }, timeout=self.timeout,
+            agent_class=partial(Agent, pool=self.pool))
+
+    def post_timed(self, url, body):
+        start = time.time()
+        d = self.post(url, body)
+
+        def record_latency(result):
+            self._fire_metric(url, 'latency', time.time() - start, AVG)
+            return result
+
+        d.addBoth(record_latency)
+        return d
+
+    def _delivered(self, result, conversation_key, url, body, attempts):
+        if not hasattr(result, 'code'):
+            log.warning('Error pushing to %s: %s' % (
+                url, result.getErrorMessage()))
+        elif result.code < 500:
+            if result.code != 200:
+                log.warning('Got unexpected response code %s from %s' % (
+                    result.code, url))
+            return
+        else:
+            log.warning('Got unexpected response code %s from %s' % (
+                result.code, url))
+        self._fire_metric(url, 'failures', 1, SUM)
+        return self.retry(conversation_key, url, body, attempts + 1)
+
+    def get_retry_delay(self, attempts):
+        if attempts < 1:
+            return 0
+        return min(self.retry_delay * 2 ** (attempts - 1),
+                   self.max_retry_delay)
+
+    def retry(self, conversation_key, url, body, attempts):
+        if attempts > self.max_retries:
+            log.error('Giving up pushing to %s after %s attempts.' % (
+                url, attempts))
+            self._fire_metric(url, 'dropped', 1, SUM)
+            return
+        return self.queue_retry(conversation_key, url, body, attempts)
+
+    def queue_retry(self, conversation_key, url, body, attempts):
+        retry = json.dumps({
+            'id': uuid4().hex,
+            'conversation_key': conversation_key,
+            'url': url,
+            'body': body,
+            'attempts': attempts,
+        })
+        due = self.clock.seconds() + self.get_retry_delay(attempts)
+        return self.redis.zadd(self.RETRY_KEY, **{retry: due})
+
+    @inlineCallbacks
+    def process_retries(self):
+        """
+        Send the retries that are due, returning the number sent.
+        """
+        retries = yield self.redis.zrangebyscore(
+            self.RETRY_KEY, '-inf', self.clock.seconds(),
+            start=0, num=self.RETRY_CHUNK_SIZE)
+        sent = 0
+        for retry in retries:
+            # Only the worker that manages to remove a retry sends it.
+            claimed = yield self.redis.zrem(self.RETRY_KEY, retry)
+            if not claimed:
+                continue
+            retry = json.loads(retry)
+            yield self.send(retry['conversation_key'], retry['url'],
+                            retry['body'], retry['attempts'])
+            sent += 1
+        returnValue(sent)
@@ -1,16 +1,20 @@
 # -*- test-case-name: go.apps.http_api.tests.test_vumi_app -*-
 
+import re
 import json
 import copy
 
 from functools import partial
 
+from zope.interface import implements
+
 from twisted.web import resource, http, util
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.guard import HTTPAuthSessionWrapper, BasicCredentialFactory
 from twisted.cred import portal
 from twisted.internet.error import ConnectionDone
 from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.interfaces import IPushProducer
 
 from vumi import errors
 from vumi.blinkenlights import metrics
@@ -46,6 +50,28 @@ class BaseResource(resource.Resource):
         return user_api.get_wrapped_conversation(conversation_key)
 
 
+class StreamProducer(object):
+    """
+    Push producer registered on a streaming request so that we stop
+    publishing messages to the client while the connection's write buffer
+    is full. Messages arriving in the meantime are queued in the backlog.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def pauseProducing(self):
+        self.stream.pause_stream()
+
+    def resumeProducing(self):
+        self.stream.resume_stream()
+
+    def stopProducing(self):
+        # The stream is torn down when the request finishes.
+        pass
+
+
 class StreamResource(BaseResource):
 
     message_class = None
@@ -80,8 +106,9 @@ class StreamResource(BaseResource):
         # connection.
         request.write('')
         done = request.notifyFinish()
-        done.addBoth(self.teardown_stream)
+        done.addBoth(self.teardown_stream, request)
         self._callback = partial(self.publish, request)
+        request.registerProducer(StreamProducer(self), True)
         self.stream_ready.callback(request)
         return NOT_DONE_YET
 
@@ -89,12 +116,20 @@ class StreamResource(BaseResource):
         return self.worker.register_client(self._rk, self.message_class,
                                            self._callback)
 
-    def teardown_stream(self, err):
+    def teardown_stream(self, err, request):
         if not (err is None or err.trap(ConnectionDone)):
             log.error(err)
+        request.unregisterProducer()
         log.info('Unregistering: %s, %s' % (self._rk, err.getErrorMessage()))
         return self.worker.unregister_client(self._rk, self._callback)
 
+    def pause_stream(self):
+        self.worker.pause_client(self._rk, self._callback)
+
+    def resume_stream(self):
+        d = self.worker.resume_client(self._rk, self._callback)
+        d.addErrback(lambda f: log.err(f, "Error flushing stream backlog."))
+
     def publish(self, request, message):
         line = u'%s\n' % (message.to_json(),)
         request.write(line.encode(self.encoding))
@@ -104,22 +139,107 @@ class InvalidAggregate(errors.VumiError):
     pass
 
 
+class InvalidPayload(errors.VumiError):
+    pass
+
+
+class JsonItemReader(object):
+    """
+    Reads JSON values one at a time from a file-like object containing
+    either a JSON array or newline-delimited JSON values.
+
+    The file is read in chunks of `chunk_size` bytes so that we only hold
+    the value currently being decoded (and the rest of its chunk) in memory.
+    Twisted spools large request bodies to a temporary file, so this lets us
+    process large batches without ever holding the whole body in memory.
+
+    Values are decoded in place from an offset into the buffer, and the
+    part of the buffer before the offset is only discarded when the next
+    chunk is read, so reading an item doesn't copy the rest of its chunk.
+    """
+
+    chunk_size = 64 * 1024
+    max_item_size = 1024 * 1024
+
+    WHITESPACE = re.compile(r'\s*')
+
+    def __init__(self, fp, chunk_size=None):
+        self.fp = fp
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or an empty
+        string if there is no more data."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._read_chunk()
+
+    def _consume(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected %r.' % (char,))
+        self.pos += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                # Python 2.6's raw_decode() only accepts the start offset
+                # as a keyword argument.
+                value, end = self.decoder.raw_decode(
+                    self.buffer, idx=self.pos)
+            except ValueError:
+                if (self.eof or
+                        len(self.buffer) - self.pos > self.max_item_size):
+                    raise
+                self._read_chunk()
+                continue
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        if self._peek() != '[':
+            while self._peek():
+                yield self._decode()
+            return
+
+        self._consume('[')
+        if self._peek() == ']':
+            self._consume(']')
+        else:
+            while True:
+                yield self._decode()
+                if self._peek() != ',':
+                    self._consume(']')
+                    break
+                self._consume(',')
+        if self._peek():
+            raise ValueError('Unexpected data after JSON array.')
+
+
 class EventStream(StreamResource):
 
     message_class = TransportEvent
     routing_key = '%(transport_name)s.stream.event.%(conversation_key)s'
 
 
-class MessageStream(StreamResource):
-
-    message_class = TransportUserMessage
-    routing_key = '%(transport_name)s.stream.message.%(conversation_key)s'
-
-    def render_PUT(self, request):
-        d = Deferred()
-        d.addCallback(self.handle_PUT)
-        d.callback(request)
-        return NOT_DONE_YET
+class MessageSenderMixin(object):
+    """
+    Sends messages for a conversation from payloads PUT to the HTTP API.
+    """
 
     def get_load_balancer_metadata(self, payload):
         """
@@ -145,39 +265,37 @@ class MessageStream(StreamResource):
     def get_conversation_tag(self, conversation):
         return (conversation.delivery_tag_pool, conversation.delivery_tag)
 
-    @inlineCallbacks
-    def handle_PUT(self, request):
-        try:
-            payload = json.loads(request.content.read())
-        except ValueError:
-            request.setResponseCode(http.BAD_REQUEST, 'Invalid Message')
-            request.finish()
-            return
+    def check_payload(self, payload, *required_fields):
+        if not isinstance(payload, dict):
+            raise InvalidPayload('Invalid message')
+        for field in required_fields:
+            if field not in payload:
+                raise InvalidPayload('Missing %s value' % (field,))
+
+    def send_payload(self, conversation, payload):
+        """
+        Send a message (or reply, if the payload has an `in_reply_to`
+        value) for the given payload and return a deferred that fires with
+        the message sent.
 
+        :raises InvalidPayload: if the payload is not a valid message.
+        """
+        self.check_payload(payload)
         in_reply_to = payload.get('in_reply_to')
         if in_reply_to:
-            yield self.handle_PUT_in_reply_to(request, payload, in_reply_to)
-        else:
-            yield self.handle_PUT_send_to(request, payload)
+            return self.send_reply(conversation, payload, in_reply_to)
+        return self.send_message(conversation, payload)
 
     @inlineCallbacks
-    def handle_PUT_in_reply_to(self, request, payload, in_reply_to):
-        user_account = request.getUser()
-        conversation = yield self.get_conversation(user_account)
-
+    def send_reply(self, conversation, payload, in_reply_to):
+        self.check_payload(payload, 'content')
         reply_to = yield self.vumi_api.mdb.get_inbound_message(in_reply_to)
         if reply_to is None:
-            request.setResponseCode(http.BAD_REQUEST)
-            request.write('Invalid in_reply_to value')
-            request.finish()
-            return
+            raise InvalidPayload('Invalid in_reply_to value')
 
         reply_to_mdh = MessageMetadataHelper(self.vumi_api, reply_to)
         if reply_to_mdh.get_conversation_key() != conversation.key:
-            request.setResponseCode(http.BAD_REQUEST)
-            request.write('Invalid in_reply_to value')
-            request.finish()
-            return
+            raise InvalidPayload('Invalid in_reply_to value')
 
         msg_options = self.get_msg_options(payload,
                                            ['session_event', 'content'])
@@ -190,29 +308,139 @@ class MessageStream(StreamResource):
         msg = yield self.worker.reply_to(
             reply_to, content, continue_session,
             helper_metadata=helper_metadata)
+        returnValue(msg)
 
-        request.setResponseCode(http.OK)
-        request.write(msg.to_json())
-        request.finish()
-
-    @inlineCallbacks
-    def handle_PUT_send_to(self, request, payload):
-        user_account = request.getUser()
-        conversation = yield self.get_conversation(user_account)
-
+    def send_message(self, conversation, payload):
+        self.check_payload(payload, 'content', 'to_addr')
         msg_options = self.get_msg_options(payload, ['content', 'to_addr'])
         to_addr = msg_options.pop('to_addr')
         content = msg_options.pop('content')
         msg_options['helper_metadata'] = conversation.set_go_helper_metadata()
 
-        msg = yield self.worker.send_to(
+        return self.worker.send_to(
             to_addr, content, endpoint='default', **msg_options)
 
+
+class MessageStream(MessageSenderMixin, StreamResource):
+
+    message_class = TransportUserMessage
+    routing_key = '%(transport_name)s.stream.message.%(conversation_key)s'
+
+    def render_PUT(self, request):
+        d = Deferred()
+        d.addCallback(self.handle_PUT)
+        d.callback(request)
+        return NOT_DONE_YET
+
+    @inlineCallbacks
+    def handle_PUT(self, request):
+        try:
+            payload = json.loads(request.content.read())
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST, 'Invalid Message')
+            request.finish()
+            return
+
+        user_account = request.getUser()
+        conversation = yield self.get_conversation(user_account)
+        try:
+            msg = yield self.send_payload(conversation, payload)
+        except InvalidPayload, e:
+            request.setResponseCode(http.BAD_REQUEST)
+            request.write(str(e))
+            request.finish()
+            return
+
         request.setResponseCode(http.OK)
         request.write(msg.to_json())
         request.finish()
 
 
+class MessageBatchResource(MessageSenderMixin, BaseResource):
+    """
+    Sends a batch of messages in a single request.
+
+    The request body is either a JSON array of message payloads or
+    newline-delimited JSON message payloads, each in the same format as
+    those PUT to `messages.json`. Messages are validated and sent one at a
+    time as the body is read, and a result for each is written to the
+    response (as newline-delimited JSON) as soon as it is known::
+
+        {"index": 0, "success": true, "message_id": "..."}
+        {"index": 1, "success": false, "reason": "Missing to_addr value"}
+
+    A payload that cannot be decoded ends the batch, since we can't find
+    the start of the next payload.
+    """
+
+    encoding = 'utf-8'
+    content_type = 'application/json; charset=%s' % (encoding,)
+
+    def render_PUT(self, request):
+        # Filled in when the response is finished or the client
+        # disconnects, after which nothing more can be written.
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = Deferred()
+        d.addCallback(self.handle_PUT, finished)
+        d.addErrback(self.handle_error, request, finished)
+        d.callback(request)
+        return NOT_DONE_YET
+
+    render_POST = render_PUT
+
+    def handle_error(self, failure, request, finished):
+        """
+        Log an unexpected error and end the response. If results have
+        already been written, the response code can't be changed, so the
+        response just ends early.
+        """
+        log.err(failure, "Error sending message batch.")
+        if finished:
+            return
+        if not request.startedWriting:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.finish()
+
+    def write_result(self, request, index, success, **fields):
+        result = dict(fields, index=index, success=success)
+        request.write((u'%s\n' % (json.dumps(result),)).encode(
+            self.encoding))
+
+    @inlineCallbacks
+    def handle_PUT(self, request, finished):
+        user_account = request.getUser()
+        conversation = yield self.get_conversation(user_account)
+
+        request.setResponseCode(http.OK)
+        request.responseHeaders.addRawHeader(
+            'Content-Type', self.content_type)
+
+        index = 0
+        payloads = iter(JsonItemReader(request.content))
+        while True:
+            try:
+                payload = next(payloads)
+            except StopIteration:
+                break
+            except ValueError, e:
+                self.write_result(
+                    request, index, False, reason='Invalid JSON: %s' % (e,))
+                break
+
+            try:
+                msg = yield self.send_payload(conversation, payload)
+            except InvalidPayload, e:
+                self.write_result(request, index, False, reason=str(e))
+            else:
+                self.write_result(
+                    request, index, True, message_id=msg['message_id'])
+            index += 1
+
+        if not finished:
+            request.finish()
+
+
 class MetricResource(BaseResource):
 
     DEFAULT_STORE_NAME = 'default'
@@ -264,28 +492,18 @@ class ConversationResource(resource.Resource):
     def __init__(self, worker, conversation_key):
         resource.Resource.__init__(self)
         self.worker = worker
-        self.redis = worker.redis
         self.conversation_key = conversation_key
 
     def get_worker_config(self, user_account_key):
         ctxt = ConfigContext(user_account=user_account_key)
         return self.worker.get_config(msg=None, ctxt=ctxt)
 
-    def key(self, *args):
-        return ':'.join(['concurrency'] + map(unicode, args))
-
-    @inlineCallbacks
-    def is_allowed(self, config, user_id):
-        if config.concurrency_limit < 0:
-            returnValue(True)
-        count = int((yield self.redis.get(self.key(user_id))) or 0)
-        returnValue(count < config.concurrency_limit)
-
-    def track_request(self, user_id):
-        return self.redis.incr(self.key(user_id))
+    def acquire_request(self, config, user_id):
+        return self.worker.concurrency_limiter.acquire(
+            user_id, config.concurrency_limit)
 
     def release_request(self, err, user_id):
-        return self.redis.decr(self.key(user_id))
+        return self.worker.concurrency_limiter.release(user_id)
 
     def render(self, request):
         return resource.NoResource().render(request)
@@ -299,6 +517,7 @@ class ConversationResource(resource.Resource):
         class_map = {
             'events.json': EventStream,
             'messages.json': MessageStream,
+            'messages_batch.json': MessageBatchResource,
             'metrics.json': MetricResource,
         }
         stream_class = class_map.get(path)
@@ -308,13 +527,12 @@ class ConversationResource(resource.Resource):
 
         user_id = request.getUser()
         config = yield self.get_worker_config(user_id)
-        if (yield self.is_allowed(config, user_id)):
+        if (yield self.acquire_request(config, user_id)):
 
-            # remove track when request is closed
+            # release the request when it is closed
             finished = request.notifyFinish()
             finished.addBoth(self.release_request, user_id)
 
-            yield self.track_request(user_id)
             returnValue(stream_class(self.worker, self.conversation_key))
         returnValue(resource.ErrorPage(http.FORBIDDEN, 'Forbidden',
                                        'Too many concurrent connections'))
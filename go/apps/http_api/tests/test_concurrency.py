@@ -0,0 +1,113 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go.apps.http_api.concurrency import ConcurrencyLimiter
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class ConcurrencyLimiterTestCase(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.clock = Clock()
+        self.limiters = []
+        self.limiter = yield self.mk_limiter()
+
+    @inlineCallbacks
+    def tearDown(self):
+        for limiter in self.limiters:
+            if limiter.running:
+                yield limiter.stop()
+        yield self._persist_tearDown()
+
+    @inlineCallbacks
+    def mk_limiter(self, **kw):
+        limiter = ConcurrencyLimiter(self.redis, **kw)
+        limiter.clock = self.clock
+        self.limiters.append(limiter)
+        yield limiter.start()
+        self.assertTrue(limiter.running)
+        returnValue(limiter)
+
+    @inlineCallbacks
+    def assert_count(self, key, expected):
+        self.assertEqual((yield self.limiter.get_count(key)), expected)
+
+    @inlineCallbacks
+    def test_acquire_and_release(self):
+        self.assertTrue((yield self.limiter.acquire('user', 2)))
+        self.assertTrue((yield self.limiter.acquire('user', 2)))
+        self.assertFalse((yield self.limiter.acquire('user', 2)))
+        yield self.assert_count('user', 2)
+        self.assertTrue((yield self.limiter.acquire('other', 2)))
+
+        yield self.limiter.release('user')
+        yield self.assert_count('user', 1)
+        self.assertTrue((yield self.limiter.acquire('user', 2)))
+
+    @inlineCallbacks
+    def test_acquire_no_limit(self):
+        for i in range(5):
+            self.assertTrue((yield self.limiter.acquire('user', -1)))
+        yield self.assert_count('user', 5)
+
+    @inlineCallbacks
+    def test_limit_shared_between_workers(self):
+        other = yield self.mk_limiter()
+        self.assertTrue((yield self.limiter.acquire('user', 2)))
+        self.assertTrue((yield other.acquire('user', 2)))
+        self.assertFalse((yield self.limiter.acquire('user', 2)))
+        self.assertFalse((yield other.acquire('user', 2)))
+
+    @inlineCallbacks
+    def test_stop_releases_held(self):
+        other = yield self.mk_limiter()
+        yield other.acquire('user', 2)
+        yield self.limiter.acquire('user', 2)
+        yield other.stop()
+        yield self.assert_count('user', 1)
+        # Requests that finish after we've stopped are already released.
+        yield other.release('user')
+        yield self.assert_count('user', 1)
+
+    @inlineCallbacks
+    def test_expired_lease_reclaimed(self):
+        crashed = yield self.mk_limiter(lease_ttl=30)
+        yield crashed.acquire('user', 3)
+        yield crashed.acquire('user', 3)
+        yield self.limiter.acquire('user', 3)
+        # Simulate a crash by stopping the heartbeat without cleaning up.
+        crashed._heartbeat_loop.stop()
+        crashed.running = False
+
+        yield self.limiter.heartbeat()
+        yield self.assert_count('user', 3)
+
+        yield self.redis.delete(crashed.lease_key(crashed.worker_id))
+        yield self.limiter.heartbeat()
+        yield self.assert_count('user', 1)
+        self.assertEqual(
+            (yield self.redis.smembers(ConcurrencyLimiter.WORKERS_KEY)),
+            set([self.limiter.worker_id]))
+        # Only one worker reclaims the slots.
+        yield self.limiter.reclaim(crashed.worker_id)
+        yield self.assert_count('user', 1)
+
+    @inlineCallbacks
+    def test_release_after_reclaim(self):
+        lapsed = yield self.mk_limiter()
+        yield lapsed.acquire('user', 3)
+        yield self.limiter.acquire('user', 3)
+        yield self.redis.delete(lapsed.lease_key(lapsed.worker_id))
+        yield self.limiter.heartbeat()
+        yield self.assert_count('user', 1)
+        # The lapsed worker is still running and releases its slot later.
+        yield lapsed.release('user')
+        yield self.assert_count('user', 1)
+        self.assertTrue((yield lapsed.acquire('user', 3)))
+        yield self.assert_count('user', 2)
+        yield lapsed.release('user')
+        yield self.assert_count('user', 1)
@@ -0,0 +1,195 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks, DeferredQueue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.server import NOT_DONE_YET
+
+from vumi.message import TransportUserMessage
+from vumi.tests.utils import MockHttpServer
+from vumi.blinkenlights.metrics import SUM, AVG
+
+from go.apps.http_api.push import PushDeliveryManager, push_url_metric_name
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class PushDeliveryManagerTestCase(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.clock = Clock()
+        self.metrics = []
+        self.push_calls = DeferredQueue()
+        self.mock_push_server = MockHttpServer(self.handle_request)
+        yield self.mock_push_server.start()
+        self.url = self.mock_push_server.url
+        self.managers = []
+        self.manager = self.mk_manager()
+
+    @inlineCallbacks
+    def tearDown(self):
+        for manager in self.managers:
+            yield manager.stop()
+        yield self.mock_push_server.stop()
+        yield self._persist_tearDown()
+
+    def handle_request(self, request):
+        self.push_calls.put(request)
+        return NOT_DONE_YET
+
+    def mk_manager(self, **kw):
+        kw.setdefault(
+            'metric_callback', lambda *args: self.metrics.append(args))
+        manager = PushDeliveryManager(self.redis, **kw)
+        manager.clock = self.clock
+        self.managers.append(manager)
+        return manager
+
+    def mkmsg(self, i):
+        return TransportUserMessage(
+            to_addr='to', from_addr='from', transport_name='sphex',
+            transport_type='sms', content='in %s' % (i,), message_id=str(i))
+
+    def metric_names(self):
+        return [(name, agg) for name, value, agg in self.metrics]
+
+    @inlineCallbacks
+    def test_push(self):
+        msg = self.mkmsg(1)
+        # We don't wait for the response.
+        yield self.manager.push('conv', self.url, msg)
+        req = yield self.push_calls.get()
+        self.assertEqual(
+            TransportUserMessage.from_json(req.content.read()), msg)
+        self.assertEqual(req.requestHeaders.getRawHeaders('Content-Type'),
+                         ['application/json; charset=utf-8'])
+        req.finish()
+        yield self.manager.wait_for_deliveries()
+        name = push_url_metric_name(self.url)
+        self.assertEqual(self.metric_names(), [
+            ('push.%s.latency' % (name,), AVG)])
+        self.assertEqual(self.manager.semaphores, {})
+
+    @inlineCallbacks
+    def test_max_in_flight(self):
+        manager = self.mk_manager(max_in_flight=2)
+        yield manager.push('conv', self.url, self.mkmsg(1))
+        yield manager.push('conv', self.url, self.mkmsg(2))
+        d = manager.push('conv', self.url, self.mkmsg(3))
+        other_conv_d = manager.push('other', self.url, self.mkmsg(4))
+        self.assertFalse(d.called)
+        self.assertTrue(other_conv_d.called)
+
+        reqs = [(yield self.push_calls.get()) for i in range(3)]
+        self.assertFalse(d.called)
+        reqs[0].finish()
+        yield d
+        req = yield self.push_calls.get()
+        for req in reqs[1:] + [req]:
+            req.finish()
+        yield manager.wait_for_deliveries()
+
+    @inlineCallbacks
+    def test_batch(self):
+        msgs = [self.mkmsg(i) for i in range(3)]
+        for msg in msgs[:2]:
+            yield self.manager.push('conv', self.url, msg, batch_size=2)
+        yield self.manager.push('conv', self.url, msgs[2], batch_size=2)
+        req = yield self.push_calls.get()
+        self.assertEqual(
+            [data['message_id'] for data in json.loads(req.content.read())],
+            ['0', '1'])
+        req.finish()
+
+        # The last message is sent when the batch wait is over.
+        self.assertEqual(self.push_calls.pending, [])
+        self.clock.advance(self.manager.batch_wait)
+        req = yield self.push_calls.get()
+        [data] = json.loads(req.content.read())
+        self.assertEqual(data['message_id'], '2')
+        req.finish()
+        yield self.manager.wait_for_deliveries()
+        self.assertEqual(self.manager.batches, {})
+
+    @inlineCallbacks
+    def test_retry_server_error(self):
+        manager = self.mk_manager(retry_delay=2)
+        yield manager.push('conv', self.url, self.mkmsg(1))
+        req = yield self.push_calls.get()
+        req.setResponseCode(500)
+        req.finish()
+        yield manager.wait_for_deliveries()
+        name = push_url_metric_name(self.url)
+        self.assertEqual(self.metric_names(), [
+            ('push.%s.latency' % (name,), AVG),
+            ('push.%s.failures' % (name,), SUM)])
+
+        self.assertEqual((yield manager.process_retries()), 0)
+        self.clock.advance(2)
+        self.assertEqual((yield manager.process_retries()), 1)
+        req = yield self.push_calls.get()
+        self.assertEqual(
+            TransportUserMessage.from_json(req.content.read())['message_id'],
+            '1')
+        req.finish()
+        yield manager.wait_for_deliveries()
+        self.assertEqual((yield manager.process_retries()), 0)
+
+    @inlineCallbacks
+    def test_no_retry_client_error(self):
+        yield self.manager.push('conv', self.url, self.mkmsg(1))
+        req = yield self.push_calls.get()
+        req.setResponseCode(400)
+        req.finish()
+        yield self.manager.wait_for_deliveries()
+        self.clock.advance(self.manager.max_retry_delay)
+        self.assertEqual((yield self.manager.process_retries()), 0)
+
+    @inlineCallbacks
+    def test_retry_backoff(self):
+        manager = self.mk_manager(retry_delay=1, max_retry_delay=5)
+        self.assertEqual(
+            [manager.get_retry_delay(i) for i in range(6)],
+            [0, 1, 2, 4, 5, 5])
+        yield manager.queue_retry('conv', self.url, '{}', 3)
+        self.clock.advance(3)
+        self.assertEqual((yield manager.process_retries()), 0)
+        self.clock.advance(1)
+        self.assertEqual((yield manager.process_retries()), 1)
+        req = yield self.push_calls.get()
+        req.finish()
+        yield manager.wait_for_deliveries()
+
+    @inlineCallbacks
+    def test_give_up_after_max_retries(self):
+        manager = self.mk_manager(max_retries=0)
+        yield manager.push('conv', self.url, self.mkmsg(1))
+        req = yield self.push_calls.get()
+        req.setResponseCode(503)
+        req.finish()
+        yield manager.wait_for_deliveries()
+        name = push_url_metric_name(self.url)
+        self.assertEqual(self.metric_names()[-1],
+                         ('push.%s.dropped' % (name,), SUM))
+        self.clock.advance(manager.max_retry_delay)
+        self.assertEqual((yield manager.process_retries()), 0)
+
+    @inlineCallbacks
+    def test_stop_queues_pending_batches(self):
+        manager = self.mk_manager()
+        yield manager.push('conv', self.url, self.mkmsg(1), batch_size=5)
+        yield manager.stop()
+        self.assertEqual(self.push_calls.pending, [])
+        self.assertEqual((yield manager.process_retries()), 1)
+        req = yield self.push_calls.get()
+        [data] = json.loads(req.content.read())
+        self.assertEqual(data['message_id'], '1')
+        req.finish()
+        yield manager.wait_for_deliveries()
+
+    def test_push_url_metric_name(self):
+        self.assertEqual(
+            push_url_metric_name('http://example.com:8080/foo/bar.json?a=1'),
+            'example_com_8080_foo_bar_json')
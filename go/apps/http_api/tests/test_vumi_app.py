@@ -1,11 +1,14 @@
 import uuid
 import base64
 import json
+from StringIO import StringIO
 
-from twisted.internet.defer import inlineCallbacks, DeferredQueue, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, DeferredQueue, returnValue, gatherResults)
 from twisted.web.http_headers import Headers
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
+from twisted.trial.unittest import TestCase
 
 from vumi.utils import http_request_full
 from vumi.message import TransportUserMessage, TransportEvent
@@ -13,9 +16,12 @@ from vumi.tests.utils import MockHttpServer
 from vumi.transports.vumi_bridge.client import StreamingClient
 from vumi.config import ConfigContext
 
-from go.vumitools.tests.utils import AppWorkerTestCase
-from go.apps.http_api.vumi_app import StreamingHTTPWorker
-from go.apps.http_api.resource import StreamResource, ConversationResource
+from go.vumitools.tests.utils import AppWorkerTestCase, GoPersistenceMixin
+from go.apps.http_api.vumi_app import (
+    StreamingHTTPWorker, StreamingClientManager)
+from go.apps.http_api.resource import (
+    StreamResource, ConversationResource, MessageBatchResource,
+    JsonItemReader)
 
 
 class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
@@ -240,6 +246,15 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
         self.assertEqual(sent_msg['to_addr'], msg['to_addr'])
         self.assertEqual(sent_msg['from_addr'], None)
 
+    @inlineCallbacks
+    def test_send_to_missing_to_addr(self):
+        url = '%s/%s/messages.json' % (self.url, self.conversation.key)
+        response = yield http_request_full(url, json.dumps({'content': 'foo'}),
+                                           self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.BAD_REQUEST)
+        self.assertEqual(response.delivered_body, 'Missing to_addr value')
+        self.assertEqual(self.get_dispatched_messages(), [])
+
     @inlineCallbacks
     def test_invalid_in_reply_to(self):
         msg = {
@@ -289,6 +304,99 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
         self.assertEqual(sent_msg['to_addr'], inbound_msg['from_addr'])
         self.assertEqual(sent_msg['from_addr'], '9292')
 
+    @inlineCallbacks
+    def put_batch(self, body):
+        url = '%s/%s/messages_batch.json' % (self.url, self.conversation.key)
+        response = yield http_request_full(url, body, self.auth_headers,
+                                           method='PUT')
+        self.assertEqual(response.code, http.OK)
+        results = [json.loads(line)
+                   for line in response.delivered_body.splitlines()]
+        returnValue(results)
+
+    @inlineCallbacks
+    def test_batch_send_to(self):
+        msgs = [
+            {'to_addr': '+2345', 'content': 'foo'},
+            {'content': 'no address'},
+            {'to_addr': '+6789', 'content': 'bar', 'message_id': 'evil_id'},
+        ]
+        results = yield self.put_batch(json.dumps(msgs))
+
+        sent_msgs = self.get_dispatched_messages()
+        self.assertEqual([m['to_addr'] for m in sent_msgs], ['+2345', '+6789'])
+        self.assertEqual([m['content'] for m in sent_msgs], ['foo', 'bar'])
+        for sent_msg in sent_msgs:
+            self.assertEqual(sent_msg['helper_metadata'], {
+                'go': {
+                    'conversation_key': self.conversation.key,
+                    'conversation_type': 'http_api',
+                    'user_account': self.account.key,
+                },
+            })
+        self.assertEqual(results, [
+            {'index': 0, 'success': True,
+             'message_id': sent_msgs[0]['message_id']},
+            {'index': 1, 'success': False,
+             'reason': 'Missing to_addr value'},
+            {'index': 2, 'success': True,
+             'message_id': sent_msgs[1]['message_id']},
+        ])
+
+    @inlineCallbacks
+    def test_batch_newline_delimited(self):
+        inbound_msg = self.mkmsg_in(content='in 1', message_id='1')
+        self.conversation.set_go_helper_metadata(
+            inbound_msg['helper_metadata'])
+        yield self.store_inbound_msg(inbound_msg, self.conversation)
+
+        msgs = [
+            {'content': 'reply', 'in_reply_to': inbound_msg['message_id']},
+            {'content': 'bad reply', 'in_reply_to': 'unknown'},
+            {'to_addr': '+2345', 'content': 'foo'},
+        ]
+        results = yield self.put_batch(
+            '\n'.join(json.dumps(msg) for msg in msgs))
+
+        [reply, sent_msg] = self.get_dispatched_messages()
+        self.assertEqual(reply['to_addr'], inbound_msg['from_addr'])
+        self.assertEqual(reply['in_reply_to'], inbound_msg['message_id'])
+        self.assertEqual(sent_msg['to_addr'], '+2345')
+        self.assertEqual(results, [
+            {'index': 0, 'success': True, 'message_id': reply['message_id']},
+            {'index': 1, 'success': False,
+             'reason': 'Invalid in_reply_to value'},
+            {'index': 2, 'success': True,
+             'message_id': sent_msg['message_id']},
+        ])
+
+    @inlineCallbacks
+    def test_batch_invalid_json(self):
+        results = yield self.put_batch(
+            '{"to_addr": "+2345", "content": "foo"}\n{bad}\n'
+            '{"to_addr": "+6789", "content": "bar"}')
+
+        [sent_msg] = self.get_dispatched_messages()
+        self.assertEqual(sent_msg['to_addr'], '+2345')
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]['index'], 1)
+        self.assertEqual(results[1]['success'], False)
+        self.assertTrue(results[1]['reason'].startswith('Invalid JSON'))
+
+    @inlineCallbacks
+    def test_batch_unexpected_error(self):
+        def send_payload(resource, conversation, payload):
+            raise RuntimeError("Oops.")
+        self.patch(MessageBatchResource, 'send_payload', send_payload)
+
+        url = '%s/%s/messages_batch.json' % (self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, json.dumps([{'to_addr': '+2345', 'content': 'foo'}]),
+            self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.INTERNAL_SERVER_ERROR)
+        self.assertEqual(self.get_dispatched_messages(), [])
+        [err] = self.flushLoggedErrors(RuntimeError)
+
     @inlineCallbacks
     def test_metric_publishing(self):
 
@@ -342,7 +450,8 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
                              concurrency_limit=-1)
         config = yield self.app.get_config(msg=None, ctxt=ctxt)
         self.assertTrue(
-            (yield conv_resource.is_allowed(config, self.account.key)))
+            (yield conv_resource.acquire_request(config, self.account.key)))
+        yield conv_resource.release_request(None, self.account.key)
 
     @inlineCallbacks
     def test_backlog_on_connect(self):
@@ -412,6 +521,24 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
         posted_msg = TransportUserMessage.from_json(posted_json_data)
         self.assertEqual(posted_msg['message_id'], msg['message_id'])
 
+    @inlineCallbacks
+    def test_post_inbound_messages_batched(self):
+        self.conversation.config['http_api'].update({
+            'push_message_url': self.mock_push_server.url,
+            'push_batch_size': 2,
+        })
+        yield self.conversation.save()
+
+        msg1 = self.mkmsg_in(content='in 1', message_id='1')
+        yield self.dispatch_to_conv(msg1, self.conversation)
+        msg2 = self.mkmsg_in(content='in 2', message_id='2')
+        yield self.dispatch_to_conv(msg2, self.conversation)
+
+        req = yield self.push_calls.get()
+        posted = json.loads(req.content.read())
+        req.finish()
+        self.assertEqual([data['message_id'] for data in posted], ['1', '2'])
+
     @inlineCallbacks
     def test_post_inbound_event(self):
         # Set the URL so stuff is HTTP Posted instead of streamed.
@@ -514,3 +641,193 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
         self.assertEqual(sent_msg['to_addr'], msg['from_addr'])
         self.assertEqual(sent_msg['content'], 'foo')
         self.assertEqual(sent_msg['in_reply_to'], msg['message_id'])
+
+
+class JsonItemReaderTestCase(TestCase):
+
+    def read_items(self, data, chunk_size=3):
+        return list(JsonItemReader(StringIO(data), chunk_size=chunk_size))
+
+    def test_json_array(self):
+        data = '[{"a": 1}, {"b": [1, 2]} ,\n {"c": "x, ]"}]'
+        expected = [{'a': 1}, {'b': [1, 2]}, {'c': 'x, ]'}]
+        self.assertEqual(self.read_items(data), expected)
+        self.assertEqual(self.read_items(data, chunk_size=1024), expected)
+
+    def test_newline_delimited(self):
+        self.assertEqual(self.read_items('{"a": 1}\n{"b": 2}\n\n'),
+                         [{'a': 1}, {'b': 2}])
+
+    def test_empty(self):
+        self.assertEqual(self.read_items(''), [])
+        self.assertEqual(self.read_items(' [ ] '), [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.read_items, '[{"a": 1} {"b": 2}]')
+        self.assertRaises(ValueError, self.read_items, '[{"a": 1},]')
+        self.assertRaises(ValueError, self.read_items, '[{"a": 1}] x')
+        self.assertRaises(ValueError, self.read_items, '{"a": 1}\n{bad}')
+
+
+class StreamingClientManagerTestCase(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.metrics = []
+        self.manager = self.mk_manager()
+        self.received = []
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_manager(self, **kw):
+        kw.setdefault(
+            'metric_callback', lambda *args: self.metrics.append(args))
+        return StreamingClientManager(self.redis, **kw)
+
+    def mkmsg(self, i):
+        return TransportUserMessage(
+            to_addr='to', from_addr='from', transport_name='sphex',
+            transport_type='sms', content='in %s' % (i,), message_id=str(i))
+
+    def start(self, manager):
+        manager.start('key', TransportUserMessage, self.received.append)
+
+    def received_ids(self):
+        return [msg['message_id'] for msg in self.received]
+
+    @inlineCallbacks
+    def test_backlog_trimmed(self):
+        manager = self.mk_manager(max_backlog_size=3)
+        for i in range(5):
+            yield manager.publish('key', self.mkmsg(i))
+        self.assertEqual(self.metrics, [
+            ('backlog.dropped', 1), ('backlog.dropped', 1)])
+        self.start(manager)
+        yield manager.flush_backlog('key', TransportUserMessage,
+                                    self.received.append)
+        self.assertEqual(self.received_ids(), ['2', '3', '4'])
+
+    @inlineCallbacks
+    def test_flush_backlog_in_chunks(self):
+        manager = self.mk_manager(flush_chunk_size=3)
+        for i in range(10):
+            yield manager.publish('key', self.mkmsg(i))
+        self.start(manager)
+        yield manager.flush_backlog('key', TransportUserMessage,
+                                    self.received.append)
+        self.assertEqual(self.received_ids(), [str(i) for i in range(10)])
+        self.assertEqual(
+            (yield self.redis.llen(manager.backlog_key('key'))), 0)
+        self.assertEqual(self.metrics, [])
+
+    @inlineCallbacks
+    def test_paused_client_skipped(self):
+        self.start(self.manager)
+        self.manager.pause('key', self.received.append)
+        yield self.manager.publish('key', self.mkmsg(0))
+        self.assertEqual(self.received, [])
+        yield self.manager.resume('key', self.received.append)
+        self.assertEqual(self.received_ids(), ['0'])
+        yield self.manager.publish('key', self.mkmsg(1))
+        self.assertEqual(self.received_ids(), ['0', '1'])
+
+    @inlineCallbacks
+    def test_flush_stops_when_client_paused(self):
+        manager = self.mk_manager(flush_chunk_size=1)
+        for i in range(4):
+            yield manager.publish('key', self.mkmsg(i))
+
+        def callback(msg):
+            self.received.append(msg)
+            manager.pause('key', callback)
+
+        manager.start('key', TransportUserMessage, callback)
+        yield manager.flush_backlog('key', TransportUserMessage, callback)
+        self.assertEqual(self.received_ids(), ['0'])
+        self.assertEqual(
+            (yield self.redis.llen(manager.backlog_key('key'))), 3)
+
+    @inlineCallbacks
+    def test_concurrent_flushes(self):
+        manager = self.mk_manager(flush_chunk_size=2)
+        for i in range(5):
+            yield manager.publish('key', self.mkmsg(i))
+
+        self.start(manager)
+        # Redis calls don't return immediately, so these would all be
+        # reading from the backlog at the same time.
+        d1 = manager.flush_backlog(
+            'key', TransportUserMessage, self.received.append)
+        d2 = manager.resume('key', self.received.append)
+        d3 = manager.flush_backlog(
+            'key', TransportUserMessage, self.received.append)
+        yield gatherResults([d1, d2, d3])
+        self.assertEqual(self.received_ids(), [str(i) for i in range(5)])
+        self.assertEqual(
+            (yield self.redis.llen(manager.backlog_key('key'))), 0)
+        self.assertEqual(manager.flushes, {})
+
+    @inlineCallbacks
+    def test_publish_during_flush(self):
+        manager = self.mk_manager(flush_chunk_size=2)
+        for i in range(3):
+            yield manager.publish('key', self.mkmsg(i))
+
+        published = []
+
+        def callback(msg):
+            self.received.append(msg)
+            if msg['message_id'] == '0':
+                published.append(manager.publish('key', self.mkmsg(3)))
+
+        manager.start('key', TransportUserMessage, callback)
+        yield manager.flush_backlog('key', TransportUserMessage, callback)
+        yield gatherResults(published)
+        self.assertEqual(self.received_ids(), ['0', '1', '2', '3'])
+        self.assertEqual(
+            (yield self.redis.llen(manager.backlog_key('key'))), 0)
+        self.assertEqual(manager.queued_during_flush, {})
+
+    @inlineCallbacks
+    def test_backlog_trimmed_during_flush(self):
+        manager = self.mk_manager(max_backlog_size=3, flush_chunk_size=2)
+        for i in range(3):
+            yield manager.publish('key', self.mkmsg(i))
+
+        published = []
+
+        def callback(msg):
+            self.received.append(msg)
+            if msg['message_id'] == '0':
+                for i in range(3, 6):
+                    published.append(manager.publish('key', self.mkmsg(i)))
+
+        manager.start('key', TransportUserMessage, callback)
+        yield manager.flush_backlog('key', TransportUserMessage, callback)
+        yield gatherResults(published)
+        # Message 2 is dropped from the full backlog, but nothing that was
+        # still in the backlog is removed without being delivered.
+        self.assertEqual(self.received_ids(), ['0', '1', '3', '4', '5'])
+        self.assertEqual(
+            (yield self.redis.llen(manager.backlog_key('key'))), 0)
+
+    @inlineCallbacks
+    def test_flush_continues_with_other_client(self):
+        manager = self.mk_manager(flush_chunk_size=1)
+        for i in range(3):
+            yield manager.publish('key', self.mkmsg(i))
+        other_received = []
+
+        def callback(msg):
+            self.received.append(msg)
+            manager.pause('key', callback)
+
+        manager.start('key', TransportUserMessage, callback)
+        manager.start('key', TransportUserMessage, other_received.append)
+        yield manager.flush_backlog('key', TransportUserMessage, callback)
+        self.assertEqual(self.received_ids(), ['0'])
+        self.assertEqual(
+            [msg['message_id'] for msg in other_received], ['1', '2'])
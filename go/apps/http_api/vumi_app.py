@@ -2,27 +2,61 @@
 from collections import defaultdict
 import random
 
-from twisted.internet.defer import inlineCallbacks, maybeDeferred
-from twisted.web import http
+from twisted.internet.defer import (
+    inlineCallbacks, maybeDeferred, gatherResults, Deferred)
 
-from vumi.config import ConfigInt, ConfigText
-from vumi.utils import http_request_full
+from vumi.config import ConfigInt, ConfigText, ConfigFloat
+from vumi.blinkenlights.metrics import SUM
 from vumi.transports.httprpc import httprpc
 from vumi import log
 
 from go.vumitools.app_worker import GoApplicationWorker
+from go.apps.http_api.push import PushDeliveryManager
+from go.apps.http_api.concurrency import ConcurrencyLimiter
 from go.apps.http_api.resource import (AuthorizedResource, MessageStream,
                                        EventStream)
 
 
 class StreamingClientManager(object):
+    """
+    Keeps track of the streaming clients connected for each routing key and
+    publishes messages to them.
+
+    Messages are only written to clients whose streams are not paused (i.e.
+    whose connection's write buffer is not full). If there are no such
+    clients, messages are queued in a backlog in Redis which holds at most
+    `max_backlog_size` of the most recent messages. The backlog is flushed
+    to the first client that connects or whose stream is resumed. While a
+    backlog is being flushed, new messages for it are added to the backlog
+    rather than published directly, so that they are delivered in order.
+
+    :param redis:
+        Redis manager the backlogs are stored in.
+    :param int max_backlog_size:
+        Maximum number of messages to keep in each backlog.
+    :param int flush_chunk_size:
+        Number of messages to read from a backlog at a time while flushing.
+    :param metric_callback:
+        Optional callable called with a metric name and value (e.g.
+        ``('backlog.dropped', 1)``) when messages are dropped from a
+        backlog.
+    """
 
     MAX_BACKLOG_SIZE = 100
+    FLUSH_CHUNK_SIZE = 100
     CLIENT_PREFIX = 'clients'
 
-    def __init__(self, redis):
+    def __init__(self, redis, max_backlog_size=None, flush_chunk_size=None,
+                 metric_callback=None):
         self.redis = redis
+        self.max_backlog_size = max_backlog_size or self.MAX_BACKLOG_SIZE
+        self.flush_chunk_size = flush_chunk_size or self.FLUSH_CHUNK_SIZE
+        self.metric_callback = metric_callback
         self.clients = defaultdict(list)
+        self.paused = defaultdict(list)
+        self.message_classes = {}
+        self.flushes = {}
+        self.queued_during_flush = {}
 
     def client_key(self, *args):
         return u':'.join([self.CLIENT_PREFIX] + map(unicode, args))
@@ -30,23 +64,113 @@ class StreamingClientManager(object):
     def backlog_key(self, key):
         return self.client_key('backlog', key)
 
-    @inlineCallbacks
+    def _fire_metric(self, name, value):
+        if self.metric_callback is not None:
+            self.metric_callback(name, value)
+
+    def is_available(self, key, callback):
+        return (callback in self.clients[key]
+                and callback not in self.paused[key])
+
     def flush_backlog(self, key, message_class, callback):
+        """
+        Write the messages in the backlog for `key` to `callback` (or to
+        another available client for `key` if `callback` stops being
+        available), oldest first, until the backlog is empty or there are no
+        available clients.
+
+        Only one flush runs for each key at a time, so that messages are
+        neither delivered twice nor out of order. If a flush is already
+        running, the deferred returned fires once it is done.
+        """
+        if key in self.flushes:
+            d = Deferred()
+            self.flushes[key].append(d)
+            return d
+        self.flushes[key] = []
+        d = self._flush_backlog(key, message_class, callback)
+        d.addBoth(self._flush_done, key)
+        return d
+
+    def _flush_done(self, result, key):
+        self.queued_during_flush.pop(key, None)
+        for d in self.flushes.pop(key):
+            d.callback(None)
+        return result
+
+    def _flush_target(self, key, callback):
+        if self.is_available(key, callback):
+            return callback
+        for other in self.clients[key]:
+            if other not in self.paused[key]:
+                return other
+        return None
+
+    @inlineCallbacks
+    def _flush_backlog(self, key, message_class, callback):
         backlog_key = self.backlog_key(key)
         while True:
-            obj = yield self.redis.rpop(backlog_key)
-            if obj is None:
+            callback = self._flush_target(key, callback)
+            if callback is None:
+                break
+            # Messages published after this are queued in the backlog, and
+            # the count tells us whether any arrived after the backlog was
+            # found to be empty.
+            self.queued_during_flush[key] = 0
+            # New messages are pushed onto the head of the list, so the
+            # oldest messages are at the tail. We pop each message we
+            # deliver (rather than trimming the chunk afterwards) because
+            # `queue_in_backlog` may trim the tail while we're delivering.
+            # The pops are sent together rather than waiting for each reply
+            # in turn.
+            objs = yield gatherResults([
+                self.redis.rpop(backlog_key)
+                for _ in range(self.flush_chunk_size)])
+            objs = [obj for obj in objs if obj is not None]
+            if not objs:
+                if self.queued_during_flush[key]:
+                    continue
                 break
-            yield maybeDeferred(callback, message_class.from_json(obj))
+            for i, obj in enumerate(objs):
+                callback = self._flush_target(key, callback)
+                if callback is None:
+                    # Put the undelivered messages back, oldest last.
+                    for undelivered in reversed(objs[i:]):
+                        yield self.redis.rpush(backlog_key, undelivered)
+                    break
+                yield maybeDeferred(callback, message_class.from_json(obj))
 
     def start(self, key, message_class, callback):
+        self.message_classes[key] = message_class
         self.clients[key].append(callback)
 
     def stop(self, key, callback):
         self.clients[key].remove(callback)
+        if callback in self.paused[key]:
+            self.paused[key].remove(callback)
+
+    def pause(self, key, callback):
+        """
+        Stop publishing messages to `callback` until it is resumed.
+        """
+        if callback not in self.paused[key]:
+            self.paused[key].append(callback)
+
+    def resume(self, key, callback):
+        """
+        Start publishing messages to `callback` again, after flushing any
+        messages that were queued while it was paused.
+        """
+        if callback in self.paused[key]:
+            self.paused[key].remove(callback)
+        return self.flush_backlog(key, self.message_classes[key], callback)
 
     def publish(self, key, msg):
-        callbacks = self.clients[key]
+        if key in self.flushes:
+            self.queued_during_flush[key] += 1
+            return self.queue_in_backlog(key, msg)
+        callbacks = [callback for callback in self.clients[key]
+                     if callback not in self.paused[key]]
         if callbacks:
             callback = random.choice(callbacks)
             return maybeDeferred(callback, msg)
@@ -56,8 +180,14 @@ class StreamingClientManager(object):
     @inlineCallbacks
     def queue_in_backlog(self, key, msg):
         backlog_key = self.backlog_key(key)
-        yield self.redis.lpush(backlog_key, msg.to_json())
-        yield self.redis.ltrim(backlog_key, 0, self.MAX_BACKLOG_SIZE - 1)
+        # These are sent together rather than waiting for each reply in turn.
+        backlog_size, _ = yield gatherResults([
+            self.redis.lpush(backlog_key, msg.to_json()),
+            self.redis.ltrim(backlog_key, 0, self.max_backlog_size - 1),
+        ])
+        dropped = backlog_size - self.max_backlog_size
+        if dropped > 0:
+            self._fire_metric('backlog.dropped', dropped)
 
 
 class StreamingHTTPWorkerConfig(GoApplicationWorker.CONFIG_CLASS):
@@ -76,6 +206,44 @@ class StreamingHTTPWorkerConfig(GoApplicationWorker.CONFIG_CLASS):
         "Maximum number of clients per account. A value less than "
         "zero disables the limit",
         default=10)
+    concurrency_lease_ttl = ConfigInt(
+        "Number of seconds after a worker stops responding that the"
+        " connections it was counting for each account are released.",
+        default=ConcurrencyLimiter.LEASE_TTL, static=True)
+    max_backlog_size = ConfigInt(
+        "Maximum number of messages to keep for each stream while no clients"
+        " are able to receive them. Older messages are dropped.",
+        default=StreamingClientManager.MAX_BACKLOG_SIZE, static=True)
+    backlog_flush_chunk_size = ConfigInt(
+        "Number of backlogged messages to read from Redis at a time when a"
+        " client connects.",
+        default=StreamingClientManager.FLUSH_CHUNK_SIZE, static=True)
+    push_max_in_flight = ConfigInt(
+        "Maximum number of requests to make to a conversation's push URLs at"
+        " a time.",
+        default=PushDeliveryManager.MAX_IN_FLIGHT, static=True)
+    push_max_persistent_per_host = ConfigInt(
+        "Maximum number of idle connections to keep open to each push URL"
+        " host.",
+        default=PushDeliveryManager.MAX_PERSISTENT_PER_HOST, static=True)
+    push_batch_wait = ConfigFloat(
+        "Number of seconds to wait for more messages before pushing a batch"
+        " that isn't full. Conversations only batch pushed messages if they"
+        " set `push_batch_size`.",
+        default=PushDeliveryManager.BATCH_WAIT, static=True)
+    push_timeout = ConfigFloat(
+        "Number of seconds to wait for a push URL to respond.",
+        default=PushDeliveryManager.TIMEOUT, static=True)
+    push_max_retries = ConfigInt(
+        "Maximum number of times to retry a failed push.",
+        default=PushDeliveryManager.MAX_RETRIES, static=True)
+    push_retry_delay = ConfigFloat(
+        "Number of seconds to wait before retrying a failed push. This is"
+        " doubled for each further attempt.",
+        default=PushDeliveryManager.RETRY_DELAY, static=True)
+    push_max_retry_delay = ConfigFloat(
+        "Maximum number of seconds to wait before retrying a failed push.",
+        default=PushDeliveryManager.MAX_RETRY_DELAY, static=True)
 
 
 class StreamingHTTPWorker(GoApplicationWorker):
@@ -97,7 +265,25 @@ class StreamingHTTPWorker(GoApplicationWorker):
         self._event_handlers = {}
         self._session_handlers = {}
         self.client_manager = StreamingClientManager(
-            self.redis.sub_manager('http_api:message_cache'))
+            self.redis.sub_manager('http_api:message_cache'),
+            max_backlog_size=config.max_backlog_size,
+            flush_chunk_size=config.backlog_flush_chunk_size,
+            metric_callback=self.fire_client_manager_metric)
+        self.push_manager = PushDeliveryManager(
+            self.redis.sub_manager('http_api:push'),
+            max_in_flight=config.push_max_in_flight,
+            max_persistent_per_host=config.push_max_persistent_per_host,
+            batch_wait=config.push_batch_wait,
+            timeout=config.push_timeout,
+            max_retries=config.push_max_retries,
+            retry_delay=config.push_retry_delay,
+            max_retry_delay=config.push_max_retry_delay,
+            metric_callback=self.publish_metric)
+        self.push_manager.start()
+        self.concurrency_limiter = ConcurrencyLimiter(
+            self.redis.sub_manager('http_api:concurrency'),
+            lease_ttl=config.concurrency_lease_ttl)
+        yield self.concurrency_limiter.start()
 
         self.webserver = self.start_web_resources([
             (AuthorizedResource(self), self.web_path),
@@ -119,6 +305,15 @@ class StreamingHTTPWorker(GoApplicationWorker):
     def unregister_client(self, conversation_key, callback):
         self.client_manager.stop(conversation_key, callback)
 
+    def pause_client(self, key, callback):
+        self.client_manager.pause(key, callback)
+
+    def resume_client(self, key, callback):
+        return self.client_manager.resume(key, callback)
+
+    def fire_client_manager_metric(self, name, value):
+        self.publish_metric(name, value, SUM)
+
     def get_api_config(self, conversation, key):
         return conversation.config.get('http_api', {}).get(key)
 
@@ -136,10 +331,7 @@ class StreamingHTTPWorker(GoApplicationWorker):
         push_message_url = self.get_api_config(conversation,
                                                'push_message_url')
         if push_message_url:
-            resp = yield self.push(push_message_url, message)
-            if resp.code != http.OK:
-                log.warning('Got unexpected response code %s from %s' % (
-                    resp.code, push_message_url))
+            yield self.push(conversation, push_message_url, message)
         else:
             yield self.stream(MessageStream, conversation.key, message)
 
@@ -158,18 +350,14 @@ class StreamingHTTPWorker(GoApplicationWorker):
         conversation = config.get_conversation()
         push_event_url = self.get_api_config(conversation, 'push_event_url')
         if push_event_url:
-            resp = yield self.push(push_event_url, event)
-            if resp.code != http.OK:
-                log.warning('Got unexpected response code %s from %s' % (
-                    resp.code, push_event_url))
+            yield self.push(conversation, push_event_url, event)
         else:
             yield self.stream(EventStream, conversation.key, event)
 
-    def push(self, url, vumi_message):
-        data = vumi_message.to_json().encode('utf-8')
-        return http_request_full(url.encode('utf-8'), data=data, headers={
-            'Content-Type': 'application/json; charset=utf-8',
-        })
+    def push(self, conversation, url, vumi_message):
+        batch_size = self.get_api_config(conversation, 'push_batch_size') or 1
+        return self.push_manager.push(
+            conversation.key, url, vumi_message, batch_size=batch_size)
 
     def get_health_response(self):
         return str(sum([len(callbacks) for callbacks in
@@ -177,5 +365,9 @@ class StreamingHTTPWorker(GoApplicationWorker):
 
     @inlineCallbacks
     def teardown_application(self):
-        yield super(StreamingHTTPWorker, self).teardown_application()
+        # Pending pushes and our concurrency counts need Redis and metrics,
+        # both of which are shut down by our superclass.
         yield self.webserver.loseConnection()
+        yield self.push_manager.stop()
+        yield self.concurrency_limiter.stop()
+        yield super(StreamingHTTPWorker, self).teardown_application()
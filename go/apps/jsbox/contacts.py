@@ -1,7 +1,7 @@
 # -*- test-case-name: go.apps.jsbox.tests.test_contacts -*-
 # -*- coding: utf-8 -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 
 from vumi import log
 from vumi.application.sandbox import SandboxResource, SandboxError
@@ -17,8 +17,30 @@ class ContactsResource(SandboxResource):
 
     See :class:`go.vumitools.contact.Contact` for a look at the Contact model
     and its fields.
+
+    Resource config fields:
+        - ``max_bulk_size``: The maximum number of contacts (or keys) that
+        may be loaded, saved or returned by a single bulk command. Defaults
+        to ``100``.
+        - ``save_bunch_size``: The number of contacts saved concurrently
+        by ``contacts.save_many``. Defaults to ``10``.
+        - ``max_search_keys``: The maximum number of contacts a
+        ``contacts.search_keys`` query may match. Defaults to ``1000``.
     """
 
+    MAX_BULK_SIZE = 100
+    SAVE_BUNCH_SIZE = 10
+    MAX_SEARCH_KEYS = 1000
+
+    def setup(self):
+        super(ContactsResource, self).setup()
+        self.max_bulk_size = self.config.get(
+            'max_bulk_size', self.MAX_BULK_SIZE)
+        self.save_bunch_size = self.config.get(
+            'save_bunch_size', self.SAVE_BUNCH_SIZE)
+        self.max_search_keys = self.config.get(
+            'max_search_keys', self.MAX_SEARCH_KEYS)
+
     def _contact_store_for_api(self, api):
         return self.app_worker.user_api_for_api(api).contact_store
 
@@ -68,8 +90,9 @@ class ContactsResource(SandboxResource):
                     'dob': null,
                     'groups': ['group-a', 'group-b'],
                     'facebook_id': null,
-                    '$VERSION': null,
+                    '$VERSION': 1,
                     'twitter_handle': null,
+                    'surname_initial': 'p',
                     'email_address': null,
                     'name': 'A Random'
                 }
@@ -372,31 +395,258 @@ class ContactsResource(SandboxResource):
                     "name-value pairs")
 
             fields = command['contact']
-            if not isinstance(fields.get('key'), unicode):
+            self._parse_contact_key(fields, "'contact'")
+            contact_store = self._contact_store_for_api(api)
+
+            # raise an exception if the contact does not exist
+            yield contact_store.get_contact_by_key(fields['key'])
+
+            contact = self._contact_from_fields(contact_store, fields)
+            yield contact.save()
+        except (SandboxError, ContactError) as e:
+            log.warning(str(e))
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+
+        returnValue(self.reply(
+            command,
+            success=True,
+            contact=contact.get_data()))
+
+    def _parse_contact_key(self, fields, name):
+        if not isinstance(fields.get('key'), unicode):
+            raise SandboxError(
+                "'key' needs to be specified as a field in %s and be a "
+                "unicode string" % (name,))
+
+    def _contact_from_fields(self, contact_store, fields):
+        # These are foreign keys.
+        groups = fields.pop('groups', [])
+
+        key = fields.pop('key')
+        contact = contact_store.contacts(
+            key,
+            user_account=contact_store.user_account_key,
+            **ContactStore.settable_contact_fields(**fields))
+
+        # since we are basically creating a 'new' contact with the same
+        # key, we can be sure that the old groups were removed
+        for group in groups:
+            contact.add_to_group(group)
+        return contact
+
+    def _parse_bulk(self, command, name, item_type, item_description):
+        items = command.get(name)
+        if (not isinstance(items, list)
+                or not all(isinstance(item, item_type) for item in items)):
+            raise SandboxError(
+                "'%s' needs to be specified and be a list of %s"
+                % (name, item_description))
+        if len(items) > self.max_bulk_size:
+            raise SandboxError(
+                "'%s' may contain at most %s items"
+                % (name, self.max_bulk_size))
+        return items
+
+    def _load_contacts(self, contact_store, keys):
+        """
+        Load the contacts for `keys`, fetching all the bunches at once.
+        Contacts that don't exist are left out.
+        """
+        d = gatherResults(list(contact_store.contacts.load_all_bunches(keys)))
+        d.addCallback(
+            lambda bunches: dict((contact.key, contact)
+                                 for bunch in bunches for contact in bunch))
+        return d
+
+    @inlineCallbacks
+    def handle_get_many(self, api, command):
+        """
+        Accepts a list of contact keys and returns the data for each of the
+        contacts that exist.
+
+        Command fields:
+            - ``keys``: A list of contact keys. At most ``max_bulk_size``
+            keys may be requested at once.
+
+        Success reply fields:
+            - ``success``: set to ``true``
+            - ``contacts``: A list of objects containing the contacts'
+            data, in the same order as ``keys``.
+            - ``missing``: A list of the keys for which no contact was found.
+
+        Failure reply fields:
+            - ``success``: set to ``false``
+            - ``reason``: Reason for the failure
+
+        Example:
+        .. code-block:: javascript
+            api.request(
+                'contacts.get_many',
+                {keys: ['f953710a2472447591bd59e906dc2c26',
+                        'b2d6f2b3d8e44a1f8c1c7c62e5d2ce4d']},
+                function(reply) { api.log_info(reply.contacts.length); });
+        """
+        try:
+            keys = self._parse_bulk(
+                command, 'keys', unicode, 'unicode strings')
+            contact_store = self._contact_store_for_api(api)
+            contacts = yield self._load_contacts(contact_store, keys)
+        except (SandboxError, ContactError) as e:
+            log.warning(str(e))
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+
+        returnValue(self.reply(
+            command,
+            success=True,
+            contacts=[contacts[key].get_data()
+                      for key in keys if key in contacts],
+            missing=[key for key in keys if key not in contacts]))
+
+    @inlineCallbacks
+    def handle_search_keys(self, api, command):
+        """
+        Search for contacts and return a page of the matching contacts'
+        keys.
+
+        Riak search can't return a page of results, so each page runs the
+        whole search. Queries may therefore match at most
+        ``max_search_keys`` contacts, and queries matching more fail.
+
+        Command fields:
+            - ``query``: The Lucene search query to perform.
+            - ``start``: The index of the first key to return. Defaults to
+            ``0``.
+            - ``page_size``: The number of keys to return. Defaults to, and
+            may not be more than, ``max_bulk_size``.
+
+        Success reply fields:
+            - ``success``: set to ``true``
+            - ``keys``: A list of the matching contacts' keys.
+            - ``total``: The total number of matching contacts.
+            - ``next_start``: The ``start`` to use to fetch the next page of
+            keys, or ``null`` if this is the last page.
+
+        Failure reply fields:
+            - ``success``: set to ``false``
+            - ``reason``: Reason for the failure
+
+        Example:
+        .. code-block:: javascript
+            api.request(
+                'contacts.search_keys',
+                {query: 'surname:Jack*', start: 0, page_size: 50},
+                function(reply) { api.log_info(reply.keys); });
+        """
+        try:
+            if not isinstance(command.get('query'), unicode):
                 raise SandboxError(
-                    "'key' needs to be specified as a field in 'contact' and "
-                    "be a unicode string")
+                    "'query' needs to be specified and be a unicode string")
 
-            # These are foreign keys.
-            groups = fields.pop('groups', [])
+            start = command.get('start', 0)
+            page_size = command.get('page_size', self.max_bulk_size)
+            # bool is a subclass of int, but true and false aren't indexes.
+            if (not isinstance(start, int) or isinstance(start, bool)
+                    or start < 0):
+                raise SandboxError(
+                    "'start' needs to be a non-negative integer")
+            if (not isinstance(page_size, int)
+                    or isinstance(page_size, bool)
+                    or not 0 < page_size <= self.max_bulk_size):
+                raise SandboxError(
+                    "'page_size' needs to be an integer between 1 and %s"
+                    % (self.max_bulk_size,))
 
-            key = fields.pop('key')
             contact_store = self._contact_store_for_api(api)
+            keys = yield contact_store.contacts.raw_search(
+                command['query']).get_keys()
+            if len(keys) > self.max_search_keys:
+                raise SandboxError(
+                    "Query matched more than %s contacts, use a narrower "
+                    "query" % (self.max_search_keys,))
+        except (SandboxError,) as e:
+            log.warning(str(e))
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        except (Exception,) as e:
+            # NOTE: Hello Riakasaurus, you raise horribly plain exceptions on
+            #       a MapReduce error.
+            if 'MapReduce' not in str(e):
+                raise
+            log.warning(str(e))
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
 
-            # raise an exception if the contact does not exist
-            yield contact_store.get_contact_by_key(key)
+        # Search results aren't ordered, so we sort them to keep the pages
+        # stable between requests.
+        keys = sorted(keys)
+        next_start = start + page_size
+        returnValue(self.reply(
+            command,
+            success=True,
+            keys=keys[start:next_start],
+            total=len(keys),
+            next_start=next_start if next_start < len(keys) else None))
 
-            contact = contact_store.contacts(
-                key,
-                user_account=contact_store.user_account_key,
-                **ContactStore.settable_contact_fields(**fields))
+    @inlineCallbacks
+    def handle_save_many(self, api, command):
+        """
+        Saves the data for multiple contacts, overwriting each contact's
+        previous data. Like :method:`handle_save`, this only works for
+        existing contacts. If any of the contacts don't exist, none of them
+        are saved.
 
-            # since we are basically creating a 'new' contact with the same
-            # key, we can be sure that the old groups were removed
-            for group in groups:
-                contact.add_to_group(group)
+        Contacts are saved ``save_bunch_size`` at a time.
 
-            yield contact.save()
+        Command fields:
+            - ``contacts``: A list of the contacts' data. **Note**: ``key``
+            must be a field in each contact's data in order identify the
+            contact. At most ``max_bulk_size`` contacts may be saved at once.
+
+        Success reply fields:
+            - ``success``: set to ``true``
+            - ``contacts``: A list of objects containing the contacts' data.
+
+        Failure reply fields:
+            - ``success``: set to ``false``
+            - ``reason``: Reason for the failure
+
+        Example:
+        .. code-block:: javascript
+            api.request(
+                'contacts.save_many', {
+                    contacts: [{
+                        'key': 'f953710a2472447591bd59e906dc2c26',
+                        'surname': 'Person',
+                        'msisdn': '+27831234567',
+                        'groups': ['group-a']
+                    }, {
+                        'key': 'b2d6f2b3d8e44a1f8c1c7c62e5d2ce4d',
+                        'surname': 'Other',
+                        'msisdn': '+27831234568',
+                        'groups': []
+                    }]
+                },
+                function(reply) { api.log_info(reply.success); });
+        """
+        try:
+            fields_list = self._parse_bulk(
+                command, 'contacts', dict, 'dicts of field name-value pairs')
+            for fields in fields_list:
+                self._parse_contact_key(fields, "each of 'contacts'")
+
+            contact_store = self._contact_store_for_api(api)
+            keys = [fields['key'] for fields in fields_list]
+            existing = yield self._load_contacts(contact_store, keys)
+            missing = [key for key in keys if key not in existing]
+            if missing:
+                raise ContactNotFoundError(
+                    "Contacts with keys %s not found."
+                    % (', '.join("'%s'" % (key,) for key in missing),))
+
+            contacts = [self._contact_from_fields(contact_store, fields)
+                        for fields in fields_list]
+            for i in range(0, len(contacts), self.save_bunch_size):
+                yield gatherResults([
+                    contact.save()
+                    for contact in contacts[i:i + self.save_bunch_size]])
         except (SandboxError, ContactError) as e:
             log.warning(str(e))
             returnValue(self.reply(command, success=False, reason=unicode(e)))
@@ -404,7 +654,7 @@ class ContactsResource(SandboxResource):
         returnValue(self.reply(
             command,
             success=True,
-            contact=contact.get_data()))
+            contacts=[contact.get_data() for contact in contacts]))
 
 
 class GroupsResource(SandboxResource):
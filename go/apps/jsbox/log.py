@@ -4,9 +4,12 @@
 import logging
 import datetime
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, gatherResults)
 
 from vumi import log
+from vumi.blinkenlights.metrics import SUM
 from vumi.application.sandbox import LoggingResource
 from vumi.persist.redis_base import Manager
 from vumi.persist.txredis_manager import TxRedisManager
@@ -35,10 +38,13 @@ class LogManager(object):
     def _conv_key(self, campaign_key, conversation_key):
         return ":".join([campaign_key, conversation_key])
 
+    def _format_msg(self, msg, level):
+        ts = datetime.datetime.utcnow().isoformat()
+        return "[%s, %s] %s" % (ts, logging.getLevelName(level), msg)
+
     @Manager.calls_manager
     def add_log(self, campaign_key, conversation_key, msg, level):
-        ts = datetime.datetime.utcnow().isoformat()
-        full_msg = "[%s, %s] %s" % (ts, logging.getLevelName(level), msg)
+        full_msg = self._format_msg(msg, level)
         conv_key = self._conv_key(campaign_key, conversation_key)
         yield self.redis.lpush(conv_key, full_msg)
         yield self.redis.ltrim(conv_key, 0, self.max_logs_per_conversation)
@@ -50,12 +56,142 @@ class LogManager(object):
         returnValue(msgs)
 
 
+class BufferedLogManager(LogManager):
+    """
+    Log manager that collects the logs for each conversation and writes
+    them to Redis together.
+
+    Buffered logs are written every `flush_interval` seconds, or as soon as
+    `flush_threshold` logs have been collected for a conversation. While
+    logs for a conversation are being written, more are collected, but
+    only up to `max_buffered` of them. Beyond that the oldest are dropped
+    and a warning with the number dropped is added to the conversation's
+    log when it is next written.
+
+    This is only for use with asynchronous Redis managers.
+
+    :param float flush_interval:
+        Maximum number of seconds to keep logs before writing them.
+    :param int flush_threshold:
+        Number of logs to collect for a conversation before writing them.
+    :param int max_buffered:
+        Maximum number of logs to keep for a conversation while waiting
+        to write them.
+    :param overflow_callback:
+        Optional callable called with the conversation's key and the
+        number of logs dropped when logs are dropped.
+    """
+
+    DEFAULT_FLUSH_INTERVAL = 0.5
+    DEFAULT_FLUSH_THRESHOLD = 20
+    DEFAULT_MAX_BUFFERED = 1000
+
+    clock = reactor
+
+    def __init__(self, redis, max_logs_per_conversation=None,
+                 sub_store=LogManager.DEFAULT_SUB_STORE, flush_interval=None,
+                 flush_threshold=None, max_buffered=None,
+                 overflow_callback=None):
+        super(BufferedLogManager, self).__init__(
+            redis, max_logs_per_conversation=max_logs_per_conversation,
+            sub_store=sub_store)
+        self.flush_interval = flush_interval or self.DEFAULT_FLUSH_INTERVAL
+        self.flush_threshold = flush_threshold or self.DEFAULT_FLUSH_THRESHOLD
+        self.max_buffered = max_buffered or self.DEFAULT_MAX_BUFFERED
+        self.overflow_callback = overflow_callback
+        self.buffers = {}
+        self.dropped = {}
+        self.flushing = {}
+        self._delayed_flush = None
+
+    def add_log(self, campaign_key, conversation_key, msg, level):
+        conv_key = self._conv_key(campaign_key, conversation_key)
+        buffered = self.buffers.setdefault(conv_key, [])
+        buffered.append(self._format_msg(msg, level))
+        if len(buffered) > self.max_buffered:
+            del buffered[0]
+            self.dropped[conv_key] = self.dropped.get(conv_key, 0) + 1
+            if self.overflow_callback is not None:
+                self.overflow_callback(conv_key, 1)
+        if len(buffered) >= self.flush_threshold:
+            return self.flush(conv_key)
+        self._schedule_flush()
+        return succeed(None)
+
+    def _schedule_flush(self):
+        if self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(
+                self.flush_interval, self._flush_all)
+
+    def _cancel_flush(self):
+        if self._delayed_flush is not None:
+            self._delayed_flush.cancel()
+            self._delayed_flush = None
+
+    def _flush_all(self):
+        self._delayed_flush = None
+        return self.flush_all()
+
+    def flush_all(self):
+        """
+        Write the buffered logs for all conversations.
+        """
+        return gatherResults([
+            self.flush(conv_key) for conv_key in self.buffers.keys()])
+
+    def flush(self, conv_key):
+        """
+        Write the buffered logs for a conversation, unless they are already
+        being written.
+        """
+        if conv_key in self.flushing:
+            return self.flushing[conv_key]
+        full_msgs = self.buffers.pop(conv_key, [])
+        dropped = self.dropped.pop(conv_key, 0)
+        if dropped:
+            full_msgs.insert(0, self._format_msg(
+                "%d log messages were dropped because they were logged"
+                " faster than they could be saved." % (dropped,),
+                logging.WARNING))
+        if not full_msgs:
+            return succeed(None)
+        # These are sent together rather than waiting for each reply in turn.
+        d = gatherResults(
+            [self.redis.lpush(conv_key, full_msg) for full_msg in full_msgs]
+            + [self.redis.ltrim(conv_key, 0, self.max_logs_per_conversation)])
+        self.flushing[conv_key] = d
+        d.addErrback(lambda f: log.err(f, "Error writing sandbox logs."))
+        d.addBoth(self._flushed, conv_key)
+        return d
+
+    def _flushed(self, _result, conv_key):
+        del self.flushing[conv_key]
+        # Logs added while we were writing weren't written by a timed flush
+        # that happened in the meantime, so make sure they're written soon.
+        if len(self.buffers.get(conv_key, [])) >= self.flush_threshold:
+            return self.flush(conv_key)
+        if self.buffers.get(conv_key) or self.dropped.get(conv_key):
+            self._schedule_flush()
+
+    @inlineCallbacks
+    def stop(self):
+        self._cancel_flush()
+        yield gatherResults(self.flushing.values())
+        yield self.flush_all()
+        self._cancel_flush()
+
+
 class GoLoggingResource(LoggingResource):
     """
     Resource that allows a sandbox to log messages.
 
     Messages are logged both via Twisted's logging framework and
     to a per-conversation log store in Redis.
+
+    If `flush_interval` is set in the resource's config, messages are
+    buffered and written to Redis together (see
+    :class:`BufferedLogManager`). The `flush_threshold` and
+    `max_buffered` options may also be set in that case.
     """
 
     @inlineCallbacks
@@ -65,8 +201,27 @@ class GoLoggingResource(LoggingResource):
         max_logs_per_conversation = self.config.get(
             'max_logs_per_conversation')
         redis = yield TxRedisManager.from_config(redis_config)
-        self.log_manager = LogManager(
-            redis, max_logs_per_conversation=max_logs_per_conversation)
+        flush_interval = self.config.get('flush_interval')
+        if flush_interval is None:
+            self.log_manager = LogManager(
+                redis, max_logs_per_conversation=max_logs_per_conversation)
+        else:
+            self.log_manager = BufferedLogManager(
+                redis, max_logs_per_conversation=max_logs_per_conversation,
+                flush_interval=flush_interval,
+                flush_threshold=self.config.get('flush_threshold'),
+                max_buffered=self.config.get('max_buffered'),
+                overflow_callback=self.fire_overflow_metric)
+
+    def teardown(self):
+        if isinstance(self.log_manager, BufferedLogManager):
+            return self.log_manager.stop()
+
+    def fire_overflow_metric(self, conv_key, dropped):
+        publish_metric = getattr(self.app_worker, 'publish_metric', None)
+        if publish_metric is not None:
+            publish_metric('%s.logs.dropped' % (self.app_worker.worker_name,),
+                           dropped, SUM)
 
     @inlineCallbacks
     def log(self, api, msg, level):
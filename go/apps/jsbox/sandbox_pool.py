@@ -0,0 +1,140 @@
+# -*- test-case-name: go.apps.jsbox.tests.test_sandbox_pool -*-
+
+"""Pool of sandbox processes that have been started ahead of time."""
+
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, maybeDeferred
+
+from vumi import log
+
+
+class SandboxPool(object):
+    """
+    Sandboxes that have been spawned and initialized and are waiting for a
+    message or event to process.
+
+    Each sandbox only processes a single message or event, but starting
+    Node.js and evaluating the conversation's JavaScript takes longer than
+    most apps take to handle a message. Keeping a sandbox warm for each
+    active conversation lets us skip that when the next message arrives.
+
+    Sandboxes are keyed by whatever identifies the code and configuration
+    they were initialized with, so a sandbox is never used after the code
+    it was initialized with has changed.
+
+    :param int size:
+        Number of warm sandboxes to keep for each key.
+    :param int max_per_account:
+        Maximum number of warm sandboxes to keep for an account.
+    :param float idle_timeout:
+        Number of seconds after which a sandbox that hasn't been used is
+        killed.
+    """
+
+    clock = reactor
+
+    def __init__(self, size, max_per_account, idle_timeout):
+        self.size = size
+        self.max_per_account = max_per_account
+        self.idle_timeout = idle_timeout
+        self.sandboxes = defaultdict(list)
+        self.account_counts = defaultdict(int)
+        self.accounts = {}
+        self.pending = {}
+
+    def wants(self, key, account_key):
+        """
+        Return ``True`` if we should start a sandbox for `key`.
+        """
+        if key in self.pending:
+            return False
+        return (len(self.sandboxes.get(key, [])) < self.size
+                and self.account_counts.get(account_key, 0)
+                < self.max_per_account)
+
+    def fill(self, key, account_key, warm_func, *args):
+        """
+        Start a sandbox for `key` by calling `warm_func` with `args` if we
+        need one. `warm_func` should return a deferred that fires with an
+        initialized sandbox protocol.
+        """
+        if not self.wants(key, account_key):
+            return
+        d = maybeDeferred(warm_func, *args)
+        self.pending[key] = d
+        d.addCallback(self.add, key, account_key)
+        d.addErrback(lambda f: log.err(f, "Error starting warm sandbox."))
+        d.addBoth(self._fill_done, key)
+
+    def _fill_done(self, _result, key):
+        del self.pending[key]
+
+    def add(self, protocol, key, account_key):
+        delayed_call = self.clock.callLater(
+            self.idle_timeout, self.evict, key, protocol)
+        self.sandboxes[key].append((protocol, delayed_call))
+        self.accounts[key] = account_key
+        self.account_counts[account_key] += 1
+        # A sandbox that dies while it is waiting (e.g. because it was
+        # killed for running too long) is no use to anyone.
+        done = protocol.done()
+        done.addBoth(self._sandbox_done, key, protocol)
+
+    def _sandbox_done(self, result, key, protocol):
+        self.remove(key, protocol)
+        return result
+
+    def remove(self, key, protocol):
+        entries = self.sandboxes.get(key, [])
+        for entry in entries:
+            if entry[0] is protocol:
+                break
+        else:
+            return False
+        entries.remove(entry)
+        protocol, delayed_call = entry
+        if delayed_call.active():
+            delayed_call.cancel()
+        account_key = self.accounts[key]
+        self.account_counts[account_key] -= 1
+        if not entries:
+            del self.sandboxes[key]
+            del self.accounts[key]
+        if not self.account_counts[account_key]:
+            del self.account_counts[account_key]
+        return True
+
+    def take(self, key):
+        """
+        Remove a warm sandbox for `key` from the pool and return it, or
+        return ``None`` if there isn't one.
+        """
+        entries = self.sandboxes.get(key)
+        if not entries:
+            return None
+        protocol = entries[0][0]
+        self.remove(key, protocol)
+        return protocol
+
+    def evict(self, key, protocol):
+        if self.remove(key, protocol):
+            protocol.kill()
+
+    def clear(self):
+        """
+        Kill all the sandboxes in the pool (including the ones being
+        started), returning a deferred that fires once they have ended.
+        """
+        pending = DeferredList(self.pending.values())
+
+        def kill_all(_):
+            dones = []
+            for key, entries in self.sandboxes.items():
+                for protocol, _delayed_call in list(entries):
+                    dones.append(protocol.done())
+                    self.evict(key, protocol)
+            return DeferredList(dones)
+
+        return pending.addCallback(kill_all)
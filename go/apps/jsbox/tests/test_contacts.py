@@ -489,6 +489,113 @@ class TestContactsResource(ResourceTestCaseBase, GoPersistenceMixin):
     def test_handle_save_for_nonexistent_contacts(self):
         return self.assert_bad_command('save', contact={'key': u'213123'})
 
+    @inlineCallbacks
+    def test_handle_get_many(self):
+        contact1 = yield self.new_contact(surname=u'Jackal', msisdn=u'+1')
+        contact2 = yield self.new_contact(surname=u'Robot', msisdn=u'+2')
+        reply = yield self.dispatch_command(
+            'get_many', keys=[contact2.key, u'unknown', contact1.key])
+        self.check_reply(reply, missing=[u'unknown'])
+        self.assertEqual(
+            [(c['key'], c['surname']) for c in reply['contacts']],
+            [(contact2.key, u'Robot'), (contact1.key, u'Jackal')])
+
+    @inlineCallbacks
+    def test_handle_get_many_parsing(self):
+        yield self.create_resource({'max_bulk_size': 2})
+        yield self.assert_bad_command('get_many')
+        yield self.assert_bad_command('get_many', keys=u'abc')
+        yield self.assert_bad_command('get_many', keys=[u'a', 2])
+        yield self.assert_bad_command('get_many', keys=[u'a', u'b', u'c'])
+
+    @inlineCallbacks
+    def test_handle_search_keys(self):
+        yield self.create_resource({'max_bulk_size': 2})
+        contacts = []
+        for i in range(3):
+            contacts.append((yield self.new_contact(
+                surname=u'Jackal', msisdn=u'+%s' % (i,))))
+        yield self.new_contact(surname=u'Robot', msisdn=u'+4')
+        keys = sorted(contact.key for contact in contacts)
+
+        reply = yield self.dispatch_command(
+            'search_keys', query=u'surname:Jackal')
+        self.check_reply(reply, keys=keys[:2], total=3, next_start=2)
+
+        reply = yield self.dispatch_command(
+            'search_keys', query=u'surname:Jackal', start=2, page_size=2)
+        self.check_reply(reply, keys=keys[2:], total=3, next_start=None)
+
+    @inlineCallbacks
+    def test_handle_search_keys_parsing(self):
+        yield self.create_resource({'max_bulk_size': 2})
+        yield self.assert_bad_command('search_keys')
+        yield self.assert_bad_command(
+            'search_keys', query=u'surname:Jackal', start=-1)
+        yield self.assert_bad_command(
+            'search_keys', query=u'surname:Jackal', page_size=0)
+        yield self.assert_bad_command(
+            'search_keys', query=u'surname:Jackal', page_size=3)
+        yield self.assert_bad_command(
+            'search_keys', query=u'surname:Jackal', start=True)
+        yield self.assert_bad_command(
+            'search_keys', query=u'surname:Jackal', page_size=True)
+
+    @inlineCallbacks
+    def test_handle_search_keys_too_many_matches(self):
+        yield self.create_resource({'max_search_keys': 2})
+        for i in range(3):
+            yield self.new_contact(surname=u'Jackal', msisdn=u'+%s' % (i,))
+
+        reply = yield self.dispatch_command(
+            'search_keys', query=u'surname:Jackal')
+        self.check_reply(
+            reply, success=False,
+            reason=u'Query matched more than 2 contacts, use a narrower '
+                   u'query')
+
+    @inlineCallbacks
+    def test_handle_save_many(self):
+        yield self.create_resource({'save_bunch_size': 2})
+        contacts = []
+        for i in range(3):
+            contacts.append((yield self.new_contact(
+                surname=u'Jackal', msisdn=u'+%s' % (i,), groups=[u'a'])))
+
+        reply = yield self.dispatch_command('save_many', contacts=[{
+            'key': contact.key,
+            'surname': u'Robot %s' % (i,),
+            'msisdn': contact.msisdn,
+            'groups': [u'b'],
+        } for i, contact in enumerate(contacts)])
+        self.check_reply(reply)
+        self.assertEqual(
+            [c['surname'] for c in reply['contacts']],
+            [u'Robot 0', u'Robot 1', u'Robot 2'])
+
+        for i, contact in enumerate(contacts):
+            yield self.check_contact_fields(
+                contact.key, surname=u'Robot %s' % (i,), groups=[u'b'])
+
+    @inlineCallbacks
+    def test_handle_save_many_parsing(self):
+        yield self.create_resource({'max_bulk_size': 1})
+        yield self.assert_bad_command('save_many')
+        yield self.assert_bad_command('save_many', contacts={})
+        yield self.assert_bad_command('save_many', contacts=[{}])
+        yield self.assert_bad_command(
+            'save_many', contacts=[{'key': u'a'}, {'key': u'b'}])
+
+    @inlineCallbacks
+    def test_handle_save_many_for_nonexistent_contacts(self):
+        contact = yield self.new_contact(surname=u'Jackal', msisdn=u'+1')
+        yield self.assert_bad_command('save_many', contacts=[
+            {'key': contact.key, 'surname': u'Robot'},
+            {'key': u'213123', 'surname': u'Robot'},
+        ])
+        # Nothing is saved if any of the contacts don't exist.
+        yield self.check_contact_fields(contact.key, surname=u'Jackal')
+
 
 class TestGroupsResource(ResourceTestCaseBase, GoPersistenceMixin):
     use_riak = True
@@ -8,12 +8,14 @@ import re
 from mock import Mock
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from vumi.tests.utils import LogCatcher
 from vumi.application.tests.test_sandbox import (
     ResourceTestCaseBase, DummyAppWorker)
 
-from go.apps.jsbox.log import LogManager, GoLoggingResource
+from go.apps.jsbox.log import (
+    LogManager, BufferedLogManager, GoLoggingResource)
 from go.vumitools.tests.utils import GoPersistenceMixin
 
 
@@ -97,6 +99,107 @@ class TestLogManager(TestTxLogManager):
     sync_persistence = True
 
 
+class TestBufferedLogManager(TestCase, GoPersistenceMixin, LogCheckerMixin):
+    @inlineCallbacks
+    def setUp(self):
+        super(TestBufferedLogManager, self).setUp()
+        yield self._persist_setUp()
+        self.parent_redis = yield self.get_redis_manager()
+        self.redis = self.parent_redis.sub_manager(
+            LogManager.DEFAULT_SUB_STORE)
+        self.clock = Clock()
+        self.overflows = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield super(TestBufferedLogManager, self).tearDown()
+        yield self._persist_tearDown()
+
+    def log_manager(self, **kw):
+        lm = BufferedLogManager(
+            self.parent_redis,
+            overflow_callback=lambda *args: self.overflows.append(args),
+            **kw)
+        lm.clock = self.clock
+        return lm
+
+    def get_logs(self):
+        return self.redis.lrange("campaign-1:conv-1", 0, -1)
+
+    @inlineCallbacks
+    def test_add_log_flushed_after_interval(self):
+        lm = self.log_manager(flush_interval=1)
+        yield lm.add_log("campaign-1", "conv-1", "Hello", logging.INFO)
+        yield lm.add_log("campaign-1", "conv-1", "Bye", logging.ERROR)
+        self.assertEqual((yield self.get_logs()), [])
+        yield self.clock.advance(1)
+        yield lm.stop()
+        self.check_logs((yield self.get_logs()), [
+            ("INFO", "Hello"), ("ERROR", "Bye")])
+
+    @inlineCallbacks
+    def test_add_log_flushed_at_threshold(self):
+        lm = self.log_manager(flush_threshold=3)
+        for i in range(3):
+            yield lm.add_log("campaign-1", "conv-1", "%d" % i, logging.INFO)
+        self.check_logs((yield self.get_logs()), [
+            ("INFO", "%d" % i) for i in range(3)])
+        self.assertEqual(lm.buffers, {})
+
+    @inlineCallbacks
+    def test_logs_added_while_flushing(self):
+        lm = self.log_manager(flush_interval=1, flush_threshold=2)
+        yield lm.add_log("campaign-1", "conv-1", "0", logging.INFO)
+        d = lm.add_log("campaign-1", "conv-1", "1", logging.INFO)
+        yield lm.add_log("campaign-1", "conv-1", "2", logging.INFO)
+        # The timed flush happens while the first flush is still running.
+        self.clock.advance(1)
+        yield d
+        self.check_logs((yield self.get_logs()), [
+            ("INFO", "0"), ("INFO", "1")])
+        self.clock.advance(1)
+        yield lm.flushing.get("campaign-1:conv-1")
+        self.check_logs((yield self.get_logs()), [
+            ("INFO", "0"), ("INFO", "1"), ("INFO", "2")])
+        yield lm.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_add_log_trims_like_unbuffered(self):
+        lm = self.log_manager(max_logs_per_conversation=10)
+        unbuffered_lm = LogManager(self.parent_redis, 10)
+        for i in range(15):
+            yield lm.add_log("campaign-1", "conv-1", "%d" % i, logging.INFO)
+            yield unbuffered_lm.add_log(
+                "campaign-1", "conv-2", "%d" % i, logging.INFO)
+        yield lm.stop()
+        logs = yield self.get_logs()
+        unbuffered_logs = yield self.redis.lrange("campaign-1:conv-2", 0, -1)
+        self.assertEqual([line.split("] ")[1] for line in logs],
+                         [line.split("] ")[1] for line in unbuffered_logs])
+
+    @inlineCallbacks
+    def test_overflow(self):
+        lm = self.log_manager(flush_threshold=10, max_buffered=2)
+        for i in range(4):
+            yield lm.add_log("campaign-1", "conv-1", "%d" % i, logging.INFO)
+        self.assertEqual(self.overflows, [
+            ("campaign-1:conv-1", 1), ("campaign-1:conv-1", 1)])
+        yield lm.stop()
+        self.check_logs((yield self.get_logs()), [
+            ("WARNING", "2 log messages were dropped because they were"
+             " logged faster than they could be saved."),
+            ("INFO", "2"), ("INFO", "3")])
+
+    @inlineCallbacks
+    def test_stop(self):
+        lm = self.log_manager()
+        yield lm.add_log("campaign-1", "conv-1", "Hello", logging.INFO)
+        yield lm.stop()
+        self.check_logs((yield self.get_logs()), [("INFO", "Hello")])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 class StubbedAppWorker(DummyAppWorker):
     def __init__(self):
         super(StubbedAppWorker, self).__init__()
@@ -165,3 +268,22 @@ class TestGoLoggingResource(ResourceTestCaseBase, GoPersistenceMixin,
     def test_handle_info_failure(self):
         yield self.assert_bad_command(
             'info', u'Value expected for msg')
+
+    @inlineCallbacks
+    def test_handle_info_buffered(self):
+        yield self.create_resource({
+            'redis_manager': {
+                'FAKE_REDIS': self.parent_redis,
+                'key_prefix': self.parent_redis.get_key_prefix(),
+            },
+            'flush_interval': 10,
+        })
+        reply = yield self.dispatch_command('info', msg=u'Info message')
+        self.check_reply(reply)
+        self.assertEqual(
+            (yield self.redis.lrange("campaign-1:conv-1", 0, -1)), [])
+        yield self.resource.log_manager.flush_all()
+        logs = yield self.redis.lrange("campaign-1:conv-1", 0, -1)
+        self.check_logs(logs, [
+            ("INFO", "Info message")
+        ])
@@ -0,0 +1,110 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go.apps.jsbox.sandbox_pool import SandboxPool
+
+
+class DummySandboxProtocol(object):
+    def __init__(self):
+        self.killed = False
+        self._dones = []
+
+    def done(self):
+        d = Deferred()
+        self._dones.append(d)
+        return d
+
+    def kill(self):
+        self.killed = True
+        self.end()
+
+    def end(self):
+        dones, self._dones = self._dones, []
+        for d in dones:
+            d.callback(0)
+
+
+class SandboxPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = self.mk_pool()
+        self.protocols = []
+
+    def mk_pool(self, size=1, max_per_account=2, idle_timeout=30):
+        pool = SandboxPool(size, max_per_account, idle_timeout)
+        pool.clock = self.clock
+        return pool
+
+    def warm(self):
+        protocol = DummySandboxProtocol()
+        self.protocols.append(protocol)
+        return succeed(protocol)
+
+    def test_fill_and_take(self):
+        self.assertEqual(self.pool.take('key'), None)
+        self.pool.fill('key', 'account', self.warm)
+        self.pool.fill('key', 'account', self.warm)
+        [protocol] = self.protocols
+        self.assertEqual(self.pool.take('key'), protocol)
+        self.assertEqual(self.pool.take('key'), None)
+        self.assertFalse(protocol.killed)
+        self.assertEqual(self.pool.sandboxes, {})
+        self.assertEqual(self.pool.account_counts, {})
+
+    def test_fill_while_pending(self):
+        d = Deferred()
+        self.pool.fill('key', 'account', lambda: d)
+        self.pool.fill('key', 'account', self.warm)
+        self.assertEqual(self.protocols, [])
+        protocol = DummySandboxProtocol()
+        d.callback(protocol)
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(self.pool.take('key'), protocol)
+
+    def test_fill_error(self):
+        self.pool.fill('key', 'account', lambda: 1 / 0)
+        [failure] = self.flushLoggedErrors(ZeroDivisionError)
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(self.pool.take('key'), None)
+
+    def test_max_per_account(self):
+        for key in ['key1', 'key2', 'key3']:
+            self.pool.fill(key, 'account', self.warm)
+        self.pool.fill('key4', 'other', self.warm)
+        self.assertEqual(len(self.protocols), 3)
+        self.assertEqual(self.pool.take('key3'), None)
+        self.pool.take('key1')
+        self.pool.fill('key3', 'account', self.warm)
+        self.assertEqual(self.pool.take('key3'), self.protocols[-1])
+
+    def test_idle_eviction(self):
+        self.pool.fill('key', 'account', self.warm)
+        [protocol] = self.protocols
+        self.clock.advance(29)
+        self.assertFalse(protocol.killed)
+        self.clock.advance(1)
+        self.assertTrue(protocol.killed)
+        self.assertEqual(self.pool.take('key'), None)
+        self.assertEqual(self.pool.account_counts, {})
+
+    def test_sandbox_ended_while_waiting(self):
+        self.pool.fill('key', 'account', self.warm)
+        [protocol] = self.protocols
+        protocol.end()
+        self.assertEqual(self.pool.take('key'), None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_clear(self):
+        d = Deferred()
+        self.pool.fill('key1', 'account', self.warm)
+        self.pool.fill('key2', 'account', lambda: d)
+        cleared = self.pool.clear()
+        self.assertFalse(cleared.called)
+        protocol = DummySandboxProtocol()
+        d.callback(protocol)
+        self.assertTrue(cleared.called)
+        self.assertTrue(self.protocols[0].killed)
+        self.assertTrue(protocol.killed)
+        self.assertEqual(self.pool.sandboxes, {})
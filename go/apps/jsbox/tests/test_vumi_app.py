@@ -111,6 +111,70 @@ class JsBoxApplicationTestCase(AppWorkerTestCase):
         msg = self.mkmsg_in()
         yield self.dispatch_to_conv(msg, conversation)
 
+    @inlineCallbacks
+    def test_user_message_warm_sandbox(self):
+        conversation = yield self.setup_conversation(
+            config=self.mk_conv_config('on_inbound_message'))
+        yield self.start_conversation(conversation)
+        self.app.sandbox_pool.size = 1
+        msg = self.mkmsg_in()
+        conversation.set_go_helper_metadata(msg['helper_metadata'])
+        config = yield self.app.get_config(msg)
+        key = self.app.sandbox_pool_key(config)
+
+        yield self.dispatch_to_conv(msg, conversation)
+        # A sandbox is started for the next message.
+        yield self.app.sandbox_pool.pending.get(key)
+        self.assertEqual(len(self.app.sandbox_pool.sandboxes[key]), 1)
+
+        yield self.dispatch_to_conv(self.mkmsg_in(), conversation)
+        hits = self.app.metrics[
+            '%s.sandbox_pool.hits' % (self.app.worker_name,)]
+        self.assertEqual([v for _, v in hits.poll()], [1])
+
+    @inlineCallbacks
+    def test_warm_sandbox_uses_message_config(self):
+        conversation = yield self.setup_conversation(
+            config=self.mk_conv_config('on_inbound_message'))
+        yield self.start_conversation(conversation)
+        self.app.sandbox_pool.size = 1
+        msg = self.mkmsg_in()
+        conversation.set_go_helper_metadata(msg['helper_metadata'])
+        config = yield self.app.get_config(msg)
+        key = self.app.sandbox_pool_key(config)
+        self.app.sandbox_pool.fill(
+            key, config.sandbox_id, self.app.warm_sandbox, config)
+        yield self.app.sandbox_pool.pending.get(key)
+
+        msg = self.mkmsg_in()
+        conversation.set_go_helper_metadata(msg['helper_metadata'])
+        msg_config = yield self.app.get_config(msg)
+        protocol = self.app.sandbox_protocol_for_message(msg, msg_config)
+        self.assertTrue(protocol.warm)
+        self.assertTrue(protocol.api.config is msg_config)
+        protocol.kill()
+        yield protocol.done()
+
+    @inlineCallbacks
+    def test_sandbox_pool_disabled_by_default(self):
+        conversation = yield self.setup_conversation(
+            config=self.mk_conv_config('on_inbound_message'))
+        yield self.start_conversation(conversation)
+        yield self.dispatch_to_conv(self.mkmsg_in(), conversation)
+        self.assertEqual(self.app.sandbox_pool.pending, {})
+        self.assertEqual(dict(self.app.sandbox_pool.sandboxes), {})
+
+    @inlineCallbacks
+    def test_sandbox_pool_key(self):
+        conversation = yield self.setup_conversation(
+            config=self.mk_conv_config('on_inbound_message'), started=True)
+        config = self.app.get_config_for_conversation(conversation)
+        key = self.app.sandbox_pool_key(config)
+        self.assertEqual(key[0], conversation.key)
+        conversation.config['jsbox']['javascript'] += '\n'
+        config = self.app.get_config_for_conversation(conversation)
+        self.assertNotEqual(self.app.sandbox_pool_key(config), key)
+
     @inlineCallbacks
     def test_user_message_sandbox_id(self):
         conversation = yield self.setup_conversation(
@@ -3,13 +3,19 @@
 
 """Vumi application worker for the vumitools API."""
 
-from twisted.internet.defer import inlineCallbacks
+import json
+import time
+import hashlib
 
-from vumi.config import ConfigDict
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from vumi.config import ConfigDict, ConfigInt, ConfigFloat
 from vumi.application.sandbox import JsSandbox, SandboxResource
+from vumi.blinkenlights.metrics import SUM, AVG
 from vumi import log
 
 from go.vumitools.app_worker import GoApplicationMixin, GoWorkerConfigMixin
+from go.apps.jsbox.sandbox_pool import SandboxPool
 
 
 class ConversationConfigResource(SandboxResource):
@@ -31,6 +37,19 @@ class JsBoxConfig(JsSandbox.CONFIG_CLASS, GoWorkerConfigMixin):
         "Custom configuration passed to the javascript code.", default={})
     jsbox = ConfigDict(
         "Must have 'javascript' field containing JavaScript code to run.")
+    sandbox_pool_size = ConfigInt(
+        "Number of sandboxes to start ahead of time for each conversation."
+        " Defaults to zero, which starts a sandbox when each message"
+        " arrives.",
+        default=0, static=True)
+    sandbox_pool_max_per_account = ConfigInt(
+        "Maximum number of sandboxes to start ahead of time for each"
+        " account.",
+        default=10, static=True)
+    sandbox_pool_idle_timeout = ConfigFloat(
+        "Number of seconds to keep a sandbox that was started ahead of time"
+        " for. This should be less than `timeout`.",
+        default=30, static=True)
 
     @property
     def javascript(self):
@@ -67,12 +86,107 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
     def setup_application(self):
         yield super(JsBoxApplication, self).setup_application()
         yield self._go_setup_worker()
+        config = self.get_static_config()
+        self.sandbox_pool = SandboxPool(
+            config.sandbox_pool_size, config.sandbox_pool_max_per_account,
+            config.sandbox_pool_idle_timeout)
 
     @inlineCallbacks
     def teardown_application(self):
+        yield self.sandbox_pool.clear()
         yield super(JsBoxApplication, self).teardown_application()
         yield self._go_teardown_worker()
 
+    def sandbox_pool_key(self, config):
+        """
+        Return the key for the sandboxes in the pool that may be used to
+        process messages with `config`.
+
+        Sandboxes are initialized with the JavaScript and may read the
+        conversation's config before they receive a message, so both are
+        included.
+        """
+        conversation = config.get_conversation()
+        code_hash = hashlib.md5(json.dumps(
+            [config.javascript, conversation.config], sort_keys=True))
+        return (conversation.key, code_hash.hexdigest())
+
+    def publish_sandbox_metric(self, name, value, agg):
+        self.publish_metric(
+            '%s.%s' % (self.worker_name, name), value, agg)
+
+    def spawn_sandbox(self, sandbox_protocol):
+        """
+        Spawn the sandbox process and initialize the sandbox API, returning
+        a deferred that fires with the protocol once that is done.
+        """
+        start = time.time()
+        sandbox_protocol.spawn()
+
+        def on_start(_result):
+            self.publish_sandbox_metric(
+                'sandbox.spawn_time', time.time() - start, AVG)
+            sandbox_protocol.api.sandbox_init()
+            return sandbox_protocol
+
+        d = sandbox_protocol.started()
+        d.addCallback(on_start)
+        return d
+
+    def warm_sandbox(self, config):
+        api = self.create_sandbox_api(self.resources, config)
+        return self.spawn_sandbox(self.create_sandbox_protocol(api))
+
+    def sandbox_protocol_for_message(self, msg_or_event, config):
+        key = self.sandbox_pool_key(config)
+        sandbox_protocol = self.sandbox_pool.take(key)
+        while (sandbox_protocol is not None
+               and not sandbox_protocol.timeout_task.active()):
+            # This one has been killed for running too long but hasn't
+            # finished ending yet.
+            sandbox_protocol = self.sandbox_pool.take(key)
+        if sandbox_protocol is None:
+            self.publish_sandbox_metric('sandbox_pool.misses', 1, SUM)
+            sandbox_protocol = super(
+                JsBoxApplication, self).sandbox_protocol_for_message(
+                    msg_or_event, config)
+        else:
+            self.publish_sandbox_metric('sandbox_pool.hits', 1, SUM)
+            sandbox_protocol.warm = True
+            # The sandbox was started with the config for an earlier
+            # message, so give its resources the config for this one.
+            sandbox_protocol.api.config = config
+            # The sandbox's time limit shouldn't include the time it spent
+            # waiting in the pool.
+            sandbox_protocol.timeout_task.reset(config.timeout)
+        # Get a sandbox ready for the next message while we process this one.
+        self.sandbox_pool.fill(
+            key, config.sandbox_id, self.warm_sandbox, config)
+        return sandbox_protocol
+
+    def _process_in_sandbox(self, sandbox_protocol, api_callback):
+        if getattr(sandbox_protocol, 'warm', False):
+            d = succeed(sandbox_protocol)
+        else:
+            d = self.spawn_sandbox(sandbox_protocol)
+
+        def on_start(_result):
+            api_callback()
+            d = sandbox_protocol.done()
+            d.addErrback(log.error)
+            return d
+
+        d.addCallbacks(on_start, log.error)
+        return d
+
+    @inlineCallbacks
+    def _timed_in_sandbox(self, process_func, msg_or_event):
+        start = time.time()
+        status = yield process_func(msg_or_event)
+        self.publish_sandbox_metric(
+            'sandbox.latency', time.time() - start, AVG)
+        returnValue(status)
+
     def conversation_for_api(self, api):
         return api.config.get_conversation()
 
@@ -97,7 +211,12 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
         # message once we have message address types
         metadata = msg['helper_metadata']
         metadata['delivery_class'] = self.infer_delivery_class(msg)
-        return super(JsBoxApplication, self).process_message_in_sandbox(msg)
+        return self._timed_in_sandbox(
+            super(JsBoxApplication, self).process_message_in_sandbox, msg)
+
+    def process_event_in_sandbox(self, event):
+        return self._timed_in_sandbox(
+            super(JsBoxApplication, self).process_event_in_sandbox, event)
 
     def process_command_start(self, user_account_key, conversation_key):
         log.info("Starting javascript sandbox conversation (key: %r)." %
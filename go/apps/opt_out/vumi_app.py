@@ -25,7 +25,8 @@ class OptOutApplication(GoApplicationWorker):
             return
 
         account_key = yield msg_mdh.get_account_key()
-        opt_out_store = OptOutStore(self.manager, account_key)
+        opt_out_store = OptOutStore(
+            self.manager, account_key, self.vumi_api.optout_redis)
         from_addr = message.get("from_addr")
         # Note: for now we are hardcoding addr_type as 'msisdn'
         # as only msisdn's are opting out currently
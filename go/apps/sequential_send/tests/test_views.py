@@ -97,3 +97,24 @@ class SequentialSendTestCase(DjangoGoApplicationTestCase):
                 u'recurring': u'daily',
                 u'days': u'',
                 u'time': u'12:00:00'}})
+
+    def test_edit_running_conversation_reschedules(self):
+        self.setup_conversation(started=True)
+        response = self.client.post(self.get_view_url('edit'), {
+            'schedule-recurring': ['daily'],
+            'schedule-days': [''],
+            'schedule-time': ['12:00:00'],
+            'messages-TOTAL_FORMS': ['1'],
+            'messages-INITIAL_FORMS': ['0'],
+            'messages-MAX_NUM_FORMS': [''],
+            'messages-0-message': [''],
+            'messages-0-DELETE': [''],
+        })
+        self.assertRedirects(response, self.get_view_url('show'))
+        conversation = self.get_wrapped_conv()
+        [reschedule_cmd] = self.get_api_commands_sent()
+        self.assertEqual(reschedule_cmd, VumiApiCommand.command(
+                '%s_application' % (conversation.conversation_type,),
+                'reschedule',
+                user_account_key=conversation.user_account.key,
+                conversation_key=conversation.key))
@@ -1,5 +1,6 @@
 """Tests for go.apps.sequential_send.vumi_app"""
 
+import json
 import uuid
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -93,19 +94,31 @@ class TestSequentialSendApplication(AppWorkerTestCase):
         redis manager for the same reason.
         """
 
-        # Avoid hitting Riak for the conversation and Redis for poll times.
-        expected = [[conv.user_account.key, conv.key] for conv in convs]
+        # Avoid hitting Riak for the conversation and Redis for poll times
+        # and send times.
+        convs_by_pointer = dict(
+            ((conv.user_account.key, conv.key), conv) for conv in convs)
         poll_times = [(yield self.app._get_last_poll_time())]
         scheduled_conversations = yield self.app._get_scheduled_conversations()
+        schedule = dict((yield self.app.redis.zrange(
+            self.app.SCHEDULE_KEY, 0, -1, withscores=True)))
+        self.schedule = schedule
 
         def get_conversations(conv_pointers):
-            self.assertEqual(sorted(conv_pointers), sorted(expected))
-            return list(convs)
+            return [convs_by_pointer[tuple(pointer)]
+                    for pointer in conv_pointers]
         self.app.get_conversations = get_conversations
 
         self.app._get_last_poll_time = lambda: poll_times[-1]
         self.app._set_last_poll_time = lambda t: poll_times.append(str(t))
         self.app._get_scheduled_conversations = lambda: scheduled_conversations
+        self.app._get_next_send_time = schedule.get
+        self.app._set_next_send_time = schedule.__setitem__
+        self.app._remove_next_send_time = (
+            lambda conv_json: schedule.pop(conv_json, None) is not None)
+        self.app._get_due_conversations = lambda now: sorted(
+            [(conv_json, due) for conv_json, due in schedule.iteritems()
+             if due <= now], key=lambda (conv_json, due): due)
 
         self.message_convs = []
 
@@ -203,6 +216,147 @@ class TestSequentialSendApplication(AppWorkerTestCase):
         yield self.check_message_convs_and_advance([conv1, conv2, conv1], 70)
         self.assertEqual(self.message_convs, [conv1, conv2, conv1, conv2])
 
+    @inlineCallbacks
+    def test_schedule_start_stop(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        conv_json = json.dumps([self.user_account.key, conv.key])
+        self.assertEqual(
+            (yield self.app._get_next_send_time(conv_json)), 100)
+
+        yield self.app._set_contact_progress(conv, u'contact-1', 1)
+        yield self.stop_conversation(conv)
+        self.assertEqual(
+            (yield self.app._get_next_send_time(conv_json)), None)
+
+    @inlineCallbacks
+    def test_archive_clears_progress(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        yield self.app._set_contact_progress(conv, u'contact-1', 1)
+        yield self.stop_conversation(conv)
+        self.assertEqual((yield self.app._get_sequence_progress(conv)),
+                         {u'contact-1': u'1'})
+
+        yield self.dispatch_command(
+            'archive', user_account_key=self.user_account.key,
+            conversation_key=conv.key)
+        self.assertEqual((yield self.app._get_sequence_progress(conv)), {})
+
+    @inlineCallbacks
+    def test_schedule_catch_up(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        conv = yield self.user_api.get_wrapped_conversation(conv.key)
+
+        yield self._stub_out_async(conv)
+
+        lag_metric = '%s.schedule.lag' % (self.app.worker_name,)
+
+        # Pretend we were down for a few days. The missed sends only happen
+        # once and we carry on with the schedule from there.
+        self.clock.advance(3600 * 24 * 3 + 50)
+        self.assertEqual(
+            self.poll_metrics()[lag_metric], [3600 * 24 * 3 + 50 - 100])
+        yield self.check_message_convs_and_advance([conv], 60)
+        yield self.check_message_convs_and_advance([conv], 60)
+        self.assertEqual(self.message_convs, [conv, conv])
+        self.assertEqual(self.schedule.values(), [3600 * 24 * 4 + 100])
+        self.assertEqual(self.poll_metrics()[lag_metric], [20])
+
+    @inlineCallbacks
+    def test_schedule_load_failure(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        conv = yield self.user_api.get_wrapped_conversation(conv.key)
+
+        yield self._stub_out_async(conv)
+        get_conversations = self.app.get_conversations
+
+        def broken_get_conversations(conv_pointers):
+            raise Exception("Failed to load conversations.")
+        self.app.get_conversations = broken_get_conversations
+
+        yield self.check_message_convs_and_advance([], 70)
+        yield self.check_message_convs_and_advance([], 70)
+        # The conversation is put back with its old send time.
+        self.assertEqual(self.schedule.values(), [100])
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+
+        self.app.get_conversations = get_conversations
+        yield self.check_message_convs_and_advance([], 70)
+        self.assertEqual(self.message_convs, [conv])
+        self.assertEqual(self.schedule.values(), [3600 * 24 + 100])
+
+    @inlineCallbacks
+    def test_schedule_error(self):
+        conv1 = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv1)
+        conv1 = yield self.user_api.get_wrapped_conversation(conv1.key)
+
+        conv2 = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:50'}})
+        yield self.start_conversation(conv2)
+        conv2 = yield self.user_api.get_wrapped_conversation(conv2.key)
+
+        yield self._stub_out_async(conv1, conv2)
+        get_next_send_time = self.app.get_next_send_time
+
+        def broken_get_next_send_time(conv, since):
+            if conv.key == conv1.key:
+                raise ValueError("Bad schedule.")
+            return get_next_send_time(conv, since)
+        self.app.get_next_send_time = broken_get_next_send_time
+
+        yield self.check_message_convs_and_advance([], 70)
+        yield self.check_message_convs_and_advance([], 70)
+        # Nothing is sent for the conversation we can't work out the next
+        # send time for, and it is retried on the next poll.
+        self.assertEqual(self.message_convs, [conv2])
+        conv1_json = json.dumps([self.user_account.key, conv1.key])
+        conv2_json = json.dumps([self.user_account.key, conv2.key])
+        self.assertEqual(self.schedule, {
+            conv1_json: 100, conv2_json: 3600 * 24 + 110})
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_reschedule(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        conv_json = json.dumps([self.user_account.key, conv.key])
+        self.assertEqual(
+            (yield self.app._get_next_send_time(conv_json)), 100)
+
+        conv = yield self.user_api.get_wrapped_conversation(conv.key)
+        conv.set_config({
+            'schedule': {'recurring': 'daily', 'time': '00:03:20'}})
+        yield conv.save()
+        yield self.dispatch_command(
+            'reschedule', user_account_key=self.user_account.key,
+            conversation_key=conv.key)
+        self.assertEqual(
+            (yield self.app._get_next_send_time(conv_json)), 200)
+
+    @inlineCallbacks
+    def test_schedule_unscheduled_conversations(self):
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+        yield self.start_conversation(conv)
+        conv_json = json.dumps([self.user_account.key, conv.key])
+        # Conversations started before we kept track of send times are
+        # only in the set of scheduled conversations.
+        yield self.app._remove_next_send_time(conv_json)
+
+        yield self.app.schedule_unscheduled_conversations(0)
+        self.assertEqual(
+            (yield self.app._get_next_send_time(conv_json)), 100)
+
     @inlineCallbacks
     def test_get_conversations(self):
         """Test get_conversation, because we stub it out elsewhere.
@@ -279,13 +433,102 @@ class TestSequentialSendApplication(AppWorkerTestCase):
         self.assertEqual(msg3['content'], 'foo')
         self.assertEqual(msg3['to_addr'], contact3.msisdn)
 
-        # Previous two contacts are done, so we should only send to the third.
+        # Previous two contacts are done, so we should only send to the third
+        # and not even load the other two.
+        loaded_keys = []
+        get_bunches = conv.get_opted_in_contact_bunches
+
+        def get_opted_in_contact_bunches(delivery_class, contact_keys):
+            loaded_keys.extend(contact_keys)
+            return get_bunches(delivery_class, contact_keys=contact_keys)
+        conv.get_opted_in_contact_bunches = get_opted_in_contact_bunches
+
         yield self.app.send_scheduled_messages(conv)
 
         [msg] = sorted(self.get_dispatched_messages()[5:],
                        key=lambda m: m['to_addr'])
         self.assertEqual(msg['content'], 'bar')
         self.assertEqual(msg['to_addr'], contact3.msisdn)
+        self.assertEqual(loaded_keys, [contact3.key])
+        self.assertEqual((yield self.app._get_sequence_progress(conv)), {
+            contact1.key: '2',
+            contact2.key: '2',
+            contact3.key: '2',
+        })
+
+    @inlineCallbacks
+    def test_sends_with_legacy_progress(self):
+        group = yield self.create_group(u'group')
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'},
+                'messages': ['foo', 'bar'],
+                })
+        conv.add_group(group)
+        yield self.start_conversation(conv)
+        conv = yield self.user_api.get_wrapped_conversation(conv.key)
+
+        # Progress used to be stored in the contact's extras.
+        index_key = u'scheduled_message_index_%s' % (conv.key,)
+        contact1 = yield self.create_contact(name=u'First',
+            surname=u'Contact', msisdn=u'27831234567', groups=[group],
+            extra={index_key: u'1'})
+        contact2 = yield self.create_contact(name=u'Second',
+            surname=u'Contact', msisdn=u'27831234568', groups=[group],
+            extra={index_key: u'2'})
+
+        yield self.app.send_scheduled_messages(conv)
+
+        [msg] = self.get_dispatched_messages()
+        self.assertEqual(msg['content'], 'bar')
+        self.assertEqual(msg['to_addr'], contact1.msisdn)
+        self.assertEqual((yield self.app._get_sequence_progress(conv)), {
+            contact1.key: '2',
+            contact2.key: '2',
+        })
+
+    @inlineCallbacks
+    def test_sends_progress_saved_on_error(self):
+        group = yield self.create_group(u'group')
+        contact1 = yield self.create_contact(name=u'First',
+            surname=u'Contact', msisdn=u'27831234567', groups=[group])
+        contact2 = yield self.create_contact(name=u'Second',
+            surname=u'Contact', msisdn=u'27831234568', groups=[group])
+        conv = yield self.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'},
+                'messages': ['foo', 'bar'],
+                })
+        conv.add_group(group)
+        yield self.start_conversation(conv)
+        conv = yield self.user_api.get_wrapped_conversation(conv.key)
+
+        send_message = self.app.send_message
+        sent_to = []
+
+        def broken_send_message(to_addr, content, msg_options):
+            if sent_to:
+                raise ValueError("Send failed.")
+            sent_to.append(to_addr)
+            return send_message(to_addr, content, msg_options)
+        self.app.send_message = broken_send_message
+
+        yield self.assertFailure(
+            self.app.send_scheduled_messages(conv), ValueError)
+        if sent_to == [contact1.msisdn]:
+            sent_contact, other_contact = contact1, contact2
+        else:
+            sent_contact, other_contact = contact2, contact1
+        self.assertEqual((yield self.app._get_sequence_progress(conv)), {
+            sent_contact.key: '1',
+        })
+
+        # The contact we sent to before the error isn't sent to again.
+        self.app.send_message = send_message
+        yield self.app.send_scheduled_messages(conv)
+        msgs = self.get_dispatched_messages()[1:]
+        self.assertEqual(
+            sorted((m['to_addr'], m['content']) for m in msgs),
+            sorted([(sent_contact.msisdn, 'bar'),
+                    (other_contact.msisdn, 'foo')]))
 
     @inlineCallbacks
     def test_collect_metrics(self):
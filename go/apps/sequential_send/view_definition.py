@@ -36,6 +36,17 @@ class EditSequentialSendView(EditConversationView):
         ('messages', MessageFormSet),
     )
 
+    def process_forms(self, request, conversation):
+        response = super(EditSequentialSendView, self).process_forms(
+            request, conversation)
+        if response is None and conversation.running():
+            # The worker only reads the schedule when it works out the next
+            # send time, so ask it to do that again.
+            conversation.dispatch_command(
+                'reschedule', user_account_key=conversation.user_account.key,
+                conversation_key=conversation.key)
+        return response
+
 
 class ConversationViewDefinition(ConversationViewDefinitionBase):
     edit_view = EditSequentialSendView
@@ -1,6 +1,8 @@
 # -*- test-case-name: go.apps.sequential_send.tests.test_vumi_app -*-
 
 import json
+import calendar
+from datetime import datetime
 
 from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from twisted.internet.task import LoopingCall
@@ -8,6 +10,7 @@ from twisted.internet.task import LoopingCall
 from vumi import log
 from vumi.config import ConfigInt, ConfigDict, ConfigList
 from vumi.components.schedule_manager import ScheduleManager
+from vumi.blinkenlights.metrics import AVG
 
 from go.vumitools.app_worker import GoApplicationWorker
 
@@ -32,15 +35,25 @@ class SequentialSendApplication(GoApplicationWorker):
 
      * List of message copy.
 
-    The poller polls every `poll_interval` seconds and checks the schedule of
-    each conversation it's watching. Any conversations that are scheduled to
-    send between the last poll time and the current time are processed
-    accordingly.
+    When a conversation is started, the next time it is scheduled to send is
+    worked out from its schedule and stored in a Redis sorted set. The poller
+    polls every `poll_interval` seconds and only processes the conversations
+    that are due, working out the next time each of them is scheduled for
+    after it has been processed. A conversation that became due while we
+    weren't running is processed once on the first poll after we start
+    again.
+
+    The schedule is read when the next send time is worked out. When the
+    conversation is edited, the `reschedule` command works it out again so
+    that changes to the schedule take effect straight away.
     """
 
     CONFIG_CLASS = SequentialSendConfig
     worker_name = 'sequential_send_application'
 
+    SCHEDULE_KEY = 'conversation_schedule'
+    DUE_CHUNK_SIZE = 100
+
     def _setup_poller(self):
         self.poller = LoopingCall(self.poll_conversations)
         self.poller.start(self.get_static_config().poll_interval, now=False)
@@ -51,7 +64,9 @@ class SequentialSendApplication(GoApplicationWorker):
         self.redis = self.redis.sub_manager(self.worker_name)
         self._setup_poller()
         # Store the current time so we don't process stale events.
-        yield self.get_interval()
+        then, now = yield self.get_interval()
+        yield self.schedule_unscheduled_conversations(
+            now if then is None else then)
 
     @inlineCallbacks
     def teardown_application(self):
@@ -115,26 +130,173 @@ class SequentialSendApplication(GoApplicationWorker):
     def _get_scheduled_conversations(self):
         return self.redis.smembers('scheduled_conversations')
 
+    def _is_scheduled(self, conv_json):
+        return self.redis.sismember('scheduled_conversations', conv_json)
+
+    def _get_next_send_time(self, conv_json):
+        return self.redis.zscore(self.SCHEDULE_KEY, conv_json)
+
+    def _set_next_send_time(self, conv_json, timestamp):
+        return self.redis.zadd(self.SCHEDULE_KEY, **{conv_json: timestamp})
+
+    def _remove_next_send_time(self, conv_json):
+        return self.redis.zrem(self.SCHEDULE_KEY, conv_json)
+
+    def _get_due_conversations(self, now):
+        return self.redis.zrangebyscore(
+            self.SCHEDULE_KEY, '-inf', now, start=0,
+            num=self.DUE_CHUNK_SIZE, withscores=True)
+
+    def get_next_send_time(self, conv, since):
+        """
+        Return the timestamp of the first time after `since` that `conv` is
+        scheduled to send, or ``None`` if it isn't scheduled to send again.
+        """
+        schedule = self.get_config_for_conversation(conv).schedule
+        next_dt = ScheduleManager(schedule).get_next(
+            datetime.utcfromtimestamp(since))
+        if next_dt is None:
+            return None
+        return calendar.timegm(next_dt.utctimetuple())
+
+    def schedule_conversation(self, conv, since):
+        if not conv.running():
+            return
+        return self._reschedule_conversation(
+            conv, self.get_next_send_time(conv, since))
+
+    def _reschedule_conversation(self, conv, next_time):
+        conv_json = json.dumps([conv.user_account.key, conv.key])
+        if next_time is None:
+            log.info("Conversation '%s' is not scheduled to send again." % (
+                conv.key,))
+            return self._remove_next_send_time(conv_json)
+        return self._set_next_send_time(conv_json, next_time)
+
     @inlineCallbacks
-    def poll_conversations(self):
-        then, now = yield self.get_interval()
+    def schedule_unscheduled_conversations(self, since):
+        """
+        Work out the next send time for scheduled conversations that don't
+        have one (because they were started before we kept track of send
+        times, for example).
+        """
         conv_jsons = yield self._get_scheduled_conversations()
-        conversations = yield self.get_conversations(
-            [json.loads(c) for c in conv_jsons])
-        log.debug("Processing %s to %s: %s" % (
-            then, now, [c.key for c in conversations]))
+        unscheduled = []
+        for conv_json in list(conv_jsons):
+            if (yield self._get_next_send_time(conv_json)) is None:
+                unscheduled.append(json.loads(conv_json))
+        if not unscheduled:
+            return
+        conversations = yield self.get_conversations(unscheduled)
         for conv in conversations:
-            if not conv.ended():
-                yield self.process_conversation_schedule(then, now, conv)
+            if conv is not None:
+                yield self.schedule_conversation(conv, since)
 
     @inlineCallbacks
-    def process_conversation_schedule(self, then, now, conv):
-        schedule = self.get_config_for_conversation(conv).schedule
-        if ScheduleManager(schedule).is_scheduled(then, now):
+    def poll_conversations(self):
+        _then, now = yield self.get_interval()
+        while True:
+            due = yield self._get_due_conversations(now)
+            yield self.process_due_conversations(now, due)
+            if len(due) < self.DUE_CHUNK_SIZE:
+                break
+
+    @inlineCallbacks
+    def process_due_conversations(self, now, due):
+        claimed = []
+        for conv_json, due_time in due:
+            # Only the worker that manages to remove a conversation from the
+            # schedule processes it.
+            if (yield self._remove_next_send_time(conv_json)):
+                claimed.append((conv_json, due_time))
+        if not claimed:
+            return
+
+        # Conversations we claimed but don't get as far as rescheduling
+        # (because they couldn't be loaded, for example) are put back with
+        # their old send times so that they're retried on the next poll.
+        unscheduled = dict(claimed)
+        try:
+            conversations = yield self.get_conversations(
+                [json.loads(conv_json) for conv_json, _ in claimed])
+            log.debug("Processing at %s: %s" % (
+                now, [c.key for c in conversations if c is not None]))
+            for (conv_json, due_time), conv in zip(claimed, conversations):
+                try:
+                    done = yield self.process_due_conversation(
+                        now, conv_json, due_time, conv)
+                except Exception:
+                    log.err(None, "Error processing scheduled conversation"
+                            " %s." % (conv_json,))
+                    continue
+                if done:
+                    del unscheduled[conv_json]
+        except Exception:
+            log.err(None, "Error loading scheduled conversations.")
+        finally:
+            for conv_json, due_time in unscheduled.iteritems():
+                yield self._set_next_send_time(conv_json, due_time)
+
+    @inlineCallbacks
+    def process_due_conversation(self, now, conv_json, due_time, conv):
+        """
+        Send the next messages for a conversation that is due and work out
+        when it is due next. Returns ``False`` if the conversation couldn't
+        be loaded, so that it can be retried.
+        """
+        if conv is None:
+            if (yield self._is_scheduled(conv_json)):
+                log.warning("Could not load scheduled conversation %s,"
+                            " retrying on the next poll." % (conv_json,))
+                returnValue(False)
+            # It has been stopped, so it mustn't be rescheduled.
+            returnValue(True)
+        if not conv.running():
+            returnValue(True)
+        self.publish_metric(
+            '%s.schedule.lag' % (self.worker_name,), now - due_time, AVG)
+        # Work out the next send time before sending, so that a broken
+        # schedule doesn't send again on every poll.
+        next_time = self.get_next_send_time(conv, now)
+        try:
             yield self.send_scheduled_messages(conv)
+        except Exception:
+            log.err(None, "Error sending scheduled messages for"
+                    " conversation '%s'." % (conv.key,))
+        yield self._reschedule_conversation(conv, next_time)
+        returnValue(True)
+
+    def _progress_key(self, conversation_key):
+        return 'sequence_progress:%s' % (conversation_key,)
+
+    def _get_sequence_progress(self, conv):
+        return self.redis.hgetall(self._progress_key(conv.key))
+
+    def _set_contact_progress(self, conv, contact_key, message_index):
+        return self.redis.hset(
+            self._progress_key(conv.key), contact_key, message_index)
+
+    def _clear_sequence_progress(self, conversation_key):
+        return self.redis.delete(self._progress_key(conversation_key))
+
+    def _get_legacy_message_index(self, conv, contact):
+        # Progress used to be stored on the contact itself.
+        index_key = 'scheduled_message_index_%s' % (conv.key,)
+        return int(contact.extra[index_key] or '0')
 
     @inlineCallbacks
     def send_scheduled_messages(self, conv):
+        """
+        Send each of the conversation's contacts the next message in the
+        sequence.
+
+        The position of each contact in the sequence is kept in a Redis hash
+        per conversation, so contacts who have already been sent all the
+        messages aren't loaded at all. Each contact's progress is written as
+        soon as their message has been sent, but we only wait for those
+        writes (and for the bunch's outbound messages to be stored) once
+        the whole bunch has been sent.
+        """
         config = self.get_config_for_conversation(conv)
         messages = config.messages
         batch_id = conv.get_batch_keys()[0]
@@ -142,34 +304,48 @@ class SequentialSendApplication(GoApplicationWorker):
         conv.set_go_helper_metadata(
             message_options.setdefault('helper_metadata', {}))
 
-        for contacts in (yield conv.get_opted_in_contact_bunches(
-                conv.delivery_class)):
-            for contact in (yield contacts):
-                index_key = 'scheduled_message_index_%s' % (conv.key,)
-                message_index = int(contact.extra[index_key] or '0')
-                if message_index >= len(messages):
-                    # We have nothing more to send to this person.
-                    continue
-
-                to_addr = contact.addr_for(conv.delivery_class)
-                if not to_addr:
-                    log.info("No suitable address found for contact %s %r" % (
-                        contact.key, contact,))
-                    continue
-
-                yield self.send_message(
-                    batch_id, to_addr, messages[message_index],
-                    message_options)
-
-                contact.extra[index_key] = u'%s' % (message_index + 1)
-                yield contact.save()
+        progress = yield self._get_sequence_progress(conv)
+        contact_keys = [
+            key for key in (yield conv.get_contact_keys())
+            if int(progress.get(key, 0)) < len(messages)]
 
-    @inlineCallbacks
-    def send_message(self, batch_id, to_addr, content, msg_options):
-        msg = yield self.send_to(
+        for contacts in (yield conv.get_opted_in_contact_bunches(
+                conv.delivery_class, contact_keys=contact_keys)):
+            pending = []
+            try:
+                for contact in (yield contacts):
+                    if contact.key in progress:
+                        message_index = int(progress[contact.key])
+                    else:
+                        message_index = self._get_legacy_message_index(
+                            conv, contact)
+                    if message_index >= len(messages):
+                        # We have nothing more to send to this person.
+                        pending.append(self._set_contact_progress(
+                            conv, contact.key, message_index))
+                        continue
+
+                    to_addr = contact.addr_for(conv.delivery_class)
+                    if not to_addr:
+                        log.info("No suitable address found for contact"
+                                 " %s %r" % (contact.key, contact,))
+                        continue
+
+                    msg = yield self.send_message(
+                        to_addr, messages[message_index], message_options)
+                    pending.append(self._set_contact_progress(
+                        conv, contact.key, message_index + 1))
+                    pending.append(self.vumi_api.mdb.add_outbound_message(
+                        msg, batch_id=batch_id))
+            finally:
+                # Even if we fail part of the way through the bunch, the
+                # contacts we've already sent to mustn't be sent the same
+                # message again.
+                yield gatherResults(pending)
+
+    def send_message(self, to_addr, content, msg_options):
+        return self.send_to(
             to_addr, content, endpoint='default', **msg_options)
-        yield self.vumi_api.mdb.add_outbound_message(msg, batch_id=batch_id)
-        log.info('Stored outbound %s' % (msg,))
 
     @inlineCallbacks
     def process_command_start(self, user_account_key, conversation_key):
@@ -179,6 +355,23 @@ class SequentialSendApplication(GoApplicationWorker):
         log.debug("Scheduling conversation: %s" % (conversation_key,))
         yield self.redis.sadd('scheduled_conversations', json.dumps(
                 [user_account_key, conversation_key]))
+        conv = yield self.get_conversation(user_account_key, conversation_key)
+        if conv is not None:
+            yield self.schedule_conversation(conv, self.poller.clock.seconds())
+
+    @inlineCallbacks
+    def process_command_reschedule(self, user_account_key, conversation_key):
+        conv = yield self.get_conversation(user_account_key, conversation_key)
+        if conv is None or not conv.running():
+            return
+        now = self.poller.clock.seconds()
+        next_time = yield self._get_next_send_time(
+            json.dumps([user_account_key, conversation_key]))
+        if next_time is not None and float(next_time) <= now:
+            # It's already due, and will be rescheduled once it's processed.
+            return
+        log.debug("Rescheduling conversation: %s" % (conversation_key,))
+        yield self.schedule_conversation(conv, now)
 
     @inlineCallbacks
     def process_command_stop(self, user_account_key, conversation_key):
@@ -186,8 +379,17 @@ class SequentialSendApplication(GoApplicationWorker):
             user_account_key, conversation_key)
 
         log.debug("Unscheduling conversation: %s" % (conversation_key,))
-        yield self.redis.srem('scheduled_conversations', json.dumps(
-                [user_account_key, conversation_key]))
+        conv_json = json.dumps([user_account_key, conversation_key])
+        yield self.redis.srem('scheduled_conversations', conv_json)
+        yield self._remove_next_send_time(conv_json)
+
+    @inlineCallbacks
+    def process_command_archive(self, user_account_key, conversation_key):
+        yield super(SequentialSendApplication, self).process_command_archive(
+            user_account_key, conversation_key)
+        # Progress is kept while the conversation is stopped so that it
+        # carries on from where it was when it is started again.
+        yield self._clear_sequence_progress(conversation_key)
 
     @inlineCallbacks
     def collect_metrics(self, user_api, conversation_key):
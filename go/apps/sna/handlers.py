@@ -53,7 +53,8 @@ class USSDOptOutHandler(SNAEventHandler):
 
         """
         account_key = event.payload['account_key']
-        oo_store = OptOutStore(self.vumi_api.manager, account_key)
+        oo_store = OptOutStore(
+            self.vumi_api.manager, account_key, self.vumi_api.optout_redis)
 
         event_data = event.payload['content']
 
@@ -3,8 +3,10 @@
 """Tests for go.vumitools.bulk_send_application"""
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from go.vumitools.tests.utils import AppWorkerTestCase
+from go.vumitools.subscription.counters import SubscriptionCounters
 from go.apps.subscription.vumi_app import SubscriptionApplication
 
 
@@ -70,6 +72,9 @@ class TestSubscriptionApplication(AppWorkerTestCase):
 
     @inlineCallbacks
     def test_subscribe_unsubscribe(self):
+        counters = self.user_api.subscription_counters
+        yield counters.set_counts('foo', {})
+        yield counters.set_counts('bar', {})
         yield self.assert_subscription(self.contact, 'foo', None)
         yield self.assert_subscription(self.contact, 'bar', None)
 
@@ -94,6 +99,12 @@ class TestSubscriptionApplication(AppWorkerTestCase):
         yield self.assert_subscription(self.contact, 'foo', 'unsubscribed')
         yield self.assert_subscription(self.contact, 'bar', 'subscribed')
 
+        counts = yield counters.get_counts(['foo', 'bar'])
+        self.assertEqual(counts, {
+            'foo': {u'subscribed': 0, u'unsubscribed': 1},
+            'bar': {u'subscribed': 1, u'unsubscribed': 0},
+        })
+
     @inlineCallbacks
     def test_empty_message(self):
         yield self.assert_subscription(self.contact, 'foo', None)
@@ -125,3 +136,60 @@ class TestSubscriptionApplication(AppWorkerTestCase):
                 u'messages_sent': [0],
                 u'messages_received': [0],
                 }, metrics)
+
+    @inlineCallbacks
+    def test_collect_metrics_uses_counters(self):
+        yield self.user_api.subscription_counters.set_counts(
+            'foo', {u'subscribed': 5, u'unsubscribed': 2})
+        yield self.dispatch_from(self.contact, 'foo')
+        yield self.dispatch_command(
+            'collect_metrics', conversation_key=self.conv.key,
+            user_account_key=self.user_account.key)
+        metrics = self.poll_metrics('%s.%s' % (self.user_account.key,
+                                               self.conv.key))
+        self.assertEqual(metrics[u'foo.subscribed'], [6])
+        self.assertEqual(metrics[u'foo.unsubscribed'], [2])
+
+    @inlineCallbacks
+    def test_collect_metrics_reconciles_old_counts(self):
+        clock = Clock()
+        self.patch(SubscriptionCounters, 'clock', clock)
+        yield self.user_api.subscription_counters.set_counts(
+            'foo', {u'subscribed': 5, u'unsubscribed': 2})
+        clock.advance(self.app.get_static_config().reconcile_interval + 1)
+        yield self.dispatch_command(
+            'collect_metrics', conversation_key=self.conv.key,
+            user_account_key=self.user_account.key)
+        metrics = self.poll_metrics('%s.%s' % (self.user_account.key,
+                                               self.conv.key))
+        self.assertEqual(metrics[u'foo.subscribed'], [0])
+        self.assertEqual(metrics[u'foo.unsubscribed'], [0])
+
+    @inlineCallbacks
+    def test_collect_metrics_counts_existing_subscriptions(self):
+        # Subscriptions from before we started counting them.
+        yield self.set_subscription(self.contact, ['foo'], [])
+        yield self.dispatch_from(self.contact, 'stop')
+        yield self.dispatch_command(
+            'collect_metrics', conversation_key=self.conv.key,
+            user_account_key=self.user_account.key)
+        metrics = self.poll_metrics('%s.%s' % (self.user_account.key,
+                                               self.conv.key))
+        self.assertEqual(metrics[u'foo.subscribed'], [0])
+        self.assertEqual(metrics[u'foo.unsubscribed'], [1])
+
+    @inlineCallbacks
+    def test_reconcile_subscription_counters(self):
+        yield self.set_subscription(self.contact, ['foo'], ['bar'])
+        counters = self.user_api.subscription_counters
+        yield counters.set_counts('foo', {u'unsubscribed': 1})
+
+        yield self.dispatch_command(
+            'reconcile_subscription_counters',
+            conversation_key=self.conv.key,
+            user_account_key=self.user_account.key)
+        counts = yield counters.get_counts(['foo', 'bar'])
+        self.assertEqual(counts, {
+            'foo': {u'subscribed': 1, u'unsubscribed': 0},
+            'bar': {u'subscribed': 0, u'unsubscribed': 1},
+        })
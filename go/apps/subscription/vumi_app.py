@@ -4,16 +4,32 @@
 from twisted.internet.defer import inlineCallbacks
 
 from vumi import log
+from vumi.config import ConfigInt
 
 from go.vumitools.app_worker import GoApplicationWorker
+from go.vumitools.keyword_matcher import (
+    KeywordMatcherCache, model_fingerprint)
+
+
+class SubscriptionConfig(GoApplicationWorker.CONFIG_CLASS):
+    reconcile_interval = ConfigInt(
+        "Seconds after which each campaign's subscription counts are"
+        " rebuilt from Riak search when metrics are collected, to correct"
+        " any drift.",
+        default=24 * 60 * 60, static=True)
 
 
 class SubscriptionApplication(GoApplicationWorker):
     """
     Application that recognises keywords and fires events.
     """
+    CONFIG_CLASS = SubscriptionConfig
     worker_name = 'subscription_application'
 
+    def setup_application(self):
+        self.keyword_matchers = KeywordMatcherCache()
+        return super(SubscriptionApplication, self).setup_application()
+
     @inlineCallbacks
     def send_message(self, batch_id, to_addr, content, msg_options):
         # TODO: Update
@@ -23,11 +39,12 @@ class SubscriptionApplication(GoApplicationWorker):
         log.info('Stored outbound %s' % (msg,))
 
     def handlers_for_content(self, conv, content):
-        words = (content or '').strip().split() + ['']
-        keyword = words[0].lower()
-        handlers = conv.get_config().get('handlers', [])
-        return [handler for handler in handlers
-                if handler['keyword'].lower() == keyword]
+        conv_config = conv.get_config()
+        matcher = self.keyword_matchers.get_matcher(
+            conv.key, model_fingerprint(conv, conv_config),
+            lambda: [(handler['keyword'], handler)
+                     for handler in conv_config.get('handlers', [])])
+        return matcher.match(content)
 
     @inlineCallbacks
     def consume_user_message(self, message):
@@ -51,8 +68,12 @@ class SubscriptionApplication(GoApplicationWorker):
                 'subscribe': u'subscribed',
                 'unsubscribe': u'unsubscribed',
                 }[handler['operation']]
-            contact.subscription[handler['campaign_name']] = status
+            campaign_name = handler['campaign_name']
+            old_status = contact.subscription[campaign_name]
+            contact.subscription[campaign_name] = status
             yield contact.save()
+            yield user_api.subscription_counters.update(
+                campaign_name, old_status, status)
             if handler['reply_copy']:
                 yield self.reply_to(message, handler['reply_copy'])
 
@@ -62,25 +83,47 @@ class SubscriptionApplication(GoApplicationWorker):
     def consume_delivery_report(self, event):
         return self.vumi_api.mdb.add_event(event)
 
+    def campaign_names(self, conv):
+        return set(handler['campaign_name']
+                   for handler in conv.get_config().get('handlers', []))
+
     @inlineCallbacks
     def collect_metrics(self, user_api, conversation_key):
         conv = yield user_api.get_wrapped_conversation(conversation_key)
-        contact_proxy = user_api.contact_store.contacts
-
-        campaign_names = set()
-        for handler in conv.get_config().get('handlers', []):
-            campaign_names.add(handler['campaign_name'])
+        counters = user_api.subscription_counters
+        campaign_names = self.campaign_names(conv)
+        all_counts = yield counters.get_counts(
+            campaign_names,
+            max_age=self.get_static_config().reconcile_interval)
 
         for campaign_name in campaign_names:
-            self.publish_conversation_metric(
-                conv, '.'.join([campaign_name, "subscribed"]),
-                (yield contact_proxy.raw_search(
-                    "subscription-%s:subscribed" % (
-                        campaign_name,)).get_count()))
-            self.publish_conversation_metric(
-                conv, '.'.join([campaign_name, "unsubscribed"]),
-                (yield contact_proxy.raw_search(
-                    "subscription-%s:unsubscribed" % (
-                        campaign_name,)).get_count()))
+            counts = all_counts[campaign_name]
+            if counts is None:
+                # We haven't counted this campaign's subscriptions yet, or
+                # haven't done so recently.
+                counts = yield counters.reconcile(
+                    user_api.contact_store, campaign_name)
+            for status in counters.STATUSES:
+                self.publish_conversation_metric(
+                    conv, '.'.join([campaign_name, status]), counts[status])
 
         yield self.collect_message_metrics(conv)
+
+    @inlineCallbacks
+    def process_command_reconcile_subscription_counters(
+            self, conversation_key, user_account_key):
+        """
+        Rebuild the subscription counts for the conversation's campaigns
+        from Riak search.
+        """
+        user_api = self.get_user_api(user_account_key)
+        conv = yield user_api.get_wrapped_conversation(conversation_key)
+        if conv is None:
+            log.warning(
+                "Trying to reconcile subscription counters for missing"
+                " conversation '%s' for user '%s'." % (
+                    conversation_key, user_account_key))
+            return
+        for campaign_name in self.campaign_names(conv):
+            yield user_api.subscription_counters.reconcile(
+                user_api.contact_store, campaign_name)
@@ -86,4 +86,4 @@ class Command(BaseCommand):
         permission.save()
 
         account.tagpools.add(permission)
-        account.save()
+        user_api.save_account(account)
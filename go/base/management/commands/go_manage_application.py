@@ -64,7 +64,7 @@ class Command(BaseCommand):
                 if application_module in existing_applications:
                     [permission] = [p for p in all_permissions
                                     if p.application == application_module]
-                    self.disable_application(permission, account)
+                    self.disable_application(user, permission, account)
                 else:
                     raise CommandError('User does not have this permission')
 
@@ -77,9 +77,9 @@ class Command(BaseCommand):
         except User.DoesNotExist, e:
             raise CommandError(e)
 
-    def disable_application(self, app_permission, account):
+    def disable_application(self, user, app_permission, account):
         account.applications.remove(app_permission)
-        account.save()
+        vumi_api_for_user(user).save_account(account)
 
     def enable_application(self, user, account, application_module):
         user_api = vumi_api_for_user(user)
@@ -90,4 +90,4 @@ class Command(BaseCommand):
         app_permission.save()
 
         account.applications.add(app_permission)
-        account.save()
+        user_api.save_account(account)
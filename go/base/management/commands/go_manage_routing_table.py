@@ -93,13 +93,13 @@ class Command(BaseCommand):
     def handle_delete(self, user_api, options):
         account = user_api.get_user_account()
         account.routing_table = None
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table deleted.\n")
 
     def handle_clear(self, user_api, options):
         account = user_api.get_user_account()
         account.routing_table = {}
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table cleared.\n")
 
     def handle_add(self, user_api, options):
@@ -112,7 +112,7 @@ class Command(BaseCommand):
             user_api.validate_routing_table(account)
         except Exception as e:
             raise CommandError(e)
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table entry added.\n")
 
     def handle_remove(self, user_api, options):
@@ -134,7 +134,7 @@ class Command(BaseCommand):
             user_api.validate_routing_table(account)
         except Exception as e:
             raise CommandError(e)
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table entry removed.\n")
 
     def print_routing_table(self, routing_table):
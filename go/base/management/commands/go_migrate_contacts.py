@@ -0,0 +1,66 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.contrib.auth.models import User
+
+from go.base.utils import vumi_api_for_user
+
+
+class Command(BaseCommand):
+    help = """
+    Load and re-save all contacts that were stored with an older model
+    version, triggering any pending model migrators (and adding any new
+    indexes) in the process. Allows for optional searching on the username.
+
+    Usage:
+
+    ./go-admin.sh go_migrate_contacts [regex]
+
+        Migrate the contacts for all accounts, or only for accounts matching
+        the given regex.
+
+    ./go-admin.sh go_migrate_contacts --dry-run [regex]
+
+        Count the contacts that need migrating without saving them.
+    """
+
+    args = "[optional username regex]"
+    encoding = 'utf-8'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Perform a dry run only.'),
+        )
+
+    def outln(self, msg, ending='\n'):
+        self.stdout.write(msg.encode(self.encoding) + ending)
+
+    def find_accounts(self, *usernames):
+        users = User.objects.all().order_by('date_joined')
+        if usernames:
+            or_statements = [Q(username__regex=un) for un in usernames]
+            or_query = reduce(lambda x, y: x | y, or_statements)
+            users = users.filter(or_query)
+        if not users.exists():
+            self.stderr.write('No accounts found.\n')
+        return users
+
+    def handle_user(self, user, dry_run):
+        user_api = vumi_api_for_user(user)
+        contact_store = user_api.contact_store
+        contact_keys = contact_store.list_contacts()
+        migrated = 0
+        for contacts in contact_store.contacts.load_all_bunches(contact_keys):
+            for contact in contacts:
+                if not contact.was_migrated:
+                    continue
+                if not dry_run:
+                    contact.save()
+                migrated += 1
+        self.outln(u'%s %s <%s> [%s]: Migrated %d of %d contacts.' % (
+            user.first_name, user.last_name, user.username,
+            user_api.user_account_key, migrated, len(contact_keys)))
+
+    def handle(self, *usernames, **options):
+        for user in self.find_accounts(*usernames):
+            self.handle_user(user, options['dry_run'])
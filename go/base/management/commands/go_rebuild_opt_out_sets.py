@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.contrib.auth.models import User
+
+from go.base.utils import vumi_api_for_user
+
+
+class Command(BaseCommand):
+    help = """
+    Rebuild the Redis opt-out sets used to filter contacts when sending
+    messages. Allows for optional searching on the username.
+
+    Usage:
+
+    ./go-admin.sh go_rebuild_opt_out_sets [regex]
+
+        Rebuild the opt-out sets for all accounts, or only for accounts
+        matching the given regex.
+    """
+
+    args = "[optional username regex]"
+    encoding = 'utf-8'
+
+    def outln(self, msg, ending='\n'):
+        self.stdout.write(msg.encode(self.encoding) + ending)
+
+    def find_accounts(self, *usernames):
+        users = User.objects.all().order_by('date_joined')
+        if usernames:
+            or_statements = [Q(username__regex=un) for un in usernames]
+            or_query = reduce(lambda x, y: x | y, or_statements)
+            users = users.filter(or_query)
+        if not users.exists():
+            self.stderr.write('No accounts found.\n')
+        return users
+
+    def handle_user(self, user):
+        user_api = vumi_api_for_user(user)
+        count = user_api.optout_store.rebuild_opt_out_sets()
+        self.outln(u'%s %s <%s> [%s]: %d opt-outs.' % (
+            user.first_name, user.last_name, user.username,
+            user_api.user_account_key, count))
+
+    def handle(self, *usernames, **options):
+        for user in self.find_accounts(*usernames):
+            self.handle_user(user)
@@ -18,6 +18,7 @@ from go.base.utils import (
     vumi_api_for_user, get_conversation_view_definition,
     get_router_view_definition)
 from go.vumitools.api import VumiApi
+from go.vumitools.tagpool_cache import TagpoolMetadataCache
 from go.vumitools.account.models import RoutingTableHelper, GoConnector
 
 # Force YAML to return unicode strings
@@ -195,6 +196,7 @@ class Command(BaseCommand):
             self.tagpool.purge_pool(pool_name)
             self.tagpool.declare_tags([(pool_name, tag) for tag in tags])
             self.tagpool.set_metadata(pool_name, pool_data['metadata'])
+        TagpoolMetadataCache(self.tagpool).invalidate()
 
         self.stdout.write('Tag pools created: %s\n' % (
             ', '.join(sorted(pools.keys())),))
@@ -246,7 +248,7 @@ class Command(BaseCommand):
         permission.save()
 
         account.tagpools.add(permission)
-        account.save()
+        self.api.get_user_api(account.key).save_account(account)
         return permission
 
     def assign_application(self, account, application_module):
@@ -255,7 +257,7 @@ class Command(BaseCommand):
         app_permission.save()
 
         account.applications.add(app_permission)
-        account.save()
+        self.api.get_user_api(account.key).save_account(account)
         return app_permission
 
     def setup_channels(self, user, channels):
@@ -345,9 +347,10 @@ class Command(BaseCommand):
             rt.add_entry(
                 str(connectors[src]), src_ep, str(connectors[dst]), dst_ep)
 
-        user_account = vumi_api_for_user(user).get_user_account()
+        user_api = vumi_api_for_user(user)
+        user_account = user_api.get_user_account()
         user_account.routing_table = rt.routing_table
-        user_account.save()
+        user_api.save_routing_table(user_account)
 
         self.stdout.write('Routing table for %s built\n' % (user.email,))
 
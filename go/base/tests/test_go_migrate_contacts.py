@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from StringIO import StringIO
+from uuid import uuid4
+
+from go.base.tests.utils import VumiGoDjangoTestCase
+from go.base.management.commands import go_migrate_contacts
+from go.vumitools.contact.old_models import ContactVNone
+
+
+class GoMigrateContactsCommandTestCase(VumiGoDjangoTestCase):
+
+    use_riak = True
+
+    def setUp(self):
+        super(GoMigrateContactsCommandTestCase, self).setUp()
+        self.setup_api()
+        self.setup_user_api()
+
+        self.command = go_migrate_contacts.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def mk_old_contact(self, **fields):
+        contact_store = self.user_api.contact_store
+        old_contacts = contact_store.manager.proxy(ContactVNone)
+        contact = old_contacts(
+            uuid4().get_hex(), user_account=self.user_api.user_account_key,
+            msisdn=u'+27831234567', **fields)
+        contact.save()
+        return contact
+
+    def assert_output(self, migrated, total):
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Test User <username> [%s]: Migrated %d of %d contacts.\n' % (
+                self.user_api.user_account_key, migrated, total))
+
+    def test_migrate(self):
+        contact_store = self.user_api.contact_store
+        self.mk_old_contact(surname=u'Person')
+        contact_store.new_contact(surname=u'Pillay', msisdn=u'+27831234568')
+        self.assertEqual(
+            len(contact_store.contacts.index_keys('surname_initial', u'p')),
+            1)
+
+        self.command.handle(dry_run=False)
+        self.assert_output(1, 2)
+        self.assertEqual(
+            len(contact_store.contacts.index_keys('surname_initial', u'p')),
+            2)
+
+    def test_migrate_dry_run(self):
+        contact_store = self.user_api.contact_store
+        self.mk_old_contact(surname=u'Person')
+
+        self.command.handle(dry_run=True)
+        self.assert_output(1, 1)
+        self.assertEqual(
+            contact_store.contacts.index_keys('surname_initial', u'p'), [])
+
+    def test_no_matching_accounts(self):
+        self.command.handle('nobody', dry_run=False)
+        self.assertEqual(self.command.stderr.getvalue(),
+                         'No accounts found.\n')
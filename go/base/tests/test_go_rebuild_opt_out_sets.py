@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from StringIO import StringIO
+
+from go.base.tests.utils import VumiGoDjangoTestCase
+from go.base.management.commands import go_rebuild_opt_out_sets
+from go.vumitools.opt_out import OptOutStore
+
+
+class GoRebuildOptOutSetsCommandTestCase(VumiGoDjangoTestCase):
+
+    use_riak = True
+
+    def setUp(self):
+        super(GoRebuildOptOutSetsCommandTestCase, self).setUp()
+        self.setup_api()
+        self.setup_user_api()
+
+        self.command = go_rebuild_opt_out_sets.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_rebuild(self):
+        # Opt-outs stored without Redis aren't in the opt-out set yet.
+        riak_only_store = OptOutStore(
+            self.user_api.manager, self.user_api.user_account_key)
+        riak_only_store.new_opt_out('msisdn', u'+27831234567', {})
+        optout_store = self.user_api.optout_store
+        self.assertEqual(optout_store.get_opt_out_set('msisdn'), set())
+
+        self.command.handle()
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Test User <username> [%s]: 1 opt-outs.\n' % (
+                self.user_api.user_account_key,))
+        self.assertEqual(optout_store.get_opt_out_set('msisdn'),
+                         set([u'+27831234567']))
+
+    def test_no_matching_accounts(self):
+        self.command.handle('nobody')
+        self.assertEqual(self.command.stderr.getvalue(),
+                         'No accounts found.\n')
@@ -9,6 +9,7 @@ from django.contrib.auth import authenticate
 from go.base.tests.utils import VumiGoDjangoTestCase
 from go.base.management.commands import go_setup_env
 from go.base.utils import vumi_api_for_user
+from go.vumitools.tagpool_cache import TagpoolMetadataCache
 
 from mock import Mock
 
@@ -219,6 +220,15 @@ class GoBootstrapEnvTestCase(VumiGoDjangoTestCase):
         self.assertEqual(sorted(self.tagpool.free_tags("pool1")),
                          [("pool1", "default%d" % i) for i in range(10)])
 
+    def test_tagpool_loading_invalidates_metadata_caches(self):
+        cache = TagpoolMetadataCache(self.tagpool)
+        cache.get_metadata('pool1')
+        self.command.setup_tagpools(self.tagpool_file.name)
+        cache.check_generation()
+        self.assertEqual(cache.get_metadata('pool1'), {
+            'display_name': 'Pool 1'
+        })
+
     def assert_supervisor_config(self, data, program, worker_class, config):
         cp = ConfigParser()
         cp.readfp(StringIO(data))
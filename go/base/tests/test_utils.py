@@ -1,12 +1,14 @@
 """Test for go.base.utils."""
 
+from django.test import TestCase
+
 from go.base.tests.utils import VumiGoDjangoTestCase
 from go.errors import UnknownConversationType, UnknownRouterType
 from go.base.utils import (
     get_conversation_pkg, get_conversation_definition,
     get_conversation_view_definition,
     get_router_pkg, get_router_definition,
-    get_router_view_definition)
+    get_router_view_definition, external_sort)
 
 
 class ConversationDefinitionHelpersTestCase(VumiGoDjangoTestCase):
@@ -80,3 +82,15 @@ class RouterDefinitionHelpersTestCase(VumiGoDjangoTestCase):
         dummy_router = object()
         view_def = get_router_view_definition('keyword', dummy_router)
         self.assertTrue(view_def._router_def.router is dummy_router)
+
+
+class ExternalSortTestCase(TestCase):
+    def test_external_sort(self):
+        items = [[i % 7, i] for i in range(50)]
+        self.assertEqual(
+            list(external_sort(items, key=lambda item: item[0],
+                               chunk_size=6)),
+            sorted(items, key=lambda item: item[0]))
+
+    def test_external_sort_empty(self):
+        self.assertEqual(list(external_sort([], key=lambda item: item)), [])
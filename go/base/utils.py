@@ -1,16 +1,25 @@
 """Utilities for the Django parts of Vumi Go."""
 
+import os
 import csv
+import json
+import heapq
 import codecs
+import tempfile
+from uuid import uuid4
 from StringIO import StringIO
 
 from django import forms
 from django.http import Http404
 from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
 
 from go.base.amqp import connection
 from go.errors import UnknownConversationType, UnknownRouterType
 from go.vumitools.api import VumiApi
+from go.token.django_token_manager import DjangoTokenManager
 
 
 def conversation_or_404(user_api, key):
@@ -121,6 +130,50 @@ class UnicodeCSVWriter(object):
             self.writerow(row)
 
 
+def _write_sorted_chunk(chunk):
+    chunk.sort(key=lambda pair: pair[0])
+    chunk_file = tempfile.TemporaryFile()
+    for pair in chunk:
+        chunk_file.write(json.dumps(pair) + '\n')
+    chunk_file.seek(0)
+    return chunk_file
+
+
+def _read_sorted_chunk(chunk_index, chunk_file):
+    for position, line in enumerate(chunk_file):
+        key, item = json.loads(line)
+        yield key, chunk_index, position, item
+
+
+def external_sort(items, key, chunk_size=10000):
+    """
+    Sort `items` using temporary files so that no more than `chunk_size`
+    items are held in memory at once. Items and their keys must be JSON
+    serializable and are returned as they come out of `json.loads`.
+
+    This returns a generator. All of `items` is consumed by the time the
+    first sorted item is produced.
+    """
+    chunk_files = []
+    try:
+        chunk = []
+        for item in items:
+            chunk.append((key(item), item))
+            if len(chunk) >= chunk_size:
+                chunk_files.append(_write_sorted_chunk(chunk))
+                chunk = []
+        if chunk:
+            chunk_files.append(_write_sorted_chunk(chunk))
+
+        chunks = [_read_sorted_chunk(i, chunk_file)
+                  for i, chunk_file in enumerate(chunk_files)]
+        for _key, _chunk_index, _position, item in heapq.merge(*chunks):
+            yield item
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
 def configured_conversation_types():
     return dict((a['namespace'], a['display_name'])
                 for a in settings.VUMI_INSTALLED_APPS.itervalues())
@@ -192,3 +245,36 @@ def get_router_view_definition(router_type, router=None):
     if not hasattr(router_pkg, 'view_definition'):
         return RouterViewDefinitionBase(router_def)
     return router_pkg.view_definition.RouterViewDefinition(router_def)
+
+
+def attach_export(email, user_api, user, file_name, export_file,
+                  mime_type='application/zip'):
+    """
+    Attach `export_file` to `email`, or add a link to download it to the
+    email's body if it is larger than ``settings.EXPORT_ATTACHMENT_MAX_SIZE``
+    bytes.
+
+    Large exports are copied to the default storage in chunks rather than
+    being read into memory, and the link is only valid for `user` for
+    ``settings.EXPORT_LINK_LIFETIME`` seconds.
+    """
+    export_file.seek(0, os.SEEK_END)
+    size = export_file.tell()
+    export_file.seek(0)
+    if size <= settings.EXPORT_ATTACHMENT_MAX_SIZE:
+        email.attach(file_name, export_file.read(), mime_type)
+        return
+
+    file_path = default_storage.save(
+        'exports/%s/%s' % (uuid4().hex, file_name), File(export_file))
+    token_manager = DjangoTokenManager(user_api.api.token_manager)
+    token = token_manager.generate(
+        reverse('download_export'), user_id=user.id,
+        lifetime=settings.EXPORT_LINK_LIFETIME, extra_params={
+            'file_path': file_path,
+            'file_name': file_name,
+            'mime_type': mime_type,
+        })
+    email.body += (
+        '\nThe export is too large to attach. You can download it from:\n'
+        '%s\n' % (token_manager.url_for_token(token),))
@@ -1,8 +1,10 @@
 import requests
 
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.contrib.auth.decorators import login_required
+from django.core.files.storage import default_storage
+from django.core.servers.basehttp import FileWrapper
 
 from urlparse import urlparse, urlunparse
 
@@ -36,3 +38,26 @@ def cross_domain_xhr(request):
     return HttpResponse(
         response.content,
         status=response.status_code)
+
+
+@login_required
+def download_export(request):
+    """
+    Serve an export that was too large to email. The token is checked by
+    :func:`go.token.views.token` before we are redirected here.
+    """
+    tm = request.user_api.api.token_manager
+    token_data = tm.verify_get(request.GET.get('token'))
+    if not token_data:
+        raise Http404
+
+    params = token_data['extra_params']
+    if not default_storage.exists(params['file_path']):
+        raise Http404
+    export_file = default_storage.open(params['file_path'], 'rb')
+    response = HttpResponse(
+        FileWrapper(export_file), content_type=params['mime_type'])
+    response['Content-Disposition'] = 'attachment; filename=%s' % (
+        params['file_name'],)
+    response['Content-Length'] = default_storage.size(params['file_path'])
+    return response
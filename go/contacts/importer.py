@@ -0,0 +1,163 @@
+# -*- test-case-name: go.contacts.tests -*-
+import hashlib
+
+
+def contact_import_redis(user_api):
+    return user_api.api.redis.sub_manager('contact_imports')
+
+
+def get_import_progress(user_api, group_key):
+    """
+    Return a list of progress dictionaries for the imports currently
+    running into the given group.
+    """
+    redis = contact_import_redis(user_api)
+    imports = []
+    for import_id in sorted(redis.smembers(group_key)):
+        progress = redis.hgetall(import_id)
+        if progress:
+            imports.append(progress)
+    return imports
+
+
+class ContactImporter(object):
+    """
+    Imports contacts into a group in batches.
+
+    Contacts with an MSISDN that already exists in the account are updated
+    and added to the group instead of being duplicated. Only the keys of the
+    contacts written are kept (in Redis) so that a failed import can be
+    rolled back. Progress is recorded in Redis so the contacts UI can show it
+    and so that an import that was interrupted can carry on from the last
+    completed batch when the task is retried.
+    """
+
+    BATCH_SIZE = 100
+    PROGRESS_TTL = 60 * 60 * 24
+
+    def __init__(self, user_api, group_key, file_path, batch_size=None):
+        self.contact_store = user_api.contact_store
+        self.redis = contact_import_redis(user_api)
+        self.group_key = group_key
+        self.file_path = file_path
+        self.import_id = hashlib.md5(
+            ':'.join([group_key, file_path]).encode('utf-8')).hexdigest()
+        self.batch_size = batch_size or self.BATCH_SIZE
+
+    def key(self, name):
+        return ':'.join([self.import_id, name])
+
+    def start(self):
+        """
+        Start the import, returning the number of rows that have already
+        been imported if this import was interrupted.
+        """
+        progress = self.redis.hgetall(self.import_id)
+        if progress.get('status') == 'importing':
+            return int(progress['processed'])
+        self.redis.hmset(self.import_id, {
+            'file_path': self.file_path,
+            'status': 'importing',
+            'processed': 0,
+            'created': 0,
+            'updated': 0,
+        })
+        self.redis.sadd(self.group_key, self.import_id)
+        return 0
+
+    def finish(self, status='completed'):
+        """
+        Mark the import as done and clean up, returning the number of rows
+        imported.
+        """
+        processed = int(self.redis.hget(self.import_id, 'processed') or 0)
+        self.redis.hset(self.import_id, 'status', status)
+        self.redis.expire(self.import_id, self.PROGRESS_TTL)
+        self.redis.srem(self.group_key, self.import_id)
+        self.redis.delete(self.key('created'))
+        self.redis.delete(self.key('updated'))
+        return processed
+
+    def rollback(self):
+        """
+        Delete the contacts created by this import and remove the contacts
+        it added to the group from it. Field values overwritten on existing
+        contacts are not restored.
+        """
+        for contact_key in list(self.redis.smembers(self.key('created'))):
+            contact = self.contact_store.contacts.load(contact_key)
+            if contact is not None:
+                contact.delete()
+        for contact_key in list(self.redis.smembers(self.key('updated'))):
+            contact = self.contact_store.contacts.load(contact_key)
+            if contact is not None:
+                contact.groups.remove_key(self.group_key)
+                contact.save()
+        self.finish('failed')
+
+    def import_contacts(self, contact_dictionaries, skip=0):
+        batch = []
+        for row_number, contact_dictionary in enumerate(contact_dictionaries):
+            if row_number < skip:
+                continue
+            batch.append(contact_dictionary)
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+
+    def find_existing_contacts(self, batch):
+        msisdns = set(fields['msisdn'] for fields in batch
+                      if fields.get('msisdn'))
+        if not msisdns:
+            return {}
+
+        escaped = [msisdn.replace('\\', '\\\\').replace("'", "\\'")
+                   for msisdn in msisdns]
+        query = ' OR '.join("msisdn:'%s'" % (msisdn,) for msisdn in escaped)
+        keys = self.contact_store.contacts.raw_search(query).get_keys()
+
+        existing = {}
+        for bunch in self.contact_store.contacts.load_all_bunches(keys):
+            for contact in bunch:
+                current = existing.get(contact.msisdn)
+                if current is None or contact.created_at > current.created_at:
+                    existing[contact.msisdn] = contact
+        return existing
+
+    def update_contact(self, contact, fields):
+        extra = fields.pop('extra', {})
+        fields = self.contact_store.settable_contact_fields(**fields)
+        for field_name, field_value in fields.iteritems():
+            if field_name in contact.field_descriptors:
+                setattr(contact, field_name, field_value)
+        for extra_name, extra_value in extra.iteritems():
+            contact.extra[extra_name] = extra_value
+        contact.add_to_group(self.group_key)
+        contact.save()
+
+    def import_batch(self, batch):
+        existing = self.find_existing_contacts(batch)
+        created, updated = 0, 0
+        for fields in batch:
+            fields = dict(fields)
+            msisdn = fields.get('msisdn')
+            contact = existing.get(msisdn)
+            if contact is None:
+                # Make sure we set this group they're being uploaded in to
+                fields['groups'] = [self.group_key]
+                contact = self.contact_store.new_contact(**fields)
+                self.redis.sadd(self.key('created'), contact.key)
+                created += 1
+                if msisdn:
+                    existing[msisdn] = contact
+            else:
+                if self.group_key not in contact.groups.keys():
+                    self.redis.sadd(self.key('updated'), contact.key)
+                self.update_contact(contact, fields)
+                updated += 1
+
+        self.redis.hincrby(self.import_id, 'created', created)
+        self.redis.hincrby(self.import_id, 'updated', updated)
+        self.redis.hincrby(self.import_id, 'processed', len(batch))
@@ -1,6 +1,7 @@
 import sys
+import tempfile
 import traceback
-from StringIO import StringIO
+from itertools import chain
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from celery.task import task
@@ -13,9 +14,9 @@ from django.utils.safestring import mark_safe
 
 from go.vumitools.api import VumiUserApi
 from go.base.models import UserProfile
-from go.base.utils import UnicodeCSVWriter
+from go.base.utils import UnicodeCSVWriter, external_sort, attach_export
 from go.contacts.parsers import ContactFileParser
-from go.contacts.utils import contacts_by_key
+from go.contacts.importer import ContactImporter
 
 
 @task(ignore_result=True)
@@ -52,14 +53,6 @@ def delete_group_contacts(account_key, group_key):
         contact_store.get_contact_by_key(contact_key).delete()
 
 
-def zipped_file(filename, data):
-    zipio = StringIO()
-    zf = ZipFile(zipio, "a", ZIP_DEFLATED)
-    zf.writestr(filename, data)
-    zf.close()
-    return zipio.getvalue()
-
-
 _contact_fields = [
     'name',
     'surname',
@@ -74,44 +67,91 @@ _contact_fields = [
 ]
 
 
-def contacts_to_csv(contacts, include_extra=True):
-    contacts = sorted(contacts, key=lambda c: c.created_at)
+def _contact_export_rows(contact_store, contact_keys, include_extra):
+    for bunch in contact_store.contacts.load_all_bunches(contact_keys):
+        for contact in bunch:
+            row = [unicode(getattr(contact, field, None) or '')
+                   for field in _contact_fields]
+            extra = {}
+            if include_extra:
+                extra = dict((extra_field, unicode(value or ''))
+                             for extra_field, value in contact.extra.items())
+            yield [contact.created_at.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                   row, extra]
 
-    io = StringIO()
-    writer = UnicodeCSVWriter(io)
 
-    # Collect the possible field names for this set of contacts, depending
-    # the number of contacts found this could be potentially expensive.
+def write_contacts_csv(csv_file, contact_store, contact_keys,
+                       include_extra=True):
+    """
+    Write the contacts for the given keys to `csv_file`, ordered by the
+    date they were created, and return the number of contacts written.
+
+    Contacts are loaded in bunches and sorted on disk, so memory use does
+    not depend on the number of contacts exported.
+    """
+    # Collect the possible field names for this set of contacts while the
+    # contacts are being sorted.
     extra_fields = set()
-    if include_extra:
-        for contact in contacts:
-            extra_fields.update(contact.extra.keys())
+
+    def collect_extra_fields(rows):
+        for row in rows:
+            extra_fields.update(row[2].keys())
+            yield row
+
+    rows = external_sort(
+        collect_extra_fields(_contact_export_rows(
+            contact_store, contact_keys, include_extra)),
+        key=lambda row: row[0])
+    # Sorting has consumed all the contacts once the first row is available.
+    first_row = next(rows, None)
     extra_fields = sorted(extra_fields)
 
+    writer = UnicodeCSVWriter(csv_file)
+
     # write the CSV header
     writer.writerow(_contact_fields + ['extras-%s' % f for f in extra_fields])
 
     # loop over the contacts and create the row populated with
     # the values of the selected fields.
-    for contact in contacts:
-        row = [unicode(getattr(contact, field, None) or '')
-               for field in _contact_fields]
+    count = 0
+    if first_row is not None:
+        for _created_at, row, extra in chain([first_row], rows):
+            if include_extra:
+                row.extend([extra.get(extra_field, u'')
+                            for extra_field in extra_fields])
+            writer.writerow(row)
+            count += 1
+
+    return count
+
 
-        if include_extra:
-            row.extend([unicode(contact.extra[extra_field] or '')
-                        for extra_field in extra_fields])
+def export_contacts_zip(contact_store, contact_keys, include_extra=True):
+    """
+    Export the contacts for the given keys as a zipped CSV file.
+
+    The CSV and the zip file are both written to temporary files rather than
+    held in memory. Returns the open zip file and the number of contacts
+    exported.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+        count = write_contacts_csv(
+            csv_file, contact_store, contact_keys, include_extra)
+        csv_file.flush()
 
-        writer.writerow(row)
+        zip_file = tempfile.TemporaryFile()
+        zf = ZipFile(zip_file, "w", ZIP_DEFLATED)
+        zf.write(csv_file.name, 'contacts-export.csv')
+        zf.close()
 
-    return io.getvalue()
+    zip_file.seek(0)
+    return zip_file, count
 
 
-def get_group_contacts(contact_store, *groups):
+def get_group_contact_keys(contact_store, *groups):
     contact_keys = []
     for group in groups:
         contact_keys.extend(contact_store.get_contacts_for_group(group))
-
-    return contacts_by_key(contact_store, *contact_keys)
+    return contact_keys
 
 
 @task(ignore_result=True)
@@ -131,9 +171,8 @@ def export_contacts(account_key, contact_keys, include_extra=True):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
 
-    contacts = contacts_by_key(contact_store, *contact_keys)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
+    zip_file, count = export_contacts_zip(
+        contact_store, contact_keys, include_extra)
 
     # Get the profile for this user so we can email them when the import
     # has been completed.
@@ -141,10 +180,12 @@ def export_contacts(account_key, contact_keys, include_extra=True):
 
     email = EmailMessage(
         'Contacts export',
-        'Please find the CSV data for %s contact(s)' % len(contacts),
+        'Please find the CSV data for %s contact(s)' % count,
         settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
 
-    email.attach('contacts-export.zip', file, 'application/zip')
+    attach_export(
+        email, api, user_profile.user, 'contacts-export.zip', zip_file)
+    zip_file.close()
     email.send()
 
 
@@ -166,9 +207,9 @@ def export_group_contacts(account_key, group_key, include_extra=True):
     contact_store = api.contact_store
 
     group = contact_store.get_group(group_key)
-    contacts = get_group_contacts(contact_store, group)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
+    zip_file, count = export_contacts_zip(
+        contact_store, get_group_contact_keys(contact_store, group),
+        include_extra)
 
     # Get the profile for this user so we can email them when the import
     # has been completed.
@@ -178,11 +219,13 @@ def export_group_contacts(account_key, group_key, include_extra=True):
         '%s contacts export' % (group.name,),
 
         'Please find the CSV data for %s contact(s) from '
-        'group "%s" attached.\n\n' % (len(contacts), group.name),
+        'group "%s" attached.\n\n' % (count, group.name),
 
         settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
 
-    email.attach('contacts-export.zip', file, 'application/zip')
+    attach_export(
+        email, api, user_profile.user, 'contacts-export.zip', zip_file)
+    zip_file.close()
     email.send()
 
 
@@ -205,9 +248,9 @@ def export_many_group_contacts(account_key, group_keys, include_extra=True):
     contact_store = api.contact_store
 
     groups = [contact_store.get_group(k) for k in group_keys]
-    contacts = get_group_contacts(contact_store, *groups)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
+    zip_file, count = export_contacts_zip(
+        contact_store, get_group_contact_keys(contact_store, *groups),
+        include_extra)
 
     # Get the profile for this user so we can email them when the import
     # has been completed.
@@ -218,15 +261,19 @@ def export_many_group_contacts(account_key, group_keys, include_extra=True):
 
         'Please find the attached CSV data for %s contact(s) from the '
         'following groups:\n%s\n' %
-        (len(contacts), '\n'.join('  - %s' % g.name for g in groups)),
+        (count, '\n'.join('  - %s' % g.name for g in groups)),
 
         settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
 
-    email.attach('contacts-export.zip', file, 'application/zip')
+    attach_export(
+        email, api, user_profile.user, 'contacts-export.zip', zip_file)
+    zip_file.close()
     email.send()
 
 
-@task(ignore_result=True)
+# This is acked late so that the import is retried (and resumed from the
+# last batch written) if the worker dies part way through.
+@task(ignore_result=True, acks_late=True)
 def import_contacts_file(account_key, group_key, file_name, file_path,
                          fields, has_header):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
@@ -237,24 +284,19 @@ def import_contacts_file(account_key, group_key, file_name, file_path,
     # has been completed.
     user_profile = UserProfile.objects.get(user_account=account_key)
 
-    written_contacts = []
+    importer = ContactImporter(api, group_key, file_path)
 
     try:
         extension, parser = ContactFileParser.get_parser(file_name)
 
         contact_dictionaries = parser.parse_file(file_path, fields, has_header)
-        for counter, contact_dictionary in enumerate(contact_dictionaries):
-
-            # Make sure we set this group they're being uploaded in to
-            contact_dictionary['groups'] = [group.key]
-
-            contact = contact_store.new_contact(**contact_dictionary)
-            written_contacts.append(contact)
+        importer.import_contacts(contact_dictionaries, skip=importer.start())
+        count = importer.finish()
 
         send_mail(
             'Contact import completed successfully.',
             render_to_string('contacts/import_completed_mail.txt', {
-                'count': counter,
+                'count': count,
                 'group': group,
                 'user': user_profile.user,
             }), settings.DEFAULT_FROM_EMAIL, [user_profile.user.email],
@@ -263,11 +305,10 @@ def import_contacts_file(account_key, group_key, file_name, file_path,
     except:
         # Clean up if something went wrong, either everything is written
         # or nothing is written
-        for contact in written_contacts:
-            contact.delete()
-
         exc_type, exc_value, exc_traceback = sys.exc_info()
 
+        importer.rollback()
+
         send_mail(
             'Something went wrong while importing the contacts.',
             render_to_string('contacts/import_failed_mail.txt', {
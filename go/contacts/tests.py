@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from os import path
 from StringIO import StringIO
+from urlparse import urlparse
 from zipfile import ZipFile
 
 from django.conf import settings
@@ -11,6 +12,8 @@ from django.core import mail
 
 from django.core.files.storage import default_storage
 from go.contacts.parsers.base import FieldNormalizer
+from go.contacts import tasks
+from go.contacts.importer import ContactImporter, get_import_progress
 from go.base.tests.utils import VumiGoDjangoTestCase
 
 
@@ -174,6 +177,60 @@ class ContactsTestCase(BaseContactsTestCase):
         self.assertTrue(contents)
         self.assertEqual(mime_type, 'application/zip')
 
+    def test_contact_exporting_too_large_to_attach(self):
+        self.patch_settings(EXPORT_ATTACHMENT_MAX_SIZE=0)
+        c1 = self.mkcontact()
+
+        self.client.post(reverse('contacts:people'), {
+            '_export': True,
+            'contact': [c1.key],
+        })
+
+        [email] = mail.outbox
+        self.assertEqual(email.attachments, [])
+        self.assertTrue('1 contact(s)' in email.body)
+        [token_url] = [line for line in email.body.splitlines()
+                       if line.startswith('http://')]
+
+        response = self.client.get(urlparse(token_url).path, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertTrue('contacts-export.zip' in
+                        response['Content-Disposition'])
+        zipfile = ZipFile(StringIO(response.content), 'r')
+        csv_contents = zipfile.open('contacts-export.csv', 'r').read()
+        self.assertTrue(c1.msisdn in csv_contents)
+
+        [export_dir] = default_storage.listdir('exports')[0]
+        export_path = 'exports/%s/contacts-export.zip' % (export_dir,)
+        default_storage.delete(export_path)
+
+    def test_write_contacts_csv(self):
+        c1 = self.mkcontact(name=u'one')
+        c1.extra['foo'] = u'bar'
+        c1.save()
+        c2 = self.mkcontact(name=u'twø')
+        c2.extra['baz'] = u'quux'
+        c2.save()
+
+        csv_file = StringIO()
+        count = tasks.write_contacts_csv(
+            csv_file, self.contact_store, [c2.key, c1.key])
+        self.assertEqual(count, 2)
+
+        [header, c1_data, c2_data, _] = csv_file.getvalue().split('\r\n')
+        self.assertTrue(header.endswith('created_at,extras-baz,extras-foo'))
+        self.assertTrue(c1_data.startswith('one,'))
+        self.assertTrue(c1_data.endswith(',,bar'))
+        self.assertTrue(c2_data.startswith('tw\xc3\xb8,'))
+        self.assertTrue(c2_data.endswith(',quux,'))
+
+    def test_write_contacts_csv_no_contacts(self):
+        csv_file = StringIO()
+        self.assertEqual(
+            tasks.write_contacts_csv(csv_file, self.contact_store, []), 0)
+        self.assertTrue(csv_file.getvalue().startswith('name,surname,'))
+
     def specify_columns(self, group_key, columns=None):
         group_url = reverse('contacts:group', kwargs={
             'group_key': group_key,
@@ -700,6 +757,96 @@ class GroupsTestCase(BaseContactsTestCase):
         self.assertEqual(mime_type, 'application/zip')
 
 
+class ContactImporterTestCase(BaseContactsTestCase):
+
+    def setUp(self):
+        super(ContactImporterTestCase, self).setUp()
+        self.group = self.contact_store.new_group(TEST_GROUP_NAME)
+
+    def mk_importer(self, file_path='tmp/contacts.csv', batch_size=2):
+        return ContactImporter(self.user_api, self.group.key, file_path,
+                               batch_size=batch_size)
+
+    def mk_rows(self, count):
+        return [{
+            'name': u'Name %s' % (i,),
+            'msisdn': u'+2776123456%s' % (i,),
+        } for i in range(count)]
+
+    def get_group_contacts(self):
+        group = self.contact_store.get_group(self.group.key)
+        return [self.contact_store.contacts.load(key)
+                for key in group.backlinks.contacts()]
+
+    def test_import(self):
+        importer = self.mk_importer()
+        self.assertEqual(importer.start(), 0)
+        importer.import_contacts(self.mk_rows(3))
+        self.assertEqual(get_import_progress(self.user_api, self.group.key), [{
+            'file_path': 'tmp/contacts.csv',
+            'status': 'importing',
+            'processed': '3',
+            'created': '3',
+            'updated': '0',
+        }])
+        self.assertEqual(importer.finish(), 3)
+        self.assertEqual(
+            get_import_progress(self.user_api, self.group.key), [])
+        self.assertEqual(len(self.get_group_contacts()), 3)
+
+    def test_import_dedupes_on_msisdn(self):
+        existing = self.mkcontact(msisdn=u'+27761234561')
+        rows = self.mk_rows(3) + [{'msisdn': u'+27761234562', 'name': u'Foo'}]
+        importer = self.mk_importer()
+        importer.start()
+        importer.import_contacts(rows)
+        importer.finish()
+
+        self.assertEqual(len(self.contact_store.list_contacts()), 3)
+        contacts = self.get_group_contacts()
+        self.assertEqual(len(contacts), 3)
+        existing = self.contact_store.get_contact_by_key(existing.key)
+        self.assertEqual(existing.name, u'Name 1')
+        self.assertEqual(existing.groups.keys(), [self.group.key])
+        [foo] = [c for c in contacts if c.msisdn == u'+27761234562']
+        self.assertEqual(foo.name, u'Foo')
+
+    def test_import_resume(self):
+        rows = self.mk_rows(5)
+        importer = self.mk_importer()
+        importer.start()
+        importer.import_contacts(rows[:2])
+
+        # The worker died; the retried task picks up after the last batch.
+        importer = self.mk_importer()
+        skip = importer.start()
+        self.assertEqual(skip, 2)
+        importer.import_contacts(rows, skip=skip)
+        self.assertEqual(importer.finish(), 5)
+        self.assertEqual(len(self.contact_store.list_contacts()), 5)
+
+    def test_rollback(self):
+        existing = self.mkcontact(msisdn=u'+27761234561')
+        importer = self.mk_importer()
+        importer.start()
+        importer.import_contacts(self.mk_rows(3))
+        importer.rollback()
+
+        self.assertEqual(self.contact_store.list_contacts(), [existing.key])
+        existing = self.contact_store.get_contact_by_key(existing.key)
+        self.assertEqual(existing.groups.keys(), [])
+        self.assertEqual(
+            get_import_progress(self.user_api, self.group.key), [])
+
+    def test_group_page_shows_import_progress(self):
+        importer = self.mk_importer()
+        importer.start()
+        importer.import_contacts(self.mk_rows(2))
+        response = self.client.get(group_url(self.group.key))
+        self.assertContains(
+            response, 'Importing contacts: 2 row(s) processed so far.')
+
+
 class SmartGroupsTestCase(BaseContactsTestCase):
     def mksmart_group(self, query, name='a smart group'):
         response = self.client.post(reverse('contacts:groups'), {
@@ -16,6 +16,7 @@ from go.contacts.forms import (
     ContactForm, ContactGroupForm, UploadContactsForm, SmartGroupForm,
     SelectContactGroupForm)
 from go.contacts import tasks, utils
+from go.contacts.importer import get_import_progress
 from go.contacts.parsers import ContactFileParser, ContactParserException
 from go.contacts.parsers.base import FieldNormalizer
 from go.vumitools.contact import ContactError
@@ -246,6 +247,11 @@ def _static_group(request, contact_store, group):
             utils.clear_file_hints_from_session(request)
             default_storage.delete(file_path)
 
+    for progress in get_import_progress(request.user_api, group.key):
+        messages.info(
+            request, 'Importing contacts: %s row(s) processed so far.' % (
+                progress['processed'],))
+
     query = request.GET.get('q', '')
     if query:
         if not ':' in query:
@@ -1,4 +1,5 @@
-from StringIO import StringIO
+import tempfile
+from itertools import chain
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from celery.task import task
@@ -8,7 +9,79 @@ from django.core.mail import EmailMessage
 
 from go.vumitools.api import VumiUserApi
 from go.base.models import UserProfile
-from go.base.utils import UnicodeCSVWriter
+from go.base.utils import UnicodeCSVWriter, external_sort, attach_export
+
+
+# The number of message keys to fetch from the message store cache at a time
+# while exporting.
+MESSAGE_EXPORT_PAGE_SIZE = 1000
+
+
+def conversation_messages(conversation, direction, batch_key,
+                          page_size=None):
+    """
+    Iterate over the messages in a conversation's batch, fetching
+    `page_size` keys at a time from the message store cache. Sensitive
+    messages are left out.
+
+    :param str direction:
+        Either 'sent' or 'received'.
+    """
+    if page_size is None:
+        page_size = MESSAGE_EXPORT_PAGE_SIZE
+    mdb = conversation.mdb
+    if direction == 'sent':
+        get_keys = mdb.cache.get_outbound_message_keys
+        proxy = mdb.outbound_messages
+    else:
+        get_keys = mdb.cache.get_inbound_message_keys
+        proxy = mdb.inbound_messages
+
+    # We page in ascending order so that messages arriving during the export
+    # are added after the pages we've already read.
+    start = 0
+    while True:
+        keys = get_keys(batch_key, start, start + page_size - 1, asc=True)
+        if not keys:
+            break
+        for message in conversation.collect_messages(
+                keys, proxy, include_sensitive=False, scrubber=None):
+            yield message
+        start += page_size
+
+
+def write_messages_csv(csv_file, conversation, field_names):
+    """
+    Write the sent and received messages in a conversation to `csv_file`,
+    sorted by the end user's address and then by timestamp.
+
+    Messages are sorted on disk, so memory use does not depend on the
+    number of messages exported.
+    """
+    writer = UnicodeCSVWriter(csv_file)
+    writer.writerow(field_names)
+
+    batch_key = conversation.get_latest_batch_key()
+    if batch_key is None:
+        return
+
+    def message_rows(direction):
+        for message in conversation_messages(
+                conversation, direction, batch_key):
+            # The to_addr & from_addr switch depending on whether the message
+            # was sent or received. We always need to sort on the addr of the
+            # end user which means switching based on direction.
+            addr = message['to_addr' if direction == 'sent' else 'from_addr']
+            timestamp = message['timestamp'].strftime('%Y-%m-%d %H:%M:%S.%f')
+            row = [unicode(message.payload.get(fn) or '')
+                   for fn in field_names]
+            yield [addr, timestamp, row]
+
+    rows = external_sort(
+        chain(message_rows('sent'), message_rows('received')),
+        key=lambda row: row[:2])
+    for _addr, _timestamp, row in rows:
+        writer.writerow(row)
 
 
 @task(ignore_result=True)
@@ -35,48 +108,25 @@ def export_conversation_messages(account_key, conversation_key):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     user_profile = UserProfile.objects.get(user_account=account_key)
     conversation = api.get_wrapped_conversation(conversation_key)
-    io = StringIO()
 
-    writer = UnicodeCSVWriter(io)
-    writer.writerow(field_names)
+    # The CSV and the zip file are written to temporary files rather than
+    # held in memory.
+    with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+        write_messages_csv(csv_file, conversation, field_names)
+        csv_file.flush()
 
-    # limiting to 0 results in getting the full set, creating lists of tuples
-    # with direction sort we can sort sent & received messages in a somewhat
-    # threaded fashion further down.
-    sent_messages = [('sent', msg)
-                        for msg in conversation.sent_messages(limit=0)]
-    received_messages = [('received', msg)
-                            for msg in conversation.received_messages(limit=0)]
-
-    def sort_by_addr_and_timestap(entry):
-        """
-        Apply sorting based on direction of the message.
-        The to_addr & from_addr switch depending on whether the message
-        was sent or received. We always need to sort on the addr of the end
-        user which means switching based on direction.
-        """
-        direction, message = entry
-        if direction == 'sent':
-            return (message['to_addr'], message['timestamp'])
-        return (message['from_addr'], message['timestamp'])
-
-    all_messages = [msg for directon, msg in
-                        sorted(sent_messages + received_messages,
-                            key=sort_by_addr_and_timestap)]
-
-    for message in all_messages:
-        writer.writerow([unicode(message.payload.get(fn) or '')
-                            for fn in field_names])
-
-    zipio = StringIO()
-    zf = ZipFile(zipio, "a", ZIP_DEFLATED)
-    zf.writestr("messages-export.csv", io.getvalue())
-    zf.close()
+        zip_file = tempfile.TemporaryFile()
+        zf = ZipFile(zip_file, "w", ZIP_DEFLATED)
+        zf.write(csv_file.name, "messages-export.csv")
+        zf.close()
 
+    zip_file.seek(0)
     email = EmailMessage(
         'Conversation message export: %s' % (conversation.name,),
         'Please find the messages of the conversation %s attached.\n' % (
             conversation.name),
         settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
-    email.attach('messages-export.zip', zipio.getvalue(), 'application/zip')
+    attach_export(
+        email, api, user_profile.user, 'messages-export.zip', zip_file)
+    zip_file.close()
     email.send()
@@ -113,6 +113,21 @@ class TestKeywordRouter(RouterWorkerTestCase):
         yield self.assert_routed_inbound(
             self.mkmsg_in(" aBc123 baz"), router, 'app2')
 
+    @inlineCallbacks
+    def test_inbound_keyword_strip_punctuation(self):
+        router = yield self.setup_router({
+            'keyword_endpoint_mapping': {
+                'stop': 'app1',
+            },
+            'strip_punctuation': True,
+        })
+        yield self.assert_routed_inbound(
+            self.mkmsg_in("STOP!"), router, 'app1')
+        yield self.assert_routed_inbound(
+            self.mkmsg_in('"stop" now'), router, 'app1')
+        yield self.assert_routed_inbound(
+            self.mkmsg_in("st.op"), router, 'default')
+
     @inlineCallbacks
     def test_outbound_no_config(self):
         router = yield self.setup_router({})
@@ -2,15 +2,20 @@
 # -*- coding: utf-8 -*-
 
 from vumi import log
-from vumi.config import ConfigDict
+from vumi.config import ConfigDict, ConfigBool
 
 from go.vumitools.app_worker import GoRouterWorker
+from go.vumitools.keyword_matcher import (
+    KeywordMatcherCache, model_fingerprint)
 
 
 class KeywordRouterConfig(GoRouterWorker.CONFIG_CLASS):
     keyword_endpoint_mapping = ConfigDict(
         "Mapping from case-insensitive keyword regex to endpoint name.",
         default={})
+    strip_punctuation = ConfigBool(
+        "Ignore punctuation at the start and end of keywords.",
+        default=False)
 
 
 class KeywordRouter(GoRouterWorker):
@@ -21,12 +26,17 @@ class KeywordRouter(GoRouterWorker):
 
     worker_name = 'keyword_router'
 
+    def setup_router(self):
+        self.keyword_matchers = KeywordMatcherCache()
+        return super(KeywordRouter, self).setup_router()
+
     def lookup_target(self, config, msg):
-        first_word = ((msg['content'] or '').strip().split() + [''])[0]
-        for keyword, target in config.keyword_endpoint_mapping.iteritems():
-            if keyword.lower() == first_word.lower():
-                return target
-        return 'default'
+        router = config.get_conversation()
+        matcher = self.keyword_matchers.get_matcher(
+            router.key, model_fingerprint(router, router.config),
+            lambda: config.keyword_endpoint_mapping.items(),
+            strip_punctuation=config.strip_punctuation)
+        return matcher.match_first(msg['content'], 'default')
 
     def handle_inbound(self, config, msg, conn_name):
         log.debug("Handling inbound: %s" % (msg,))
@@ -236,6 +236,12 @@ CELERY_RESULT_BACKEND = "amqp"
 EMAIL_BACKEND = 'djcelery_email.backends.CeleryEmailBackend'
 SEND_FROM_EMAIL_ADDRESS = 'no-reply-vumigo@praekeltfoundation.org'
 
+# Exports larger than this (in bytes) are saved to the default storage and
+# a link to download them is emailed instead of the export itself.
+EXPORT_ATTACHMENT_MAX_SIZE = 5 * 1024 * 1024
+# Number of seconds that links to download exports are valid for.
+EXPORT_LINK_LIFETIME = 7 * 24 * 60 * 60
+
 # Vumi API config
 # TODO: go.vumitools.api_worker and this should share the same
 #       configuration file so that configuration values aren't
@@ -24,6 +24,10 @@ urlpatterns = patterns(
     # confirmation tokens
     url(r'^t/', include('go.token.urls')),
 
+    # exports too large to email
+    url(r'^exports/download/$', 'go.base.views.download_export',
+        name='download_export'),
+
     # proxy for cross-domain xhrs
     url(r'^cross-domain-xhr/', cross_domain_xhr, name='cross_domain_xhr'),
 
@@ -80,6 +80,23 @@ class RoutingTableHelper(object):
 
     def __init__(self, routing_table):
         self.routing_table = routing_table
+        self._compiled = None
+
+    def compiled(self):
+        """Return a :class:`CompiledRoutingTable` for the current table.
+
+        The compiled table is built once and reused until the routing table
+        is modified through this helper. Code that modifies
+        :attr:`routing_table` directly must call :meth:`invalidate`
+        afterwards.
+        """
+        if self._compiled is None:
+            self._compiled = CompiledRoutingTable(self.routing_table)
+        return self._compiled
+
+    def invalidate(self):
+        """Discard the compiled form of the routing table."""
+        self._compiled = None
 
     def lookup_target(self, src_conn, src_endpoint):
         return self.routing_table.get(src_conn, {}).get(src_endpoint)
@@ -88,19 +105,10 @@ class RoutingTableHelper(object):
         return self.routing_table.get(src_conn, {}).items()
 
     def lookup_source(self, target_conn, target_endpoint):
-        for src_conn, routes in self.routing_table.iteritems():
-            for src_endpoint, (dst_conn, dst_endpoint) in routes.items():
-                if dst_conn == target_conn and dst_endpoint == target_endpoint:
-                    return [src_conn, src_endpoint]
-        return None
+        return self.compiled().lookup_source(target_conn, target_endpoint)
 
     def lookup_sources(self, target_conn):
-        sources = []
-        for src_conn, routes in self.routing_table.iteritems():
-            for src_endpoint, (dest_conn, dest_endpoint) in routes.items():
-                if dest_conn == target_conn:
-                    sources.append((dest_endpoint, [src_conn, src_endpoint]))
-        return sources
+        return self.compiled().lookup_sources(target_conn)
 
     def entries(self):
         """Iterate over entries in the routing table.
@@ -120,6 +128,7 @@ class RoutingTableHelper(object):
                     src_conn, src_endpoint, connector_dict[src_endpoint],
                     [dst_conn, dst_endpoint]))
         connector_dict[src_endpoint] = [dst_conn, dst_endpoint]
+        self.invalidate()
 
     def remove_entry(self, src_conn, src_endpoint):
         connector_dict = self.routing_table.get(src_conn)
@@ -135,6 +144,7 @@ class RoutingTableHelper(object):
             # This is the last entry for this connector
             self.routing_table.pop(src_conn)
 
+        self.invalidate()
         return old_dest
 
     def remove_connector(self, conn):
@@ -158,6 +168,8 @@ class RoutingTableHelper(object):
         for src_conn in to_remove:
             del self.routing_table[src_conn]
 
+        self.invalidate()
+
     def remove_conversation(self, conv):
         """Remove all entries linking to or from a given conversation.
 
@@ -217,22 +229,7 @@ class RoutingTableHelper(object):
         :param str src_conn: source connector to start search with.
         :rtype: set of destination connector strings.
         """
-        sources = [src_conn]
-        sources_seen = set(sources)
-        results = set()
-        while sources:
-            source = sources.pop()
-            destinations = self.lookup_targets(source)
-            for _src_endpoint, (dst_conn, _dst_endpoint) in destinations:
-                results.add(dst_conn)
-                parsed_dst = GoConnector.parse(dst_conn)
-                if parsed_dst.ctype != GoConnector.ROUTER:
-                    continue
-                extra_src = str(parsed_dst.flip_direction())
-                if extra_src not in sources_seen:
-                    sources.append(extra_src)
-                    sources_seen.add(extra_src)
-        return results
+        return self.compiled().transitive_targets(src_conn)
 
     def transitive_sources(self, dst_conn):
         """Return all connectors that lead to `dst_conn`.
@@ -254,22 +251,7 @@ class RoutingTableHelper(object):
         :param str dst_conn: destination connector to start search with.
         :rtype: set of source connector strings.
         """
-        destinations = [dst_conn]
-        destinations_seen = set(destinations)
-        results = set()
-        while destinations:
-            destination = destinations.pop()
-            sources = self.lookup_sources(destination)
-            for _dst_endpoint, (src_conn, _src_endpoint) in sources:
-                results.add(src_conn)
-                parsed_src = GoConnector.parse(src_conn)
-                if parsed_src.ctype != GoConnector.ROUTER:
-                    continue
-                extra_dst = str(parsed_src.flip_direction())
-                if extra_dst not in destinations_seen:
-                    destinations.append(extra_dst)
-                    destinations_seen.add(extra_dst)
-        return results
+        return self.compiled().transitive_sources(dst_conn)
 
     def validate_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
         """Validate the provided entry.
@@ -293,6 +275,92 @@ class RoutingTableHelper(object):
             self.validate_entry(*entry)
 
 
+class CompiledRoutingTable(object):
+    """Read-only indexes over a routing table dictionary.
+
+    Building the indexes walks the whole routing table once. After that,
+    looking up the source of a destination is a dictionary lookup rather
+    than a scan of every entry, and the transitive closures computed by
+    :meth:`transitive_targets` and :meth:`transitive_sources` are
+    remembered for each connector.
+
+    The indexes are not updated if the routing table is modified, so a new
+    instance must be built for each version of the table. Use
+    :meth:`go.vumitools.api.VumiUserApi.get_compiled_routing_table` to get
+    one that is cached until the account's routing table is next saved.
+    """
+
+    def __init__(self, routing_table):
+        # (dst_conn, dst_endpoint) -> [src_conn, src_endpoint]
+        self._sources = {}
+        # dst_conn -> [(dst_endpoint, [src_conn, src_endpoint]), ...]
+        self._connector_sources = {}
+        # src_conn -> set of dst_conns
+        self._connector_targets = {}
+        self._routers = set()
+        self._transitive_targets = {}
+        self._transitive_sources = {}
+
+        for src_conn, routes in routing_table.iteritems():
+            targets = self._connector_targets.setdefault(src_conn, set())
+            for src_endpoint, (dst_conn, dst_endpoint) in routes.iteritems():
+                targets.add(dst_conn)
+                self._sources.setdefault(
+                    (dst_conn, dst_endpoint), [src_conn, src_endpoint])
+                self._connector_sources.setdefault(dst_conn, []).append(
+                    (dst_endpoint, [src_conn, src_endpoint]))
+                for conn in (src_conn, dst_conn):
+                    if conn.startswith(GoConnector.ROUTER + ":"):
+                        self._routers.add(conn)
+
+    def lookup_source(self, target_conn, target_endpoint):
+        source = self._sources.get((target_conn, target_endpoint))
+        if source is None:
+            return None
+        return list(source)
+
+    def lookup_sources(self, target_conn):
+        return [(dst_endpoint, list(source)) for dst_endpoint, source
+                in self._connector_sources.get(target_conn, [])]
+
+    def _other_side(self, conn):
+        """Return the connector on the other side of a router connector or
+        None if `conn` is not a router connector.
+        """
+        if conn not in self._routers:
+            return None
+        return str(GoConnector.parse(conn).flip_direction())
+
+    def _closure(self, start_conn, neighbours):
+        pending = [start_conn]
+        seen = set(pending)
+        results = set()
+        while pending:
+            for conn in neighbours(pending.pop()):
+                results.add(conn)
+                extra = self._other_side(conn)
+                if extra is not None and extra not in seen:
+                    pending.append(extra)
+                    seen.add(extra)
+        return frozenset(results)
+
+    def transitive_targets(self, src_conn):
+        """See :meth:`RoutingTableHelper.transitive_targets`."""
+        if src_conn not in self._transitive_targets:
+            self._transitive_targets[src_conn] = self._closure(
+                src_conn, lambda conn: self._connector_targets.get(conn, ()))
+        return set(self._transitive_targets[src_conn])
+
+    def transitive_sources(self, dst_conn):
+        """See :meth:`RoutingTableHelper.transitive_sources`."""
+        if dst_conn not in self._transitive_sources:
+            self._transitive_sources[dst_conn] = self._closure(
+                dst_conn, lambda conn: [
+                    src_conn for _dst_endpoint, (src_conn, _src_endpoint)
+                    in self._connector_sources.get(conn, [])])
+        return set(self._transitive_sources[dst_conn])
+
+
 class GoConnectorError(Exception):
     """Raised when attempting to construct an invalid connector."""
 
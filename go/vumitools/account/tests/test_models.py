@@ -173,6 +173,38 @@ class RoutingTableHelperTestCase(TestCase):
             ],
         )
 
+    def test_compiled_is_reused(self):
+        rt = self.mk_helper()
+        self.assertTrue(rt.compiled() is rt.compiled())
+
+    def test_compiled_invalidated_by_add_entry(self):
+        rt = self.mk_helper()
+        compiled = rt.compiled()
+        rt.add_entry(self.CONV_2, "default", self.CHANNEL_3, "other")
+        self.assertFalse(rt.compiled() is compiled)
+        self.assertEqual(rt.lookup_source(self.CHANNEL_3, "other"),
+                         [self.CONV_2, "default"])
+
+    def test_compiled_invalidated_by_remove_entry(self):
+        rt = self.mk_helper()
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "default2"),
+                         [self.CONV_1, "default1.1"])
+        rt.remove_entry(self.CONV_1, "default1.1")
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "default2"), None)
+
+    def test_compiled_invalidated_by_remove_connector(self):
+        rt = self.mk_helper(copy.deepcopy(self.COMPLEX_ROUTING))
+        self.assertEqual(sorted(rt.transitive_sources(self.CHANNEL_3)),
+                         [self.CONV_2])
+        rt.remove_connector(self.CONV_2)
+        self.assertEqual(sorted(rt.transitive_sources(self.CHANNEL_3)), [])
+
+    def test_transitive_targets_returns_copy(self):
+        rt = self.mk_helper()
+        rt.transitive_targets(self.CONV_1).clear()
+        self.assertEqual(sorted(rt.transitive_targets(self.CONV_1)), [
+            self.CHANNEL_2, self.CHANNEL_3])
+
     def test_entries(self):
         rt = self.mk_helper()
         self.assertEqual(sorted(rt.entries()), [
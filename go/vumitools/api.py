@@ -23,9 +23,14 @@ from go.vumitools.account import AccountStore, RoutingTableHelper, GoConnector
 from go.vumitools.channel import ChannelStore
 from go.vumitools.contact import ContactStore
 from go.vumitools.conversation import ConversationStore
+from go.vumitools.opt_out import OptOutStore
 from go.vumitools.router import RouterStore
 from go.vumitools.conversation.utils import ConversationWrapper
 from go.vumitools.credit import CreditManager
+from go.vumitools.routing_cache import RoutingTableCache
+from go.vumitools.event_handler_cache import EventHandlerConfigCache
+from go.vumitools.subscription.counters import SubscriptionCounters
+from go.vumitools.tagpool_cache import TagpoolMetadataCache
 from go.vumitools.token_manager import TokenManager
 
 from django.conf import settings
@@ -105,6 +110,11 @@ class VumiUserApi(object):
                                         self.user_account_key)
         self.channel_store = ChannelStore(self.api.manager,
                                           self.user_account_key)
+        self.optout_store = OptOutStore(self.api.manager,
+                                        self.user_account_key,
+                                        self.api.optout_redis)
+        self.subscription_counters = SubscriptionCounters(
+            self.api.subscription_redis, self.user_account_key)
 
     def exists(self):
         return self.api.user_exists(self.user_account_key)
@@ -318,6 +328,59 @@ class VumiUserApi(object):
                 "Routing table missing for account: %s" % (user_account.key,))
         returnValue(user_account.routing_table)
 
+    @Manager.calls_manager
+    def get_compiled_routing_table(self, user_account=None):
+        """Return a :class:`CompiledRoutingTable` for the account's
+        routing table.
+
+        The compiled table is cached until the routing table is saved using
+        :meth:`save_routing_table`, so it must not be modified.
+        """
+        if user_account is None:
+            user_account = yield self.get_user_account()
+        compiled = yield self.api.routing_cache.get_compiled_routing_table(
+            user_account.key, lambda: self.get_routing_table(user_account))
+        returnValue(compiled)
+
+    @Manager.calls_manager
+    def save_routing_table(self, user_account):
+        """Save the routing table on `user_account`.
+
+        This saves the account and invalidates any copies of its routing
+        table cached by routing dispatchers. Anything that modifies an
+        account's routing table should save it using this method.
+        """
+        yield user_account.save()
+        yield self.api.routing_cache.invalidate_routing_table(
+            user_account.key)
+
+    @Manager.calls_manager
+    def save_event_handler_config(self, user_account):
+        """Save the event handler config on `user_account`.
+
+        This saves the account and invalidates any copies of its event
+        handler config cached by event dispatchers. Anything that modifies
+        an account's event handler config should save it using this method.
+        """
+        yield user_account.save()
+        yield self.api.event_handler_cache.invalidate_event_handler_config(
+            user_account.key)
+
+    @Manager.calls_manager
+    def save_account(self, user_account):
+        """Save `user_account` after an unspecified change.
+
+        This saves the account and invalidates any cached copies of its
+        routing table and event handler config. Code that changes an account
+        without knowing whether those were modified should save it using
+        this method.
+        """
+        yield user_account.save()
+        yield self.api.routing_cache.invalidate_routing_table(
+            user_account.key)
+        yield self.api.event_handler_cache.invalidate_event_handler_config(
+            user_account.key)
+
     @Manager.calls_manager
     def validate_routing_table(self, user_account=None):
         """Check that the routing table on this account is valid.
@@ -366,6 +429,7 @@ class VumiUserApi(object):
         tag_info.metadata['user_account'] = user_account.key.decode('utf-8')
         yield tag_info.save()
         yield user_account.save()
+        yield self.api.routing_cache.invalidate_tag(tag)
 
     @Manager.calls_manager
     def acquire_tag(self, pool):
@@ -433,6 +497,7 @@ class VumiUserApi(object):
             tag_info = yield self.api.mdb.get_tag_info(tag)
             del tag_info.metadata['user_account']
             yield tag_info.save()
+            yield self.api.routing_cache.invalidate_tag(tag)
             # NOTE: This loads and saves the CurrentTag object a second time.
             #       We should probably refactor the message store to make this
             #       less clumsy.
@@ -444,7 +509,7 @@ class VumiUserApi(object):
             rt_helper = RoutingTableHelper(routing_table)
             rt_helper.remove_transport_tag(tag)
 
-            yield user_account.save()
+            yield self.save_routing_table(user_account)
         yield self.api.tpm.release_tag(tag)
 
     def delivery_class_for_msg(self, msg):
@@ -488,7 +553,7 @@ class VumiRouterApi(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         rt_helper = RoutingTableHelper(routing_table)
         rt_helper.remove_router(router)
-        yield user_account.save()
+        yield self.user_api.save_routing_table(user_account)
 
     @Manager.calls_manager
     def start_router(self, router=None):
@@ -540,7 +605,15 @@ class VumiApi(object):
         self.redis = redis
 
         self.tpm = TagpoolManager(self.redis.sub_manager('tagpool_store'))
+        self.tagpool_cache = TagpoolMetadataCache(self.tpm)
         self.cm = CreditManager(self.redis.sub_manager('credit_store'))
+        self.routing_cache = RoutingTableCache(
+            self.redis.sub_manager('routing_table_cache'))
+        self.event_handler_cache = EventHandlerConfigCache(
+            self.redis.sub_manager('event_handler_config_cache'))
+        self.optout_redis = self.redis.sub_manager('optout_store')
+        self.subscription_redis = self.redis.sub_manager(
+            'subscription_counters')
         self.mdb = MessageStore(self.manager,
                                 self.redis.sub_manager('message_store'))
         self.account_store = AccountStore(self.manager)
@@ -3,13 +3,19 @@
 
 """Vumi application worker for the vumitools API."""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, DeferredSemaphore,
+    DeferredList, Deferred)
+from twisted.python.failure import Failure
 
 from vumi.application import ApplicationWorker
+from vumi.blinkenlights.metrics import MetricManager, Metric, SUM, AVG
 from vumi.utils import load_class_by_string
 from vumi import log
 
 from go.vumitools.api import VumiApi, VumiApiCommand, VumiApiEvent
+from go.vumitools.event_handler_cache import EventHandlerConfigCache
 
 
 class CommandDispatcher(ApplicationWorker):
@@ -70,9 +76,24 @@ class EventDispatcher(ApplicationWorker):
     An application worker that forwards event arriving on the Vumi Api Event
     queue to the relevant handlers.
 
-    FIXME: The configuration is currently static.
-    TODO: We need a "flush cache" command for when the per-account config
-          updates.
+    Handlers run concurrently, and by default an event is only considered
+    consumed (and acked) once its handlers have finished or timed out, so
+    that events whose handlers were interrupted by a crash or restart are
+    redelivered. Set `ack_after_handlers` to ``False`` to ack events as
+    soon as their handlers have started instead, so that a slow handler
+    doesn't hold up other events at the cost of losing its events if the
+    worker stops.
+
+    At most `max_concurrent_handlers` handlers run at once. A handler that
+    takes longer than `handler_timeout` seconds is counted as failed and
+    we stop waiting for it, but it keeps its place in the limit until it
+    really finishes.
+
+    Each account's handler config is cached, and cached copies are reloaded
+    when :meth:`go.vumitools.api.VumiUserApi.save_event_handler_config` or
+    :meth:`go.vumitools.api.VumiUserApi.save_account` invalidates them (or
+    when they expire).
+
     TODO: We should wrap the command publisher and such to make event handlers
           saner. Or something.
 
@@ -82,8 +103,32 @@ class EventDispatcher(ApplicationWorker):
         Dictionary describing where to consume API commands.
     :param dict event_handlers:
         A mapping from handler name to fully-qualified class name.
+    :param int max_concurrent_handlers:
+        Maximum number of handlers to run at once. Defaults to 10.
+    :param float handler_timeout:
+        Number of seconds after which we stop waiting for a handler.
+        Defaults to 30.
+    :param bool ack_after_handlers:
+        If ``True``, an event is only acked once all its handlers have
+        finished (successfully or not) or timed out. Defaults to ``True``.
+    :param int account_config_ttl:
+        Number of seconds an account's handler config is cached for.
+        Defaults to 60.
+    :param int account_config_cache_size:
+        Maximum number of accounts to cache handler configs for. Defaults
+        to 1000.
+    :param str metrics_prefix:
+        Prefix for the handler latency and error metrics. Defaults to
+        ``go.event_dispatcher.``.
     """
 
+    MAX_CONCURRENT_HANDLERS = 10
+    HANDLER_TIMEOUT = 30
+    ACCOUNT_CONFIG_TTL = 60
+    ACCOUNT_CONFIG_CACHE_SIZE = 1000
+
+    clock = reactor
+
     def validate_config(self):
         self.api_routing_config = VumiApiEvent.default_routing_config()
         self.api_routing_config.update(self.config.get('api_routing', {}))
@@ -91,6 +136,18 @@ class EventDispatcher(ApplicationWorker):
         self.handler_config = self.config.get('event_handlers', {})
         self.account_handler_configs = self.config.get(
             'account_handler_configs', {})
+        self.max_concurrent_handlers = self.config.get(
+            'max_concurrent_handlers', self.MAX_CONCURRENT_HANDLERS)
+        self.handler_timeout = self.config.get(
+            'handler_timeout', self.HANDLER_TIMEOUT)
+        self.ack_after_handlers = self.config.get(
+            'ack_after_handlers', True)
+        self.account_config_ttl = self.config.get(
+            'account_config_ttl', self.ACCOUNT_CONFIG_TTL)
+        self.account_config_cache_size = self.config.get(
+            'account_config_cache_size', self.ACCOUNT_CONFIG_CACHE_SIZE)
+        self.metrics_prefix = self.config.get(
+            'metrics_prefix', 'go.event_dispatcher.')
 
     @inlineCallbacks
     def setup_application(self):
@@ -99,7 +156,16 @@ class EventDispatcher(ApplicationWorker):
         self.api_command_publisher = yield self.publish_to('vumi.api')
         self.vumi_api = yield VumiApi.from_config_async(
             self.config, self._amqp_client)
-        self.account_config = {}
+        self.account_config_cache = EventHandlerConfigCache(
+            self.vumi_api.event_handler_cache.redis,
+            ttl=self.account_config_ttl,
+            max_size=self.account_config_cache_size,
+            metric_callback=self.fire_account_config_cache_metric)
+        self.metrics = yield self.start_publisher(
+            MetricManager, self.metrics_prefix)
+        self.handler_semaphore = DeferredSemaphore(
+            self.max_concurrent_handlers)
+        self.handlers_in_progress = set()
 
         for name, handler_class in self.handler_config.items():
             cls = load_class_by_string(handler_class)
@@ -119,10 +185,22 @@ class EventDispatcher(ApplicationWorker):
             yield self.api_event_consumer.stop()
             self.api_event_consumer = None
 
+        yield self.wait_for_handlers()
         for name, handler in self.handlers.items():
             yield handler.teardown_handler()
+        self.metrics.stop()
+
+    def publish_metric(self, name, value, agg):
+        if name not in self.metrics:
+            metric = Metric(name, [agg])
+            self.metrics.register(metric)
+        else:
+            metric = self.metrics[name]
+        metric.set(value)
+
+    def fire_account_config_cache_metric(self, name):
+        self.publish_metric("account_config_cache.%s" % (name,), 1, SUM)
 
-    @inlineCallbacks
     def get_account_config(self, account_key):
         """Find the appropriate account config.
 
@@ -151,19 +229,80 @@ class EventDispatcher(ApplicationWorker):
 
         Hence the juggling of eggs below.
         """
-        if account_key not in self.account_config:
-            user_account = yield self.vumi_api.get_user_account(account_key)
-            event_handler_config = {}
-            for k, v in (user_account.event_handler_config or
-                         self.account_handler_configs.get(account_key) or []):
-                event_handler_config[tuple(k)] = v
-            self.account_config[account_key] = event_handler_config
-        returnValue(self.account_config[account_key])
+        return self.account_config_cache.get_event_handler_config(
+            account_key, lambda: self.load_account_config(account_key))
+
+    @inlineCallbacks
+    def load_account_config(self, account_key):
+        user_account = yield self.vumi_api.get_user_account(account_key)
+        account_event_handler_config = None
+        if user_account is not None:
+            account_event_handler_config = user_account.event_handler_config
+        event_handler_config = {}
+        for k, v in (account_event_handler_config or
+                     self.account_handler_configs.get(account_key) or []):
+            event_handler_config[tuple(k)] = v
+        returnValue(event_handler_config)
 
     @inlineCallbacks
     def consume_api_event(self, event):
         log.msg("Handling event: %r" % (event,))
         config = yield self.get_account_config(event['account_key'])
+        handler_ds = []
         for handler, handler_config in config.get(
                 (event['conversation_key'], event['event_type']), []):
-            yield self.handlers[handler].handle_event(event, handler_config)
+            # We wait for room to run the handler, but not for it to finish.
+            yield self.handler_semaphore.acquire()
+            handler_ds.append(self.run_handler(handler, event, handler_config))
+        if self.ack_after_handlers:
+            yield DeferredList(handler_ds)
+
+    def run_handler(self, handler, event, handler_config):
+        """
+        Start a handler, returning a deferred that fires once it has
+        finished or timed out.
+
+        The handler's own deferred isn't cancelled when it times out,
+        because the work it started may carry on regardless. It holds its
+        semaphore slot until it really finishes.
+        """
+        start = self.clock.seconds()
+        work = maybeDeferred(
+            self.handlers[handler].handle_event, event, handler_config)
+        d = Deferred()
+        timeout = self.clock.callLater(
+            self.handler_timeout, self._handler_timed_out, handler, d)
+        self.handlers_in_progress.add(work)
+        work.addBoth(self._handler_done, handler, start, timeout, d)
+        work.addBoth(self._handler_finished, work)
+        return d
+
+    def _handler_timed_out(self, handler, d):
+        log.warning("Event handler %s timed out after %s seconds." % (
+            handler, self.handler_timeout))
+        self.publish_metric("%s.timeouts" % (handler,), 1, SUM)
+        self.publish_metric("%s.errors" % (handler,), 1, SUM)
+        d.callback(None)
+
+    def _handler_done(self, result, handler, start, timeout, d):
+        self.publish_metric(
+            "%s.latency" % (handler,), self.clock.seconds() - start, AVG)
+        if isinstance(result, Failure):
+            log.err(result, "Error in event handler %s." % (handler,))
+        if timeout.active():
+            # Failures after a timeout have already been counted.
+            if isinstance(result, Failure):
+                self.publish_metric("%s.errors" % (handler,), 1, SUM)
+            timeout.cancel()
+            d.callback(None)
+
+    def _handler_finished(self, _result, work):
+        self.handlers_in_progress.discard(work)
+        self.handler_semaphore.release()
+
+    def wait_for_handlers(self):
+        """
+        Return a deferred that fires once the handlers that are currently
+        running have finished (including any that have timed out).
+        """
+        return DeferredList(list(self.handlers_in_progress))
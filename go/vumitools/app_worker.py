@@ -378,6 +378,11 @@ class GoApplicationMixin(GoWorkerMixin):
         conv.set_status_stopped()
         yield conv.save()
 
+    def process_command_archive(self, user_account_key, conversation_key):
+        # By default, there's nothing to clean up when a conversation is
+        # archived.
+        pass
+
     @inlineCallbacks
     def process_command_send_message(self, user_account_key, conversation_key,
                                      command_data, **kwargs):
@@ -0,0 +1,42 @@
+from vumi.persist.model import ModelMigrator
+
+
+# NOTE: This module must not import anything from Vumi Go at the top level.
+#       If individual migrators need such modules, they can import them in
+#       their own scope.
+
+
+def surname_initial(surname):
+    """Return the value stored in a contact's indexed `surname_initial`
+    field for the given surname.
+
+    Riak index values are bytestrings, so initials outside ASCII are
+    escaped.
+    """
+    if not surname:
+        return None
+    return surname[0].lower().encode('unicode_escape').decode('ascii')
+
+
+class ContactMigrator(ModelMigrator):
+
+    def migrate_from_unversioned(self, mdata):
+        # Copy stuff that hasn't changed between versions
+        mdata.copy_values('msisdn', 'created_at')
+        mdata.copy_dynamic_values('extras-', 'subscription-')
+        mdata.copy_indexes('user_account_bin', 'groups_bin')
+        # Set values for possible ancient index-only fields.
+        mdata.set_value('user_account', mdata.new_index['user_account_bin'][0])
+        mdata.set_value('groups', mdata.new_index['groups_bin'])
+        # Older contacts may not have all the optional fields.
+        for field in ['name', 'surname', 'email_address', 'dob',
+                      'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id']:
+            mdata.set_value(field, mdata.old_data.get(field, None))
+
+        # Add stuff that's new in this version
+        mdata.set_value('$VERSION', 1)
+        mdata.set_value(
+            'surname_initial', surname_initial(mdata.new_data['surname']),
+            index='surname_initial_bin')
+
+        return mdata
@@ -11,6 +11,7 @@ from vumi.persist.fields import (Unicode, ManyToMany, ForeignKey, Timestamp,
 
 from go.vumitools.account import UserAccount, PerAccountStore
 from go.vumitools.opt_out import OptOutStore
+from go.vumitools.contact.migrators import ContactMigrator, surname_initial
 
 
 class ContactError(Exception):
@@ -44,6 +45,10 @@ class ContactGroup(Model):
 
 class Contact(Model):
     """A contact"""
+
+    VERSION = 1
+    MIGRATOR = ContactMigrator
+
     # key is UUID
     user_account = ForeignKey(UserAccount)
     name = Unicode(max_length=255, null=True)
@@ -59,6 +64,13 @@ class Contact(Model):
     groups = ManyToMany(ContactGroup)
     extra = Dynamic(prefix='extras-')
     subscription = Dynamic(prefix='subscription-')
+    # Lower-cased (and escaped) first letter of the surname, kept up to date
+    # on save so that contacts can be filtered by surname using an index.
+    surname_initial = Unicode(max_length=10, null=True, index=True)
+
+    def save(self):
+        self.surname_initial = surname_initial(self.surname)
+        return super(Contact, self).save()
 
     def add_to_group(self, group):
         if isinstance(group, ContactGroup):
@@ -91,7 +103,8 @@ class Contact(Model):
 
 
 class ContactStore(PerAccountStore):
-    NONSETTABLE_CONTACT_FIELDS = ['$VERSION', 'user_account']
+    NONSETTABLE_CONTACT_FIELDS = [
+        '$VERSION', 'user_account', 'surname_initial']
 
     def setup_proxies(self):
         self.contacts = self.manager.proxy(Contact)
@@ -209,39 +222,26 @@ class ContactStore(PerAccountStore):
 
     @Manager.calls_manager
     def filter_contacts_on_surname(self, letter, group=None):
-        # FIXME: This does a mapreduce over a bucket, which means hitting every
-        #        key in riak.
-        # TODO: vumi.persist needs to have better ways of supporting
-        #       generic map reduce functions. There's a bunch of boilerplate
-        #       around getting bucket names and indexes that I'm doing
-        #       manually that could be automated.
-        mr = self.manager.riak_map_reduce()
-        bucket = self.manager.bucket_name(Contact)
-        mr.add_bucket(bucket)
+        """
+        Return the contacts whose surname starts with `letter`, optionally
+        limited to the members of `group`.
+
+        This uses the `surname_initial` index, so contacts saved before the
+        index existed need to be migrated with the `go_migrate_contacts`
+        command before they are found.
+        """
+        initial = surname_initial(letter)
+        if initial is None:
+            returnValue([])
+
+        keys = yield self.contacts.index_keys('surname_initial', initial)
         if group is not None:
-            mr.index(bucket, 'groups_bin', group.key)
-        # Deleted values hang around with tombstone markers in Riak for a while
-        # before they get removed, and this happens a lot in tests. We need to
-        # find the real values amongst the deleted ones here.
-        # TODO: Make this a general thing?
-        js_function = """function(value, keyData, arg){
-            for (i in value.values) {
-                var val = value.values[i]
-                if (!val.metadata['X-Riak-Deleted']) {
-                    var data = JSON.parse(val.data);
-                    if (data.surname) {
-                        if (data.surname.toLowerCase()[0] === arg) {
-                            return [[value.key, val]];
-                        }
-                    }
-                }
-            }
-            return [];
-        }"""
-        mr.map(js_function, {'arg': letter.lower()})
-        contacts = yield self.manager.run_map_reduce(mr,
-            lambda manager, result: Contact.load(
-                manager, result[0], result[1]))
+            group_keys = yield self.contacts.index_keys('groups', group.key)
+            keys = list(set(keys).intersection(group_keys))
+
+        contacts = []
+        for contacts_bunch in self.contacts.load_all_bunches(keys):
+            contacts.extend((yield contacts_bunch))
         returnValue(contacts)
 
     def list_contacts(self):
@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from vumi.persist.model import Model
+from vumi.persist.fields import (
+    Unicode, ManyToMany, ForeignKey, Timestamp, Dynamic)
+
+from go.vumitools.account import UserAccount
+from go.vumitools.contact.models import ContactGroup
+from go.vumitools.contact.migrators import ContactMigrator
+
+
+class ContactVNone(Model):
+    """A contact"""
+
+    MIGRATOR = ContactMigrator
+
+    bucket = 'contact'
+
+    # key is UUID
+    user_account = ForeignKey(UserAccount)
+    name = Unicode(max_length=255, null=True)
+    surname = Unicode(max_length=255, null=True)
+    email_address = Unicode(null=True)  # EmailField?
+    msisdn = Unicode(max_length=255)
+    dob = Timestamp(null=True)
+    twitter_handle = Unicode(max_length=100, null=True)
+    facebook_id = Unicode(max_length=100, null=True)
+    bbm_pin = Unicode(max_length=100, null=True)
+    gtalk_id = Unicode(null=True)
+    created_at = Timestamp(default=datetime.utcnow)
+    groups = ManyToMany(ContactGroup)
+    extra = Dynamic(prefix='extras-')
+    subscription = Dynamic(prefix='subscription-')
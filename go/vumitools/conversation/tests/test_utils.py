@@ -329,7 +329,7 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
     @inlineCallbacks
     def test_get_opted_in_contact_bunches(self):
         contact_store = self.user_api.contact_store
-        opt_out_store = OptOutStore.from_user_account(self.user)
+        opt_out_store = self.user_api.optout_store
 
         @inlineCallbacks
         def get_contacts():
@@ -370,6 +370,95 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
             ['+27000000001'],
             (yield get_contacts()))
 
+        yield opt_out_store.delete_opt_out(u'msisdn', contact2.msisdn)
+
+        self.assertEqual(
+            set(['+27000000001', '+27000000002']),
+            set((yield get_contacts())))
+
+    @inlineCallbacks
+    def test_get_opted_in_contact_bunches_existing_opt_outs(self):
+        # Opt-outs stored before the Redis opt-out set existed are picked up
+        # when the set is built.
+        riak_only_store = OptOutStore.from_user_account(self.user)
+        yield riak_only_store.new_opt_out(u'msisdn', u'+27000000002', {
+            'message_id': u'some-message-id',
+        })
+
+        group = yield self.user_api.contact_store.new_group(u'a group')
+        self.conv.add_group(group)
+        yield self.conv.save()
+        for msisdn in [u'+27000000001', u'+27000000002']:
+            yield self.user_api.contact_store.new_contact(
+                msisdn=msisdn, groups=[group])
+
+        contacts = []
+        for bunch in (yield self.conv.get_opted_in_contact_bunches(
+                self.conv.delivery_class)):
+            contacts.extend((yield bunch))
+        self.assertEqual([c.msisdn for c in contacts], [u'+27000000001'])
+
+    @inlineCallbacks
+    def test_rebuild_opt_out_sets(self):
+        opt_out_store = self.user_api.optout_store
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000001', {})
+        self.assertEqual(
+            (yield opt_out_store.get_opt_out_set(u'msisdn')), set())
+
+        yield opt_out_store.rebuild_opt_out_sets()
+        old_generation = yield opt_out_store.get_opt_out_set_generation()
+        self.assertEqual(
+            (yield opt_out_store.get_opt_out_set(u'msisdn')),
+            set([u'+27000000001']))
+
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000002', {})
+        yield opt_out_store.rebuild_opt_out_sets()
+        self.assertNotEqual(
+            (yield opt_out_store.get_opt_out_set_generation()),
+            old_generation)
+        self.assertEqual(
+            (yield opt_out_store.get_opt_out_set(u'msisdn')),
+            set([u'+27000000001', u'+27000000002']))
+
+        # Readers that looked up the old generation before it changed can
+        # still use its sets for a while.
+        old_key = opt_out_store.opt_out_set_key(old_generation, u'msisdn')
+        self.assertEqual(
+            (yield opt_out_store.redis.smembers(old_key)),
+            set([u'+27000000001', u'+27000000002']))
+        self.assertTrue((yield opt_out_store.redis.ttl(old_key)) > 0)
+
+    @inlineCallbacks
+    def test_rebuild_opt_out_sets_with_concurrent_changes(self):
+        opt_out_store = self.user_api.optout_store
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000001', {})
+        yield opt_out_store.rebuild_opt_out_sets()
+        list_opt_outs = opt_out_store.list_opt_outs
+
+        @inlineCallbacks
+        def list_and_change_opt_outs():
+            keys = yield list_opt_outs()
+            # These happen after the rebuild has listed the opt-outs but
+            # before it makes the new generation current.
+            yield opt_out_store.new_opt_out(u'msisdn', u'+27000000002', {})
+            yield opt_out_store.new_opt_out(u'gtalk', u'foo@example.com', {})
+            yield opt_out_store.delete_opt_out(u'msisdn', u'+27000000001')
+            returnValue(keys)
+
+        self.patch(opt_out_store, 'list_opt_outs', list_and_change_opt_outs)
+        yield opt_out_store.rebuild_opt_out_sets()
+        self.assertEqual(
+            (yield opt_out_store.get_opt_out_set(u'msisdn')),
+            set([u'+27000000002']))
+        self.assertEqual(
+            (yield opt_out_store.get_opt_out_set(u'gtalk')),
+            set([u'foo@example.com']))
+        generation = yield opt_out_store.get_opt_out_set_generation()
+        self.assertEqual(
+            (yield opt_out_store.redis.smembers(
+                opt_out_store.opt_out_set_types_key(generation))),
+            set([u'msisdn', u'gtalk']))
+
     @inlineCallbacks
     def test_get_inbound_throughput(self):
         yield self.conv.start()
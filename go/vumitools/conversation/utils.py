@@ -8,7 +8,6 @@ from twisted.internet.defer import returnValue
 
 from vumi.persist.model import Manager
 
-from go.vumitools.opt_out import OptOutStore
 from go.vumitools.utils import MessageMetadataHelper
 from go.vumitools.account import RoutingTableHelper, GoConnector
 
@@ -40,6 +39,9 @@ class ConversationWrapper(object):
         yield self.c.save()
         yield self._remove_from_routing_table()
         yield self._release_batches()
+        yield self.dispatch_command('archive',
+                                    user_account_key=self.c.user_account.key,
+                                    conversation_key=self.c.key)
 
     def _release_batches(self):
         return self.mdb.batch_done(self.batch.key)
@@ -83,12 +85,12 @@ class ConversationWrapper(object):
         if self._channels is not None:
             returnValue(self._channels)
         user_account = yield self.c.user_account.get(self.api.manager)
-        routing_table = yield self.user_api.get_routing_table(user_account)
-        rt_helper = RoutingTableHelper(routing_table)
+        routing_table = yield self.user_api.get_compiled_routing_table(
+            user_account)
         conn = GoConnector.for_conversation(
             self.conversation_type, self.key)
-        incoming = rt_helper.transitive_sources(str(conn))
-        outbound = rt_helper.transitive_targets(str(conn))
+        incoming = routing_table.transitive_sources(str(conn))
+        outbound = routing_table.transitive_targets(str(conn))
         connectors = incoming | outbound
         go_connectors = [GoConnector.parse(s) for s in connectors]
         channels = []
@@ -197,7 +199,7 @@ class ConversationWrapper(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         rt_helper = RoutingTableHelper(routing_table)
         rt_helper.remove_conversation(self.c)
-        yield user_account.save()
+        yield self.user_api.save_routing_table(user_account)
 
     @Manager.calls_manager
     def send_token_url(self, token_url, msisdn):
@@ -577,13 +579,9 @@ class ConversationWrapper(object):
         # TODO: Less hacky address type handling.
         address_type = 'gtalk' if delivery_class == 'gtalk' else 'msisdn'
         contacts = yield contacts
-        opt_out_store = OptOutStore(
-            self.api.manager, self.user_api.user_account_key)
-
         addresses = self.get_contacts_addresses(contacts)
-        opt_out_keys = yield opt_out_store.opt_outs_for_addresses(
+        opted_out_addrs = yield self.user_api.optout_store.opted_out_addresses(
             address_type, addresses)
-        opted_out_addrs = set(key.split(':')[1] for key in opt_out_keys)
 
         filtered_contacts = []
         for contact in contacts:
@@ -593,14 +591,18 @@ class ConversationWrapper(object):
         returnValue(filtered_contacts)
 
     @Manager.calls_manager
-    def get_opted_in_contact_bunches(self, delivery_class):
+    def get_opted_in_contact_bunches(self, delivery_class, contact_keys=None):
         """
         Get a generator that produces batches the contacts with
         an address attribute that is appropriate for the conversation's
         delivery_class and that are opted in.
+
+        If `contact_keys` is given, only those contacts are loaded instead
+        of all the contacts for this conversation.
         """
         contact_store = self.user_api.contact_store
-        contact_keys = yield self.get_contact_keys()
+        if contact_keys is None:
+            contact_keys = yield self.get_contact_keys()
         contacts_iter = yield contact_store.contacts.load_all_bunches(
             contact_keys)
 
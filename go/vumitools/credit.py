@@ -7,6 +7,31 @@ from twisted.internet.defer import returnValue
 from vumi.persist.redis_base import Manager
 
 
+class CreditReservation(object):
+    """Credit that has been debited from an account in advance.
+
+    Reserved credit is handed out locally by :meth:`take` without touching
+    Redis. Whatever is left over must be returned to the account with
+    :meth:`CreditManager.settle`.
+    """
+
+    def __init__(self, user_account_key, amount):
+        self.user_account_key = user_account_key
+        self.amount = amount
+        self.remaining = amount
+
+    def take(self, amount):
+        """Use `amount` credits from this reservation.
+
+        :returns:
+            True if the reservation had enough credit left, False otherwise.
+        """
+        if amount > self.remaining:
+            return False
+        self.remaining -= amount
+        return True
+
+
 class CreditManager(object):
     def __init__(self, redis):
         self.redis = redis
@@ -43,5 +68,29 @@ class CreditManager(object):
             yield self.redis.incr(credit_key, amount)
         returnValue(success)
 
+    @Manager.calls_manager
+    def reserve(self, user_account_key, amount):
+        """Debit an amount of credits to be handed out later.
+
+        This allows a sender to pay for many messages with a single Redis
+        call and settle the difference afterwards.
+
+        :returns:
+            A :class:`CreditReservation` for the reserved amount or None if
+            the account has insufficient credit.
+        """
+        success = yield self.debit(user_account_key, amount)
+        if not success:
+            returnValue(None)
+        returnValue(CreditReservation(user_account_key, amount))
+
+    @Manager.calls_manager
+    def settle(self, reservation):
+        """Return the unused part of a reservation to its account."""
+        unused, reservation.remaining = reservation.remaining, 0
+        if unused > 0:
+            yield self.credit(reservation.user_account_key, unused)
+        returnValue(unused)
+
     def _credit_key(self, user_account_key):
         return ":".join(["credits", user_account_key])
@@ -0,0 +1,59 @@
+# -*- test-case-name: go.vumitools.tests.test_event_handler_cache -*-
+
+"""In-process caching of event handler configs.
+
+The event dispatcher needs an account's event handler config for every
+event it handles. These live in Riak and change rarely, so we keep copies
+in memory and only reload them when they expire or when a generation
+counter in Redis tells us that something has changed.
+
+Anything that changes an account's event handler config must call
+:meth:`EventHandlerConfigCache.invalidate_event_handler_config` so that
+every process holding a cached copy notices the change on its next lookup.
+"""
+
+from go.vumitools.lru import LRUCache
+from go.vumitools.routing_cache import GenerationCache
+
+
+class EventHandlerConfigCache(GenerationCache):
+    """Cache of event handler configs with Redis invalidation.
+
+    See :class:`go.vumitools.routing_cache.GenerationCache` for the
+    constructor parameters.
+    """
+
+    def __init__(self, redis, ttl=None, max_size=None, metric_callback=None):
+        super(EventHandlerConfigCache, self).__init__(
+            redis, ttl=ttl, max_size=max_size,
+            metric_callback=metric_callback)
+        self._event_handler_configs = LRUCache(max_size)
+
+    def _event_handler_config_key(self, user_account_key):
+        return ":".join(["event_handler_config", user_account_key])
+
+    def get_event_handler_config(self, user_account_key, loader):
+        """Return the cached event handler config for an account.
+
+        :param str user_account_key:
+            The account to return the event handler config for.
+        :param loader:
+            Callable returning the event handler config (or a deferred that
+            fires with it) that is called when there is no usable cached
+            copy.
+        """
+        return self._cached_lookup(
+            self._event_handler_configs, user_account_key,
+            self._event_handler_config_key(user_account_key),
+            "event_handler_config", loader)
+
+    def invalidate_event_handler_config(self, user_account_key):
+        """Invalidate all cached copies of an account's event handler
+        config."""
+        self._event_handler_configs.pop(user_account_key, None)
+        return self.redis.incr(
+            self._event_handler_config_key(user_account_key))
+
+    def clear(self):
+        """Discard everything cached in this process."""
+        self._event_handler_configs.clear()
@@ -0,0 +1,158 @@
+# -*- test-case-name: go.vumitools.tests.test_keyword_matcher -*-
+# -*- coding: utf-8 -*-
+
+"""Matching the first word of a message against a set of keywords.
+
+Keyword routers and applications need to find the things (endpoints,
+handlers, etc.) configured for the first word of every message they
+receive. Rather than comparing that word with each configured keyword in
+turn, a :class:`KeywordMatcher` builds a dict of normalised keywords once
+so that each lookup is a single dict access, and a
+:class:`KeywordMatcherCache` keeps matchers around for as long as the
+config they were built from doesn't change.
+"""
+
+import json
+import hashlib
+import unicodedata
+
+from go.vumitools.lru import LRUCache
+
+
+def normalise_keyword(word, strip_punctuation=False):
+    """
+    Return the normalised form of `word` used for matching.
+
+    Keywords are matched case-insensitively and, if `strip_punctuation` is
+    ``True``, any punctuation at the start or end of the word is ignored
+    (so that ``"STOP!"`` matches ``"stop"``, for example).
+    """
+    if isinstance(word, str):
+        word = word.decode('utf-8', 'replace')
+    word = word.lower()
+    if strip_punctuation:
+        start, end = 0, len(word)
+        while start < end and _is_punctuation(word[start]):
+            start += 1
+        while end > start and _is_punctuation(word[end - 1]):
+            end -= 1
+        word = word[start:end]
+    return word
+
+
+def _is_punctuation(char):
+    return unicodedata.category(char).startswith('P')
+
+
+def config_fingerprint(config):
+    """
+    Return a short string that changes whenever `config` (which must be
+    JSON serialisable) does.
+
+    Serialising and hashing the config is done in C, so this is a lot
+    cheaper than building a list of keywords from the config in Python and
+    comparing it with another one.
+    """
+    return hashlib.md5(json.dumps(config, sort_keys=True)).hexdigest()
+
+
+def model_fingerprint(modelobj, config):
+    """
+    Return a short string that changes whenever `modelobj` is saved, for
+    caching things built from `config` (which must belong to `modelobj`).
+
+    This is the Riak vclock the object was loaded with, so unlike
+    :func:`config_fingerprint` it costs the same however big the config
+    is. Objects that haven't been stored have no vclock, so we fall back to
+    fingerprinting their config.
+    """
+    vclock = modelobj._riak_object.vclock()
+    if vclock is None:
+        return config_fingerprint(config)
+    return vclock
+
+
+def first_word(content):
+    return ((content or '').strip().split() + [''])[0]
+
+
+class KeywordMatcher(object):
+    """
+    Lookup table from keywords to the values configured for them.
+
+    :param keywords:
+        List of ``(keyword, value)`` pairs. More than one value may be
+        configured for the same keyword, in which case they're all returned
+        in the order they're listed in.
+    :param bool strip_punctuation:
+        Ignore punctuation at the start and end of keywords and words.
+    """
+
+    def __init__(self, keywords, strip_punctuation=False):
+        self.strip_punctuation = strip_punctuation
+        self._table = {}
+        for keyword, value in keywords:
+            self._table.setdefault(
+                self.normalise(keyword), []).append(value)
+
+    def normalise(self, word):
+        return normalise_keyword(word, self.strip_punctuation)
+
+    def match(self, content):
+        """
+        Return the list of values for the first word of `content`.
+        """
+        return list(self._table.get(self.normalise(first_word(content)), []))
+
+    def match_first(self, content, default=None):
+        """
+        Return the first value for the first word of `content`, or
+        `default` if there isn't one.
+        """
+        values = self._table.get(self.normalise(first_word(content)))
+        return values[0] if values else default
+
+
+class KeywordMatcherCache(object):
+    """
+    Cache of :class:`KeywordMatcher` objects for routers or conversations.
+
+    Each matcher is cached along with a fingerprint of the config it was
+    built from (see :func:`model_fingerprint`) and the options it was built
+    with. A cached matcher is only used if it's asked for with the same
+    fingerprint and options, so a matcher is rebuilt as soon as its router
+    or conversation config changes, but the keywords don't need to be
+    listed or compared when it hasn't.
+
+    :param int max_size:
+        Maximum number of matchers to keep. The least recently used matcher
+        is dropped to make room for a new one.
+    """
+
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self._matchers = LRUCache(self.max_size)
+
+    def get_matcher(self, key, fingerprint, get_keywords, **options):
+        """
+        Return a matcher for the config with the given `fingerprint`,
+        building one if the matcher cached under `key` was built from a
+        different config or with different options.
+
+        :param callable get_keywords:
+            Called with no arguments to get the list of
+            ``(keyword, value)`` pairs when a matcher needs to be built.
+
+        Options are passed through to :class:`KeywordMatcher`.
+        """
+        cached = self._matchers.get(key)
+        if cached is not None and cached[:2] == (fingerprint, options):
+            return cached[2]
+        matcher = KeywordMatcher(get_keywords(), **options)
+        self._matchers[key] = (fingerprint, options, matcher)
+        return matcher
+
+    def clear(self):
+        self._matchers.clear()
@@ -0,0 +1,113 @@
+# -*- test-case-name: go.vumitools.tests.test_lru -*-
+
+"""A mapping that forgets its least recently used items.
+
+We still support Python 2.6, which doesn't have
+:class:`collections.OrderedDict`, so the order items were used in is kept
+in a deque alongside a plain dict.
+"""
+
+from collections import deque
+
+
+class LRUCache(object):
+    """
+    Mapping that keeps track of the order its keys were last set or looked
+    up in.
+
+    Setting or looking up a key makes it the most recently used key.
+    Removing a key doesn't need to search the usage order, because entries
+    in the order that no longer match the dict are skipped (and eventually
+    discarded) instead.
+
+    :param int max_size:
+        Maximum number of items to keep. The least recently used items are
+        dropped to make room for new ones. If ``None``, the number of items
+        isn't limited.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._data = {}
+        self._order = deque()
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        _tick, value = self._data[key]
+        self._touch(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._touch(key, value)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self.popoldest()
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        return self[key]
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def keys(self):
+        """
+        Return the keys, least recently used first.
+        """
+        return [key for tick, key in self._order
+                if self._data.get(key, (None,))[0] == tick]
+
+    def clear(self):
+        self._data.clear()
+        self._order.clear()
+
+    def oldest(self):
+        """
+        Return the least recently used ``(key, value)`` pair, or ``None``
+        if there are no items.
+        """
+        self._discard_stale()
+        if not self._order:
+            return None
+        _tick, key = self._order[0]
+        return key, self._data[key][1]
+
+    def popoldest(self):
+        """
+        Remove and return the least recently used ``(key, value)`` pair, or
+        ``None`` if there are no items.
+        """
+        item = self.oldest()
+        if item is not None:
+            del self._data[item[0]]
+        return item
+
+    def _touch(self, key, value):
+        self._tick += 1
+        self._data[key] = (self._tick, value)
+        self._order.append((self._tick, key))
+        if len(self._order) > 2 * len(self._data) + 16:
+            # Too many of the entries are stale, so rebuild the order.
+            self._order = deque(sorted(
+                (tick, k) for k, (tick, _value) in self._data.iteritems()))
+
+    def _discard_stale(self):
+        while self._order:
+            tick, key = self._order[0]
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == tick:
+                return
+            self._order.popleft()
@@ -1,10 +1,16 @@
 # -*- test-case-name: go.vumitools.tests.test_metrics_worker -*-
 
-from twisted.internet.defer import inlineCallbacks
+import hashlib
+import random
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, DeferredSemaphore,
+    gatherResults)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
 from vumi.service import Worker
+from vumi.blinkenlights.metrics import MetricManager, Metric, MAX
 
 from go.vumitools.api import VumiApi, VumiApiCommand
 
@@ -16,6 +22,31 @@ class GoMetricsWorker(Worker):
     collection and sending commands to the relevant application workers to
     trigger the actual metrics.
 
+    Multiple instances of this worker may be run by giving each a distinct
+    ``shard_index`` and the same ``shard_count``. Accounts are divided
+    between the shards using rendezvous hashing, so changing the number of
+    shards only moves the accounts that need to move.
+
+    Configuration options:
+
+    :param int metrics_interval:
+        Seconds between metrics collection runs. Default 300.
+    :param int metrics_concurrency:
+        Maximum number of accounts to find running conversations for at the
+        same time. Default 10.
+    :param float metrics_spread:
+        Fraction of ``metrics_interval`` over which the `collect_metrics`
+        commands are spread (at random) rather than sent in a single burst.
+        This should be less than 1, so that the commands for one run are
+        sent before the next run starts. Set to 0 to send all commands
+        immediately. Default 0.
+    :param int shard_index:
+        The shard this worker is responsible for. Default 0.
+    :param int shard_count:
+        The total number of shards. Default 1.
+    :param str metrics_prefix:
+        Prefix for the metrics this worker publishes about itself.
+        Default ``go.metrics_worker.``.
     """
 
     worker_name = 'go_metrics'
@@ -30,41 +61,112 @@ class GoMetricsWorker(Worker):
         self.command_publisher = yield self.publish_to(
             self.api_routing_config['routing_key'])
 
+        self.metrics = yield self.start_publisher(
+            MetricManager, self.metrics_prefix)
+        self.loop_duration_metric = self.metrics.register(
+            Metric('loop_duration', [MAX]))
+
+        self._pending_commands = set()
         self._looper = LoopingCall(self.metrics_loop_func)
         self._looper.start(self.metrics_interval)
 
     def stopWorker(self):
         if self._looper.running:
             self._looper.stop()
+        for delayed_call in self._pending_commands:
+            delayed_call.cancel()
+        self._pending_commands.clear()
+        self.metrics.stop()
         return self.redis.close_manager()
 
     def validate_config(self):
         self.metrics_interval = int(self.config.get('metrics_interval', 300))
+        self.metrics_concurrency = int(
+            self.config.get('metrics_concurrency', 10))
+        self.metrics_spread = float(self.config.get('metrics_spread', 0))
+        self.shard_index = int(self.config.get('shard_index', 0))
+        self.shard_count = int(self.config.get('shard_count', 1))
+        self.metrics_prefix = self.config.get(
+            'metrics_prefix', 'go.metrics_worker.')
         self.api_routing_config = VumiApiCommand.default_routing_config()
         self.api_routing_config.update(self.config.get('api_routing', {}))
 
     @inlineCallbacks
     def metrics_loop_func(self):
+        clock = self._looper.clock
+        start = clock.seconds()
+
         account_keys = yield self.find_account_keys()
-        conversations = []
-        # We deliberarely serialise this. We don't want to hit the datastore
-        # too hard for metrics.
-        for account_key in account_keys:
-            convs = yield self.find_conversations_for_account(account_key)
-            conversations.extend(convs)
+        account_keys = [key for key in account_keys
+                        if self.shard_for_account(key) == self.shard_index]
+        conversations = yield self.find_conversations_for_accounts(
+            account_keys)
         log.info(
             "Processing metrics for %s conversations owned by %s users." % (
                 len(conversations), len(account_keys)))
-        for conversation in conversations:
-            yield self.send_metrics_command(conversation)
+        yield self.send_metrics_commands(conversations)
+
+        duration = clock.seconds() - start
+        self.loop_duration_metric.set(duration)
+        if duration > self.metrics_interval:
+            log.warning(
+                "Metrics collection took %.1fs, longer than the metrics"
+                " interval of %ss." % (duration, self.metrics_interval))
 
     def find_account_keys(self):
         return self.redis.smembers('metrics_accounts')
 
+    def shard_for_account(self, account_key):
+        """Return the shard responsible for the given account.
+        """
+        def weight(shard):
+            return hashlib.md5('%s:%s' % (shard, account_key)).hexdigest()
+        return max(range(self.shard_count), key=weight)
+
     def find_conversations_for_account(self, account_key):
         user_api = self.vumi_api.get_user_api(account_key)
         return user_api.running_conversations()
 
+    @inlineCallbacks
+    def find_conversations_for_accounts(self, account_keys):
+        # We limit the number of accounts we look at concurrently so that we
+        # don't hit the datastore too hard for metrics.
+        semaphore = DeferredSemaphore(self.metrics_concurrency)
+        results = yield gatherResults([
+            semaphore.run(self.find_conversations_for_account, account_key)
+            for account_key in account_keys])
+        conversations = []
+        for convs in results:
+            conversations.extend(convs)
+        returnValue(conversations)
+
+    @inlineCallbacks
+    def send_metrics_commands(self, conversations):
+        """Send `collect_metrics` commands for the given conversations.
+
+        If ``metrics_spread`` is set, each command is scheduled to be sent
+        after a random delay so that the application workers aren't all
+        asked to collect their metrics at the same time.
+        """
+        max_delay = self.metrics_interval * self.metrics_spread
+        for conversation in conversations:
+            if max_delay > 0:
+                self.schedule_metrics_command(
+                    random.uniform(0, max_delay), conversation)
+            else:
+                yield self.send_metrics_command(conversation)
+
+    def schedule_metrics_command(self, delay, conversation):
+        def send():
+            self._pending_commands.discard(delayed_call)
+            d = maybeDeferred(self.send_metrics_command, conversation)
+            d.addErrback(lambda f: log.err(
+                f, "Error sending metrics command for conversation %s." % (
+                    conversation.key,)))
+
+        delayed_call = self._looper.clock.callLater(delay, send)
+        self._pending_commands.add(delayed_call)
+
     def send_metrics_command(self, conversation):
         cmd = VumiApiCommand.command(
             conversation.conversation_type, 'collect_metrics',
@@ -1,8 +1,10 @@
 # -*- test-case-name: go.vumitools.tests.test_middleware -*-
 import sys
 import time
+from collections import deque
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.middleware.base import TransportMiddleware, BaseMiddleware
@@ -14,6 +16,8 @@ from vumi.persist.txredis_manager import TxRedisManager
 from vumi.errors import ConfigError
 
 from go.vumitools.credit import CreditManager
+from go.vumitools.lru import LRUCache
+from go.vumitools.tagpool_cache import TagpoolMetadataCache
 
 
 class NormalizeMsisdnMiddleware(TransportMiddleware):
@@ -77,7 +81,8 @@ class OptOutMiddleware(BaseMiddleware):
         optout_disabled = False
         tag = TaggingMiddleware.map_msg_to_tag(message)
         if tag is not None:
-            tagpool_metadata = yield self.vumi_api.tpm.get_metadata(tag[0])
+            tagpool_metadata = yield self.vumi_api.tagpool_cache.get_metadata(
+                tag[0])
             optout_disabled = tagpool_metadata.get(
                 'disable_global_opt_out', False)
         keyword = (message['content'] or '').strip()
@@ -97,32 +102,125 @@ class OptOutMiddleware(BaseMiddleware):
 
 
 class DebitAccountMiddleware(TransportMiddleware):
+    """
+    Middleware that debits a user account's credit for each outbound
+    message based on the `credits_per_message` of the message's tag pool.
+
+    :param dict redis_manager:
+        Connection configuration details for Redis.
+    :param dict tagpool_manager:
+        Optional `tagpool_prefix` for the tagpool store. Defaults to
+        `tagpool_store`.
+    :param dict credit_manager:
+        Optional `credit_prefix` for the credit store. Defaults to
+        `credit_store`.
+    :param int credits_per_message_ttl:
+        Number of seconds to cache each tag pool's metadata (and hence its
+        `credits_per_message`) for. Defaults to 300.
+    :param int reservation_size:
+        If greater than zero, credit for this many messages is reserved
+        from an account at a time and handed out locally so that only one
+        Redis call is needed per `reservation_size` messages. Unused credit
+        is returned when the account stops sending. Defaults to 0 (each
+        message is debited individually).
+    :param int reservation_idle_timeout:
+        Number of seconds an account may go without sending before its
+        unused reserved credit is returned. Defaults to 60.
+    """
 
+    @inlineCallbacks
     def setup_middleware(self):
-        # TODO: There really needs to be a helper function to
-        #       turn this config into managers.
-        from go.vumitools.api import get_redis
-        r_server = get_redis(self.config)
+        self.redis = yield TxRedisManager.from_config(
+            self.config.get('redis_manager', {}))
         tpm_config = self.config.get('tagpool_manager', {})
         tpm_prefix = tpm_config.get('tagpool_prefix', 'tagpool_store')
-        self.tpm = TagpoolManager(r_server, tpm_prefix)
+        self.tpm = TagpoolManager(self.redis.sub_manager(tpm_prefix))
         cm_config = self.config.get('credit_manager', {})
         cm_prefix = cm_config.get('credit_prefix', 'credit_store')
-        self.cm = CreditManager(r_server, cm_prefix)
+        self.cm = CreditManager(self.redis.sub_manager(cm_prefix))
+
+        self.tagpool_cache = TagpoolMetadataCache(
+            self.tpm, ttl=int(self.config.get(
+                'credits_per_message_ttl', TagpoolMetadataCache.DEFAULT_TTL)))
+        self.reservation_size = int(self.config.get('reservation_size', 0))
+        self.reservation_idle_timeout = int(
+            self.config.get('reservation_idle_timeout', 60))
+        self._reservations = {}
+        self._reservation_last_used = {}
+        self._settle_looper = None
+        if self.reservation_size > 0:
+            self._settle_looper = LoopingCall(self.settle_idle_reservations)
+            self._settle_looper.start(
+                self.reservation_idle_timeout, now=False)
+
+    @inlineCallbacks
+    def teardown_middleware(self):
+        if self._settle_looper is not None and self._settle_looper.running:
+            self._settle_looper.stop()
+        yield self.settle_reservations(self._reservations.keys())
 
+    @inlineCallbacks
     def _credits_per_message(self, pool):
-        tagpool_metadata = self.tpm.get_metadata(pool)
+        tagpool_metadata = yield self.tagpool_cache.get_metadata(pool)
         credits_per_message = tagpool_metadata.get('credits_per_message')
         try:
             credits_per_message = int(credits_per_message)
             assert credits_per_message >= 0
         except Exception:
             exc_tb = sys.exc_info()[2]
-            raise (BadTagPool,
-                   BadTagPool("Invalid credits_per_message for pool %r"
-                              % (pool,)),
-                   exc_tb)
-        return credits_per_message
+            raise BadTagPool, BadTagPool(
+                "Invalid credits_per_message for pool %r" % (pool,)), exc_tb
+        returnValue(credits_per_message)
+
+    def _debit_account(self, user_account_key, credits_per_message):
+        if self.reservation_size > 0:
+            return self._debit_reservation(
+                user_account_key, credits_per_message)
+        return self.cm.debit(user_account_key, credits_per_message)
+
+    @inlineCallbacks
+    def _debit_reservation(self, user_account_key, credits_per_message):
+        self._reservation_last_used[user_account_key] = time.time()
+        reservation = self._reservations.get(user_account_key)
+        if reservation is not None and reservation.take(credits_per_message):
+            returnValue(True)
+
+        yield self.settle_reservations([user_account_key])
+        reservation = yield self.cm.reserve(
+            user_account_key, credits_per_message * self.reservation_size)
+        if reservation is None:
+            # There isn't enough credit for a full reservation, so we pay
+            # for this message on its own.
+            success = yield self.cm.debit(
+                user_account_key, credits_per_message)
+            returnValue(success)
+
+        reservation.take(credits_per_message)
+        # Another message may have made a reservation while we were
+        # waiting for ours.
+        yield self.settle_reservations([user_account_key])
+        self._reservations[user_account_key] = reservation
+        returnValue(True)
+
+    @inlineCallbacks
+    def settle_reservations(self, user_account_keys):
+        """Return unused reserved credit to the given accounts."""
+        for user_account_key in user_account_keys:
+            reservation = self._reservations.pop(user_account_key, None)
+            if reservation is not None:
+                yield self.cm.settle(reservation)
+
+    def settle_idle_reservations(self):
+        """Return unused reserved credit to accounts that have not sent a
+        message for `reservation_idle_timeout` seconds.
+        """
+        idle_since = time.time() - self.reservation_idle_timeout
+        idle_keys = [key for key, last_used
+                     in self._reservation_last_used.items()
+                     if last_used <= idle_since]
+        for key in idle_keys:
+            del self._reservation_last_used[key]
+        return self.settle_reservations(idle_keys)
 
     @staticmethod
     def map_msg_to_user(msg):
@@ -151,6 +249,7 @@ class DebitAccountMiddleware(TransportMiddleware):
         go_metadata = helper_metadata.setdefault('go', {})
         go_metadata['user_account'] = user_account_key
 
+    @inlineCallbacks
     def handle_outbound(self, msg, endpoint):
         # TODO: what actually happens when we raise an exception from
         #       inside middleware?
@@ -160,14 +259,60 @@ class DebitAccountMiddleware(TransportMiddleware):
         tag = TaggingMiddleware.map_msg_to_tag(msg)
         if tag is None:
             raise NoTagError(msg)
-        credits_per_message = self._credits_per_message(tag[0])
-        self._debit_account(user_account_key, credits_per_message)
-        success = self.cm.debit(user_account_key, credits_per_message)
+        credits_per_message = yield self._credits_per_message(tag[0])
+        success = yield self._debit_account(
+            user_account_key, credits_per_message)
         if not success:
             raise InsufficientCredit("User %r has insufficient credit"
                                      " to debit %r." %
                                      (user_account_key, credits_per_message))
-        return msg
+        returnValue(msg)
+
+
+class ResponseTimeSamples(object):
+    """
+    Response times recorded for one transport over the last `window`
+    seconds, keeping at most `max_samples` of the most recent ones.
+    """
+
+    def __init__(self, window, max_samples=10000):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, value):
+        self.samples.append((time.time(), value))
+
+    def percentile(self, percent):
+        """
+        Return the given percentile of the current samples (using the
+        nearest-rank method) or `None` if there are no samples.
+        """
+        expiry = time.time() - self.window
+        while self.samples and self.samples[0][0] < expiry:
+            self.samples.popleft()
+        if not self.samples:
+            return None
+        values = sorted(value for _, value in self.samples)
+        rank = int(round(percent / 100.0 * len(values)))
+        return values[max(rank, 1) - 1]
+
+
+class PercentileMetric(Metric):
+    """
+    A metric that publishes a percentile of a set of response time samples
+    each time it is polled.
+    """
+
+    def __init__(self, name, samples, percent, aggregators=None):
+        super(PercentileMetric, self).__init__(name, aggregators)
+        self.samples = samples
+        self.percent = percent
+
+    def poll(self):
+        value = self.samples.percentile(self.percent)
+        if value is None:
+            return []
+        return [(int(time.time()), value)]
 
 
 class MetricsMiddleware(BaseMiddleware):
@@ -189,7 +334,27 @@ class MetricsMiddleware(BaseMiddleware):
         `transport_name` based average response time metrics. If a message is
         received its `message_id` is stored and when a reply for the given
         `message_id` is sent out, the timestamps are compared and a averaged
-        metric is published.
+        metric is published. Percentiles of the response times seen over the
+        last `percentile_window` seconds are published on
+        '<manager_name>.foo.<response_time_suffix>.p<percentile>'.
+    :param list percentiles:
+        The response time percentiles to publish. Defaults to
+        ``[50, 95, 99]``.
+    :param int percentile_window:
+        The number of seconds of response times that percentiles are
+        calculated over. Defaults to 300.
+    :param int max_response_time:
+        How long (in seconds) to keep an inbound message's timestamp while
+        waiting for a reply. Replies that take longer than this aren't
+        timed. Defaults to 3600.
+    :param bool local_response_times:
+        If `True`, inbound timestamps are kept in memory instead of in Redis.
+        Only use this if replies are sent through the same process that
+        received the inbound messages. Defaults to `False`.
+    :param int max_local_timestamps:
+        The maximum number of inbound timestamps to keep in memory when
+        `local_response_times` is set. The oldest timestamps are discarded
+        first. Defaults to 10000.
     :param dict redis_manager:
         Connection configuration details for Redis.
     :param str op_mode:
@@ -212,6 +377,14 @@ class MetricsMiddleware(BaseMiddleware):
         self.count_suffix = self.config.get('count_suffix', 'count')
         self.response_time_suffix = self.config.get('response_time_suffix',
             'response_time')
+        self.percentiles = self.config.get('percentiles', [50, 95, 99])
+        self.percentile_window = int(self.config.get('percentile_window', 300))
+        self.max_response_time = int(
+            self.config.get('max_response_time', 3600))
+        self.local_response_times = self.config.get(
+            'local_response_times', False)
+        self.max_local_timestamps = int(
+            self.config.get('max_local_timestamps', 10000))
         self.op_mode = self.config.get('op_mode', 'passive')
         if self.op_mode not in self.KNOWN_MODES:
             raise ConfigError('Unknown op_mode: %s' % (
@@ -222,6 +395,8 @@ class MetricsMiddleware(BaseMiddleware):
         self.validate_config()
         self.redis = yield TxRedisManager.from_config(
             self.config['redis_manager'])
+        self.local_timestamps = LRUCache()
+        self.response_time_samples = {}
         self.metric_manager = yield self.worker.start_publisher(MetricManager,
             "%s." % (self.manager_name,))
 
@@ -250,20 +425,50 @@ class MetricsMiddleware(BaseMiddleware):
         metric_name = '%s.%s' % (name, self.response_time_suffix)
         return self.get_or_create_metric(metric_name, Metric)
 
+    def get_response_time_samples(self, name):
+        if name not in self.response_time_samples:
+            samples = ResponseTimeSamples(self.percentile_window)
+            self.response_time_samples[name] = samples
+            for percent in self.percentiles:
+                metric_name = '%s.%s.p%s' % (
+                    name, self.response_time_suffix, percent)
+                self.get_or_create_metric(
+                    metric_name, PercentileMetric, samples, percent)
+        return self.response_time_samples[name]
+
     def set_response_time(self, transport_name, time):
         metric = self.get_response_time_metric(transport_name)
         metric.set(time)
+        self.get_response_time_samples(transport_name).add(time)
 
     def key(self, transport_name, message_id):
         return '%s:%s' % (transport_name, message_id)
 
+    def expire_local_timestamps(self):
+        # Timestamps are added in order, so the oldest are at the front.
+        expiry = time.time() - self.max_response_time
+        while self.local_timestamps:
+            key, timestamp = self.local_timestamps.oldest()
+            if (timestamp >= expiry and
+                    len(self.local_timestamps) <= self.max_local_timestamps):
+                break
+            del self.local_timestamps[key]
+
     def set_inbound_timestamp(self, transport_name, message):
         key = self.key(transport_name, message['message_id'])
-        return self.redis.set(key, repr(time.time()))
+        if self.local_response_times:
+            self.local_timestamps[key] = time.time()
+            self.expire_local_timestamps()
+            return
+        return self.redis.setex(
+            key, self.max_response_time, repr(time.time()))
 
     @inlineCallbacks
     def get_outbound_timestamp(self, transport_name, message):
         key = self.key(transport_name, message['in_reply_to'])
+        if self.local_response_times:
+            self.expire_local_timestamps()
+            returnValue(self.local_timestamps.pop(key, None))
         timestamp = yield self.redis.get(key)
         if timestamp:
             returnValue(float(timestamp))
@@ -1,8 +1,9 @@
 # -*- test-case-name: go.apps.opt_out.tests.test_vumi_app -*-
 
 from datetime import datetime
+from uuid import uuid4
 
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import returnValue, gatherResults, Deferred
 
 from vumi.persist.model import Model, Manager
 from vumi.persist.fields import ForeignKey, Timestamp, Unicode
@@ -18,12 +19,69 @@ class OptOut(Model):
 
 
 class OptOutStore(PerAccountStore):
+    """Store for an account's opt-outs.
+
+    If `redis` is provided, the opted-out addresses are also kept in a Redis
+    set per address type so that contacts can be filtered without a Riak
+    map-reduce. The sets are built from Riak the first time they are needed
+    and may be rebuilt with :meth:`rebuild_opt_out_sets`.
+
+    Each build of the sets gets a new generation id, and the sets are only
+    used once the generation they belong to is made current, so that
+    readers never see a set that is half built. While a generation is being
+    built, opt-outs that are added or deleted are applied to both it and
+    the current generation, and deletions are checked again once the new
+    sets are full, so that changes made during a rebuild aren't lost.
+    """
+
+    # Number of seconds to keep the sets from the previous generation for
+    # readers that looked up the generation before it changed.
+    OLD_GENERATION_TTL = 60
+    # Number of seconds after which a rebuild that hasn't finished is
+    # assumed to have died, so writers stop updating its sets.
+    BUILDING_GENERATION_TTL = 60 * 60
+
+    def __init__(self, base_manager, user_account_key, redis=None):
+        super(OptOutStore, self).__init__(base_manager, user_account_key)
+        if redis is not None:
+            redis = redis.sub_manager(user_account_key)
+        self.redis = redis
+
     def setup_proxies(self):
         self.opt_outs = self.manager.proxy(OptOut)
 
     def opt_out_id(self, addr_type, addr_value):
         return "%s:%s" % (addr_type, addr_value)
 
+    def opt_out_set_key(self, generation, addr_type):
+        return "opt_out_set:%s:%s" % (generation, addr_type)
+
+    def opt_out_set_types_key(self, generation):
+        return "opt_out_set_types:%s" % (generation,)
+
+    def opt_out_set_deleted_key(self, generation):
+        return "opt_out_set_deleted:%s" % (generation,)
+
+    def get_opt_out_set_generation(self):
+        """Return the current generation of the opt-out sets, or ``None``
+        if they haven't been built."""
+        return self.redis.get('opt_out_set_generation')
+
+    @Manager.calls_manager
+    def _opt_out_set_generations(self):
+        """Return the generation of the opt-out sets being built and the
+        current generation (either of which may be ``None``). Both need to
+        be updated when an opt-out is added or deleted.
+
+        The generation being built is looked up before the current one, so
+        that a rebuild that finishes in between is still seen as current.
+        """
+        building = yield self.redis.get('opt_out_set_building')
+        current = yield self.get_opt_out_set_generation()
+        if building == current:
+            building = None
+        returnValue((building, current))
+
     @Manager.calls_manager
     def new_opt_out(self, addr_type, addr_value, message):
         opt_out_id = self.opt_out_id(addr_type, addr_value)
@@ -31,6 +89,13 @@ class OptOutStore(PerAccountStore):
                 user_account=self.user_account_key,
                 message=message.get('message_id'))
         yield opt_out.save()
+        if self.redis is not None:
+            generations = yield self._opt_out_set_generations()
+            for generation in filter(None, generations):
+                yield self.redis.sadd(
+                    self.opt_out_set_types_key(generation), addr_type)
+                yield self.redis.sadd(
+                    self.opt_out_set_key(generation, addr_type), addr_value)
         returnValue(opt_out)
 
     def get_opt_out(self, addr_type, addr_value):
@@ -41,6 +106,21 @@ class OptOutStore(PerAccountStore):
         opt_out = yield self.get_opt_out(addr_type, addr_value)
         if opt_out:
             yield opt_out.delete()
+        if self.redis is not None:
+            building, current = yield self._opt_out_set_generations()
+            if building is not None:
+                # The rebuild may have listed this opt-out before it was
+                # deleted, so we record the deletion for it to check.
+                deleted_key = self.opt_out_set_deleted_key(building)
+                yield self.redis.sadd(
+                    deleted_key, self.opt_out_id(addr_type, addr_value))
+                yield self.redis.expire(
+                    deleted_key, self.BUILDING_GENERATION_TTL)
+            for generation in filter(None, [building, current]):
+                yield self.redis.sadd(
+                    self.opt_out_set_types_key(generation), addr_type)
+                yield self.redis.srem(
+                    self.opt_out_set_key(generation, addr_type), addr_value)
 
     def list_opt_outs(self):
         return self.list_keys(self.opt_outs)
@@ -50,3 +130,93 @@ class OptOutStore(PerAccountStore):
         mr = self.manager.mr_from_keys(self.opt_outs, keys)
         mr.filter_not_found()
         return mr.get_keys()
+
+    @Manager.calls_manager
+    def rebuild_opt_out_sets(self):
+        """Rebuild the Redis opt-out sets from the opt-outs in Riak.
+
+        Returns the number of opt-outs found.
+        """
+        generation = uuid4().hex
+        # Writers start updating the new generation's sets before we list
+        # the opt-outs, so anything added after the listing isn't missed.
+        yield self.redis.setex(
+            'opt_out_set_building', self.BUILDING_GENERATION_TTL, generation)
+
+        opt_out_keys = yield self.list_opt_outs()
+        addresses = {}
+        for key in opt_out_keys:
+            addr_type, _colon, addr_value = key.partition(":")
+            addresses.setdefault(addr_type, []).append(addr_value)
+
+        for addr_type, addr_values in addresses.iteritems():
+            yield self.redis.sadd(
+                self.opt_out_set_key(generation, addr_type), *addr_values)
+        if addresses:
+            yield self.redis.sadd(
+                self.opt_out_set_types_key(generation), *addresses.keys())
+
+        # Opt-outs deleted after we listed them have just been added back,
+        # so remove the ones that are really gone.
+        deleted_key = self.opt_out_set_deleted_key(generation)
+        deleted_ids = yield self.redis.smembers(deleted_key)
+        for opt_out_id in deleted_ids:
+            opt_out = yield self.opt_outs.load(opt_out_id)
+            if opt_out is None:
+                addr_type, _colon, addr_value = opt_out_id.partition(":")
+                yield self.redis.srem(
+                    self.opt_out_set_key(generation, addr_type), addr_value)
+        yield self.redis.delete(deleted_key)
+
+        old_generation = yield self.get_opt_out_set_generation()
+        yield self.redis.set('opt_out_set_generation', generation)
+        building = yield self.redis.get('opt_out_set_building')
+        if building == generation:
+            yield self.redis.delete('opt_out_set_building')
+        if old_generation is not None:
+            old_types_key = self.opt_out_set_types_key(old_generation)
+            old_addr_types = yield self.redis.smembers(old_types_key)
+            for addr_type in old_addr_types:
+                yield self.redis.expire(
+                    self.opt_out_set_key(old_generation, addr_type),
+                    self.OLD_GENERATION_TTL)
+            yield self.redis.expire(old_types_key, self.OLD_GENERATION_TTL)
+        returnValue(len(opt_out_keys))
+
+    @Manager.calls_manager
+    def get_opt_out_set(self, addr_type):
+        """Return the addresses in the current opt-out set for `addr_type`,
+        or an empty set if the opt-out sets haven't been built."""
+        generation = yield self.get_opt_out_set_generation()
+        if generation is None:
+            returnValue(set())
+        addresses = yield self.redis.smembers(
+            self.opt_out_set_key(generation, addr_type))
+        returnValue(addresses)
+
+    @Manager.calls_manager
+    def opted_out_addresses(self, addr_type, addresses):
+        """Return the set of `addresses` that have opted out.
+
+        This checks the Redis opt-out set if we have one and falls back to a
+        Riak map-reduce otherwise.
+        """
+        if self.redis is None:
+            opt_out_keys = yield self.opt_outs_for_addresses(
+                addr_type, addresses)
+            returnValue(set(key.split(':', 1)[1] for key in opt_out_keys))
+
+        generation = yield self.get_opt_out_set_generation()
+        if generation is None:
+            yield self.rebuild_opt_out_sets()
+            generation = yield self.get_opt_out_set_generation()
+
+        set_key = self.opt_out_set_key(generation, addr_type)
+        addresses = list(addresses)
+        memberships = [self.redis.sismember(set_key, address)
+                       for address in addresses]
+        if memberships and isinstance(memberships[0], Deferred):
+            # Async managers let us issue all the checks at once.
+            memberships = yield gatherResults(memberships)
+        returnValue(set(address for address, opted_out
+                        in zip(addresses, memberships) if opted_out))
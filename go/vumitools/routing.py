@@ -3,12 +3,14 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.endpoint_dispatchers import RoutingTableDispatcher
-from vumi.config import ConfigDict, ConfigText
+from vumi.config import ConfigDict, ConfigText, ConfigInt
 from vumi.message import TransportEvent
+from vumi.blinkenlights.metrics import SUM
 from vumi import log
 
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
 from go.vumitools.account import GoConnector
+from go.vumitools.routing_cache import RoutingTableCache
 
 
 class RoutingError(Exception):
@@ -154,6 +156,11 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         static=True, required=True)
     user_account_key = ConfigText(
         "Key of the user account the message is from.")
+    routing_table_cache_ttl = ConfigInt(
+        "Number of seconds to cache routing tables and tag owners for."
+        " Cached entries are also discarded whenever they are changed."
+        " Set to zero to disable caching.",
+        default=RoutingTableCache.DEFAULT_TTL, static=True)
 
 
 class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
@@ -249,12 +256,36 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             config.receive_inbound_connectors)
         self.transport_connectors.discard(
             self.router_connectors)
+        self.routing_cache = RoutingTableCache(
+            self.vumi_api.routing_cache.redis,
+            ttl=config.routing_table_cache_ttl,
+            metric_callback=self.fire_routing_cache_metric)
 
     @inlineCallbacks
     def teardown_dispatcher(self):
         yield self._go_teardown_worker()
         yield super(AccountRoutingTableDispatcher, self).teardown_dispatcher()
 
+    def fire_routing_cache_metric(self, name):
+        self.publish_metric("routing_cache.%s" % (name,), 1, SUM)
+
+    @inlineCallbacks
+    def _load_tag_owner(self, tag):
+        tag_info = yield self.vumi_api.mdb.get_tag_info(tag)
+        returnValue(tag_info.metadata['user_account'])
+
+    def get_tag_owner(self, tag):
+        """Return the (possibly cached) key of the account owning `tag`."""
+        tag = tuple(tag)
+        return self.routing_cache.get_tag_owner(
+            tag, lambda: self._load_tag_owner(tag))
+
+    def get_routing_table(self, user_account_key):
+        """Return the (possibly cached) routing table for an account."""
+        user_api = self.get_user_api(user_account_key)
+        return self.routing_cache.get_routing_table(
+            user_account_key, user_api.get_routing_table)
+
     @inlineCallbacks
     def get_config(self, msg):
         """Determine the config (primarily the routing table) for the given
@@ -278,8 +309,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         if msg_mdh.has_user_account():
             user_account_key = msg_mdh.get_account_key()
         elif msg_mdh.tag is not None:
-            tag_info = yield self.vumi_api.mdb.get_tag_info(tuple(msg_mdh.tag))
-            user_account_key = tag_info.metadata['user_account']
+            user_account_key = yield self.get_tag_owner(msg_mdh.tag)
             if user_account_key is None:
                 raise UnroutableMessageError(
                     "Message received for unowned tag.", msg)
@@ -287,8 +317,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             raise UnroutableMessageError(
                 "Could not determine user account key", msg)
 
-        user_api = self.get_user_api(user_account_key)
-        routing_table = yield user_api.get_routing_table()
+        routing_table = yield self.get_routing_table(user_account_key)
 
         config_dict = self.config.copy()
         config_dict['user_account_key'] = user_account_key
@@ -366,7 +395,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         elif conn.ctype == conn.TRANSPORT_TAG:
             msg_mdh.set_tag([conn.tagpool, conn.tagname])
-            tagpool_metadata = yield self.vumi_api.tpm.get_metadata(
+            tagpool_metadata = yield self.vumi_api.tagpool_cache.get_metadata(
                 conn.tagpool)
             transport_name = tagpool_metadata.get('transport_name')
             if transport_name is None:
@@ -0,0 +1,165 @@
+# -*- test-case-name: go.vumitools.tests.test_routing_cache -*-
+
+"""In-process caching of routing tables and tag ownership.
+
+Routing dispatchers need an account's routing table (and, for messages
+from transports, the account that owns the tag) for every message they
+route. Both of these live in Riak and change rarely, so we keep copies in
+memory and only reload them when they expire or when a generation counter
+in Redis tells us that something has changed.
+
+Anything that changes a routing table or the owner of a tag must call
+:meth:`RoutingTableCache.invalidate_routing_table` or
+:meth:`RoutingTableCache.invalidate_tag` so that every process holding a
+cached copy notices the change on its next lookup.
+"""
+
+import time
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.account.models import CompiledRoutingTable
+from go.vumitools.lru import LRUCache
+
+
+class GenerationCache(object):
+    """Base class for in-process caches invalidated through Redis.
+
+    Each cached entry is stored along with the value of a generation
+    counter in Redis. Invalidating an entry increments its counter, which
+    makes every process reload its copy on the next lookup.
+
+    :param redis:
+        Redis manager used to store invalidation generation counters.
+    :param int ttl:
+        Number of seconds a cached entry may be used for before it is
+        reloaded regardless of the generation counter. A TTL of zero
+        disables caching.
+    :param int max_size:
+        Maximum number of entries of each kind to keep. The least recently
+        used entry is dropped to make room for a new one. Unlimited by
+        default.
+    :param metric_callback:
+        Optional callable called with a metric name (e.g.
+        ``routing_table.hit``) for each cache lookup.
+    """
+
+    DEFAULT_TTL = 60
+
+    def __init__(self, redis, ttl=None, max_size=None, metric_callback=None):
+        self.redis = redis
+        self.manager = self.redis  # TODO: hack to make calls_manager work
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        self.max_size = max_size
+        self.metric_callback = metric_callback
+
+    def _fire_metric(self, name):
+        if self.metric_callback is not None:
+            self.metric_callback(name)
+
+    @Manager.calls_manager
+    def _cached_lookup(self, cache, cache_key, redis_key, metric_name, loader):
+        generation = yield self.redis.get(redis_key)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            cached_generation, expires_at, value = cached
+            if cached_generation == generation and expires_at > time.time():
+                self._fire_metric("%s.hit" % (metric_name,))
+                returnValue(value)
+        self._fire_metric("%s.miss" % (metric_name,))
+        value = yield loader()
+        if self.ttl > 0:
+            cache[cache_key] = (generation, time.time() + self.ttl, value)
+        returnValue(value)
+
+
+class RoutingTableCache(GenerationCache):
+    """Cache of routing tables and tag owners with Redis invalidation.
+
+    See :class:`GenerationCache` for the constructor parameters.
+    """
+
+    def __init__(self, redis, ttl=None, max_size=None, metric_callback=None):
+        super(RoutingTableCache, self).__init__(
+            redis, ttl=ttl, max_size=max_size,
+            metric_callback=metric_callback)
+        self._routing_tables = LRUCache(max_size)
+        self._compiled_routing_tables = LRUCache(max_size)
+        self._tag_owners = LRUCache(max_size)
+
+    def _routing_table_key(self, user_account_key):
+        return ":".join(["routing_table", user_account_key])
+
+    def _tag_key(self, tag):
+        return ":".join(["tag", tag[0], tag[1]])
+
+    def get_routing_table(self, user_account_key, loader):
+        """Return the cached routing table for an account.
+
+        :param str user_account_key:
+            The account to return the routing table for.
+        :param loader:
+            Callable returning the routing table (or a deferred that fires
+            with it) that is called when there is no usable cached copy.
+        """
+        return self._cached_lookup(
+            self._routing_tables, user_account_key,
+            self._routing_table_key(user_account_key), "routing_table",
+            loader)
+
+    def get_compiled_routing_table(self, user_account_key, loader):
+        """Return a cached :class:`CompiledRoutingTable` for an account.
+
+        The compiled table shares the routing table's generation counter, so
+        it is only rebuilt when the routing table is invalidated (or when
+        it expires).
+
+        :param str user_account_key:
+            The account to return the compiled routing table for.
+        :param loader:
+            Callable returning the routing table (or a deferred that fires
+            with it) that is called when there is no usable cached copy.
+        """
+        return self._cached_lookup(
+            self._compiled_routing_tables, user_account_key,
+            self._routing_table_key(user_account_key),
+            "compiled_routing_table", lambda: self._compile(loader))
+
+    @Manager.calls_manager
+    def _compile(self, loader):
+        routing_table = yield loader()
+        returnValue(CompiledRoutingTable(routing_table))
+
+    def get_tag_owner(self, tag, loader):
+        """Return the cached key of the account that owns a tag.
+
+        :param tuple tag:
+            The `(pool, tagname)` pair to look up.
+        :param loader:
+            Callable returning the owning account key (or a deferred that
+            fires with it) that is called when there is no usable cached
+            copy.
+        """
+        tag = tuple(tag)
+        return self._cached_lookup(
+            self._tag_owners, tag, self._tag_key(tag), "tag_owner", loader)
+
+    def invalidate_routing_table(self, user_account_key):
+        """Invalidate all cached copies of an account's routing table."""
+        self._routing_tables.pop(user_account_key, None)
+        self._compiled_routing_tables.pop(user_account_key, None)
+        return self.redis.incr(self._routing_table_key(user_account_key))
+
+    def invalidate_tag(self, tag):
+        """Invalidate all cached copies of a tag's owner."""
+        tag = tuple(tag)
+        self._tag_owners.pop(tag, None)
+        return self.redis.incr(self._tag_key(tag))
+
+    def clear(self):
+        """Discard everything cached in this process."""
+        self._routing_tables.clear()
+        self._compiled_routing_tables.clear()
+        self._tag_owners.clear()
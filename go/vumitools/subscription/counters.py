@@ -0,0 +1,129 @@
+# -*- test-case-name: go.vumitools.subscription.tests.test_counters -*-
+
+"""Counts of the contacts subscribed to and unsubscribed from campaigns."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class SubscriptionCounters(object):
+    """Per-account counts of contacts for each campaign and subscription
+    status, kept in a Redis hash.
+
+    Anything that changes a contact's subscription status must call
+    :meth:`update` once the contact has been saved. A campaign's counts are
+    seeded from Riak search by :meth:`reconcile`, and :meth:`get_counts`
+    returns ``None`` for a campaign until they have been. Riak search can
+    lag behind recent saves, and a contact saved while the counts are being
+    seeded may be counted by both the search and :meth:`update` (or by
+    neither), so the counts can drift. Callers should reconcile them
+    periodically (see the `max_age` parameter of :meth:`get_counts`).
+
+    Both of a campaign's counts are kept in a single hash field so that
+    each update is one atomic ``HINCRBY``, which happens either entirely
+    before or entirely after the counts are seeded. The count of
+    subscribed contacts is kept in the high bits of the field and the count
+    of unsubscribed contacts in the low bits (see :meth:`pack_counts`).
+
+    :param redis:
+        Redis manager to keep the counts in.
+    :param str user_account_key:
+        The account whose contacts are counted.
+    """
+
+    STATUSES = (u'subscribed', u'unsubscribed')
+    COUNTS = u'counts'
+    COUNTED = u'counted'
+    # Multiplier for the subscribed count in the packed counts.
+    SHIFT = 2 ** 32
+
+    clock = reactor
+
+    def __init__(self, redis, user_account_key):
+        self.redis = redis
+        self.manager = self.redis  # TODO: hack to make calls_manager work
+        self.user_account_key = user_account_key
+
+    def _field(self, campaign_name, name):
+        return ":".join([campaign_name, name])
+
+    def pack_counts(self, counts):
+        """
+        Pack a dict of counts for each status into a single integer.
+        """
+        return (counts.get(u'subscribed', 0) * self.SHIFT
+                + counts.get(u'unsubscribed', 0))
+
+    def unpack_counts(self, packed):
+        """
+        Unpack counts packed by :meth:`pack_counts`. Updates made before the
+        counts were seeded can leave either count negative, so the low bits
+        are read as a signed number.
+        """
+        half = self.SHIFT // 2
+        unsubscribed = (packed + half) % self.SHIFT - half
+        subscribed = (packed - unsubscribed) // self.SHIFT
+        return {u'subscribed': subscribed, u'unsubscribed': unsubscribed}
+
+    def update(self, campaign_name, old_status, new_status):
+        """
+        Move a contact from the count for `old_status` to the count for
+        `new_status` (either of which may be ``None``).
+
+        Campaigns that haven't been seeded are updated too, since
+        :meth:`get_counts` ignores their counts and seeding them replaces
+        the counts.
+        """
+        delta = (self.pack_counts({new_status: 1})
+                 - self.pack_counts({old_status: 1}))
+        if not delta:
+            return
+        return self.redis.hincrby(
+            self.user_account_key, self._field(campaign_name, self.COUNTS),
+            delta)
+
+    @Manager.calls_manager
+    def get_counts(self, campaign_names, max_age=None):
+        """
+        Return a dict mapping each campaign name to a dict of counts for
+        each status, or to ``None`` if the campaign hasn't been counted (or,
+        if `max_age` is given, hasn't been counted in the last `max_age`
+        seconds).
+        """
+        fields = yield self.redis.hgetall(self.user_account_key)
+        counts = {}
+        for campaign_name in campaign_names:
+            counted = fields.get(self._field(campaign_name, self.COUNTED))
+            if counted is None or (
+                    max_age is not None
+                    and float(counted) < self.clock.seconds() - max_age):
+                counts[campaign_name] = None
+                continue
+            counts[campaign_name] = self.unpack_counts(
+                int(fields.get(self._field(campaign_name, self.COUNTS), 0)))
+        returnValue(counts)
+
+    def set_counts(self, campaign_name, counts):
+        """
+        Replace the counts for `campaign_name` with `counts` (a dict of
+        counts for each status) and mark the campaign as counted.
+        """
+        return self.redis.hmset(self.user_account_key, {
+            self._field(campaign_name, self.COUNTS): self.pack_counts(counts),
+            self._field(campaign_name, self.COUNTED): self.clock.seconds(),
+        })
+
+    @Manager.calls_manager
+    def reconcile(self, contact_store, campaign_name):
+        """
+        Replace the counts for `campaign_name` with counts from a Riak
+        search of the account's contacts, returning the new counts.
+        """
+        counts = {}
+        for status in self.STATUSES:
+            counts[status] = yield contact_store.contacts.raw_search(
+                "subscription-%s:%s" % (campaign_name, status)).get_count()
+        yield self.set_counts(campaign_name, counts)
+        returnValue(counts)
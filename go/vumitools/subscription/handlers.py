@@ -42,8 +42,13 @@ class SubscriptionHandler(EventHandler):
 
         contact = yield user_api.contact_store.get_contact_by_key(
             fields['contact_id'])
-        contact.subscription[fields['campaign_name']] = {
+        campaign_name = fields['campaign_name']
+        old_status = contact.subscription[campaign_name]
+        new_status = {
             'subscribe': u'subscribed',
             'unsubscribe': u'unsubscribed',
             }[fields['operation']]
+        contact.subscription[campaign_name] = new_status
         yield contact.save()
+        yield user_api.subscription_counters.update(
+            campaign_name, old_status, new_status)
@@ -0,0 +1,130 @@
+"""Tests for go.vumitools.subscription.counters."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from go.vumitools.subscription.counters import SubscriptionCounters
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class StubSearch(object):
+    def __init__(self, count):
+        self.count = count
+
+    def get_count(self):
+        return succeed(self.count)
+
+
+class StubContactStore(object):
+    def __init__(self, counts):
+        self.contacts = self
+        self.counts = counts
+
+    def raw_search(self, query):
+        return StubSearch(self.counts.get(query, 0))
+
+
+class TestSubscriptionCounters(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.counters = SubscriptionCounters(self.redis, 'acc1')
+        self.clock = self.counters.clock = Clock()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def assert_counts(self, campaign_name, expected):
+        counts = yield self.counters.get_counts([campaign_name])
+        self.assertEqual(counts, {campaign_name: expected})
+
+    @inlineCallbacks
+    def test_no_counts(self):
+        yield self.assert_counts('foo', None)
+
+    @inlineCallbacks
+    def test_update_not_counted(self):
+        yield self.counters.update('foo', None, u'subscribed')
+        yield self.counters.update('foo', u'subscribed', u'unsubscribed')
+        yield self.assert_counts('foo', None)
+
+    @inlineCallbacks
+    def test_update(self):
+        yield self.counters.set_counts('foo', {})
+        yield self.counters.set_counts('bar', {})
+        yield self.assert_counts(
+            'foo', {u'subscribed': 0, u'unsubscribed': 0})
+        yield self.counters.update('foo', None, u'subscribed')
+        yield self.counters.update('foo', None, u'subscribed')
+        yield self.assert_counts(
+            'foo', {u'subscribed': 2, u'unsubscribed': 0})
+
+        yield self.counters.update('foo', u'subscribed', u'unsubscribed')
+        yield self.assert_counts(
+            'foo', {u'subscribed': 1, u'unsubscribed': 1})
+
+        yield self.counters.update('foo', u'unsubscribed', u'unsubscribed')
+        yield self.assert_counts(
+            'foo', {u'subscribed': 1, u'unsubscribed': 1})
+        yield self.assert_counts(
+            'bar', {u'subscribed': 0, u'unsubscribed': 0})
+
+    @inlineCallbacks
+    def test_update_below_zero(self):
+        # If the counts drift, one of them going below zero mustn't affect
+        # the other.
+        yield self.counters.set_counts('foo', {u'subscribed': 1})
+        yield self.counters.update('foo', u'subscribed', u'unsubscribed')
+        yield self.counters.update('foo', u'unsubscribed', None)
+        yield self.counters.update('foo', u'unsubscribed', None)
+        yield self.assert_counts(
+            'foo', {u'subscribed': 0, u'unsubscribed': -1})
+
+    @inlineCallbacks
+    def test_get_counts_max_age(self):
+        yield self.counters.set_counts('foo', {u'subscribed': 2})
+        self.clock.advance(10)
+        counts = yield self.counters.get_counts(['foo'], max_age=10)
+        self.assertEqual(counts, {
+            'foo': {u'subscribed': 2, u'unsubscribed': 0}})
+        self.clock.advance(1)
+        counts = yield self.counters.get_counts(['foo'], max_age=10)
+        self.assertEqual(counts, {'foo': None})
+        yield self.assert_counts(
+            'foo', {u'subscribed': 2, u'unsubscribed': 0})
+
+    @inlineCallbacks
+    def test_counts_per_account(self):
+        other = SubscriptionCounters(self.redis, 'acc2')
+        yield other.set_counts('foo', {u'subscribed': 2})
+        yield other.update('foo', None, u'subscribed')
+        self.assertEqual((yield other.get_counts(['foo'])), {
+            'foo': {u'subscribed': 3, u'unsubscribed': 0}})
+        yield self.assert_counts('foo', None)
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        yield self.counters.set_counts('foo', {u'subscribed': 1})
+        contact_store = StubContactStore({
+            'subscription-foo:subscribed': 3,
+            'subscription-foo:unsubscribed': 5,
+        })
+        counts = yield self.counters.reconcile(contact_store, 'foo')
+        self.assertEqual(counts, {u'subscribed': 3, u'unsubscribed': 5})
+        yield self.assert_counts(
+            'foo', {u'subscribed': 3, u'unsubscribed': 5})
+
+    @inlineCallbacks
+    def test_update_after_reconcile(self):
+        contact_store = StubContactStore({
+            'subscription-foo:subscribed': 3,
+        })
+        yield self.counters.update('foo', None, u'subscribed')
+        yield self.counters.reconcile(contact_store, 'foo')
+        yield self.counters.update('foo', u'subscribed', u'unsubscribed')
+        yield self.assert_counts(
+            'foo', {u'subscribed': 2, u'unsubscribed': 1})
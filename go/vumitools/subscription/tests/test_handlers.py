@@ -16,6 +16,8 @@ class SubscriptionHandlerTestCase(EventHandlerTestCase):
         contact = yield self.contact_store.new_contact(
             name=u'J Random', surname=u'Person', msisdn=u'27831234567')
         self.contact_id = contact.key
+        yield self.user_api.subscription_counters.set_counts(
+            'testcampaign', {})
         self.track_event(self.account.key, self.conversation.key,
                          'subscription', 'conv')
 
@@ -31,11 +33,28 @@ class SubscriptionHandlerTestCase(EventHandlerTestCase):
         contact = yield self.contact_store.get_contact_by_key(self.contact_id)
         self.assertEqual(contact.subscription['testcampaign'], value)
 
+    @inlineCallbacks
+    def assert_counts(self, subscribed, unsubscribed):
+        counts = yield self.user_api.subscription_counters.get_counts(
+            ['testcampaign'])
+        self.assertEqual(counts['testcampaign'], {
+            u'subscribed': subscribed,
+            u'unsubscribed': unsubscribed,
+        })
+
     @inlineCallbacks
     def test_subscribe(self):
         yield self.assert_subscription(None)
         yield self.publish_event(self.mkevent_sub('subscribe'))
         yield self.assert_subscription('subscribed')
+        yield self.assert_counts(1, 0)
+
+    @inlineCallbacks
+    def test_subscribe_then_unsubscribe(self):
+        yield self.publish_event(self.mkevent_sub('subscribe'))
+        yield self.publish_event(self.mkevent_sub('unsubscribe'))
+        yield self.assert_subscription('unsubscribed')
+        yield self.assert_counts(0, 1)
 
     @inlineCallbacks
     def test_unsubscribe(self):
@@ -54,3 +73,12 @@ class SubscriptionHandlerTestCase(EventHandlerTestCase):
         yield self.assert_subscription('unsubscribed')
         yield self.publish_event(self.mkevent_sub('subscribe'))
         yield self.assert_subscription('subscribed')
+
+    @inlineCallbacks
+    def test_subscribe_not_counted(self):
+        counters = self.user_api.subscription_counters
+        yield counters.redis.delete(counters.user_account_key)
+        yield self.publish_event(self.mkevent_sub('subscribe'))
+        yield self.assert_subscription('subscribed')
+        counts = yield counters.get_counts(['testcampaign'])
+        self.assertEqual(counts, {'testcampaign': None})
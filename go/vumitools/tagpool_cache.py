@@ -0,0 +1,109 @@
+# -*- test-case-name: go.vumitools.tests.test_tagpool_cache -*-
+
+"""In-process caching of tagpool metadata.
+
+Middlewares and dispatchers read a tagpool's metadata (its transport name,
+message cost, opt-out settings, etc.) for every message they handle. This
+metadata is static configuration that only changes when tagpools are
+(re)declared, so we keep copies in memory.
+
+Cached metadata is refreshed in the background shortly before it expires,
+so lookups for pools in regular use never wait on Redis. Anything that
+changes tagpool metadata should call :meth:`TagpoolMetadataCache.invalidate`
+so that every process discards its cached copies on its next generation
+check.
+"""
+
+import time
+
+from twisted.internet.defer import returnValue, maybeDeferred
+
+from vumi import log
+from vumi.persist.redis_base import Manager
+
+
+class TagpoolMetadataCache(object):
+    """Cache of tagpool metadata with refresh-ahead and Redis invalidation.
+
+    :param tpm:
+        The :class:`TagpoolManager` to load metadata from. The generation
+        counter used for invalidation is stored in its Redis namespace.
+    :param int ttl:
+        Number of seconds cached metadata may be used for. Metadata that is
+        looked up after :attr:`REFRESH_AHEAD` of this has passed is reloaded
+        in the background. A TTL of zero disables caching.
+    :param int generation_check_interval:
+        Minimum number of seconds between checks of the generation counter.
+    """
+
+    DEFAULT_TTL = 300
+    DEFAULT_GENERATION_CHECK_INTERVAL = 10
+    REFRESH_AHEAD = 0.75
+    GENERATION_KEY = 'metadata_cache:generation'
+
+    def __init__(self, tpm, ttl=None, generation_check_interval=None):
+        self.tpm = tpm
+        self.redis = tpm.redis
+        self.manager = self.redis  # TODO: hack to make calls_manager work
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        if generation_check_interval is None:
+            generation_check_interval = self.DEFAULT_GENERATION_CHECK_INTERVAL
+        self.generation_check_interval = generation_check_interval
+        self._metadata = {}
+        self._refreshing = set()
+        self._generation = None
+        self._next_generation_check = 0
+
+    @Manager.calls_manager
+    def _load(self, pool):
+        metadata = yield self.tpm.get_metadata(pool)
+        if self.ttl > 0:
+            self._metadata[pool] = (time.time(), metadata)
+        returnValue(metadata)
+
+    def _in_background(self, func, *args):
+        d = maybeDeferred(func, *args)
+        d.addErrback(lambda f: log.err(f, "Error updating tagpool cache."))
+        return d
+
+    def _refresh(self, pool):
+        if pool in self._refreshing:
+            return
+        self._refreshing.add(pool)
+        d = self._in_background(self._load, pool)
+        d.addBoth(lambda _: self._refreshing.discard(pool))
+
+    @Manager.calls_manager
+    def check_generation(self):
+        """Discard all cached metadata if it has been invalidated since the
+        last check.
+        """
+        self._next_generation_check = (
+            time.time() + self.generation_check_interval)
+        generation = yield self.redis.get(self.GENERATION_KEY)
+        if generation != self._generation:
+            self._metadata.clear()
+            self._generation = generation
+
+    @Manager.calls_manager
+    def get_metadata(self, pool):
+        """Return the (possibly cached) metadata for a tagpool."""
+        now = time.time()
+        if now >= self._next_generation_check:
+            self._in_background(self.check_generation)
+
+        cached = self._metadata.get(pool)
+        if cached is not None:
+            loaded_at, metadata = cached
+            age = now - loaded_at
+            if age < self.ttl:
+                if age >= self.ttl * self.REFRESH_AHEAD:
+                    self._refresh(pool)
+                returnValue(metadata)
+        metadata = yield self._load(pool)
+        returnValue(metadata)
+
+    def invalidate(self):
+        """Invalidate all cached copies of tagpool metadata."""
+        self._metadata.clear()
+        return self.redis.incr(self.GENERATION_KEY)
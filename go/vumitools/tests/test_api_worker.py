@@ -2,7 +2,8 @@
 
 """Tests for go.vumitools.api_worker."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
 
 from vumi.tests.utils import LogCatcher
 
@@ -58,6 +59,32 @@ class ToyHandler(EventHandler):
         self.handled_events.append((event, handler_config))
 
 
+class SlowHandler(ToyHandler):
+    def setup_handler(self):
+        super(SlowHandler, self).setup_handler()
+        self.pending = []
+        self.started = []
+
+    def handle_event(self, event, handler_config):
+        super(SlowHandler, self).handle_event(event, handler_config)
+        d = Deferred()
+        self.pending.append(d)
+        started, self.started = self.started, []
+        for started_d in started:
+            started_d.callback(None)
+        return d
+
+    def wait_for_start(self):
+        d = Deferred()
+        self.started.append(d)
+        return d
+
+
+class BrokenHandler(EventHandler):
+    def handle_event(self, event, handler_config):
+        raise ValueError("Broken handler.")
+
+
 class EventDispatcherTestCase(AppWorkerTestCase):
 
     application_class = EventDispatcher
@@ -69,13 +96,31 @@ class EventDispatcherTestCase(AppWorkerTestCase):
             'event_handlers': {
                     'handler1': '%s.ToyHandler' % __name__,
                     'handler2': '%s.ToyHandler' % __name__,
+                    'slow': '%s.SlowHandler' % __name__,
+                    'broken': '%s.BrokenHandler' % __name__,
                     },
+            'max_concurrent_handlers': 2,
+            'handler_timeout': 10,
         }))
+        self.ed.clock = Clock()
         self.handler1 = self.ed.handlers['handler1']
         self.handler2 = self.ed.handlers['handler2']
+        self.slow_handler = self.ed.handlers['slow']
 
-    def publish_event(self, cmd):
-        return self.dispatch(cmd, rkey='vumi.event')
+    @inlineCallbacks
+    def publish_event(self, cmd, wait=True):
+        yield self.dispatch(cmd, rkey='vumi.event')
+        if wait:
+            yield self.ed.wait_for_handlers()
+
+    def set_account_config(self, account_key, config):
+        self.ed.account_handler_configs[account_key] = [
+            [list(k), v] for k, v in config.iteritems()]
+
+    def poll_metrics(self):
+        metrics = self.ed.metrics._metrics_lookup
+        return dict((name, [v for _, v in metric.poll()])
+                    for name, metric in metrics.items())
 
     def mkevent(self, event_type, content, conv_key="conv_key",
                 account_key="acct"):
@@ -84,8 +129,8 @@ class EventDispatcherTestCase(AppWorkerTestCase):
 
     @inlineCallbacks
     def test_handle_event(self):
-        self.ed.account_config['acct'] = {
-            ('conv_key', 'my_event'): [('handler1', {})]}
+        self.set_account_config('acct', {
+            ('conv_key', 'my_event'): [('handler1', {})]})
         event = self.mkevent("my_event", {"foo": "bar"})
         self.assertEqual([], self.handler1.handled_events)
         yield self.publish_event(event)
@@ -108,13 +153,13 @@ class EventDispatcherTestCase(AppWorkerTestCase):
 
     @inlineCallbacks
     def test_handle_events(self):
-        self.ed.account_config['acct'] = {
+        self.set_account_config('acct', {
             ('conv_key', 'my_event'): [('handler1', {'animal': 'puppy'})],
             ('conv_key', 'other_event'): [
                 ('handler1', {'animal': 'kitten'}),
                 ('handler2', {})
                 ],
-            }
+            })
         event = self.mkevent("my_event", {"foo": "bar"})
         event2 = self.mkevent("other_event", {"foo": "bar"})
         self.assertEqual([], self.handler1.handled_events)
@@ -126,6 +171,143 @@ class EventDispatcherTestCase(AppWorkerTestCase):
             self.handler1.handled_events)
         self.assertEqual([(event2, {})], self.handler2.handled_events)
 
+    @inlineCallbacks
+    def test_slow_handler_does_not_block_events(self):
+        self.ed.ack_after_handlers = False
+        self.set_account_config('acct', {
+            ('conv_key', 'slow_event'): [('slow', {})],
+            ('conv_key', 'my_event'): [('handler1', {})],
+            })
+        slow_event = self.mkevent("slow_event", {})
+        event = self.mkevent("my_event", {})
+        yield self.publish_event(slow_event, wait=False)
+        yield self.publish_event(event, wait=False)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+
+        [d] = self.slow_handler.pending
+        d.callback(None)
+        yield self.ed.wait_for_handlers()
+        self.assertTrue('slow.latency' in self.poll_metrics())
+
+    @inlineCallbacks
+    def test_max_concurrent_handlers(self):
+        self.ed.ack_after_handlers = False
+        self.set_account_config('acct', {
+            ('conv_key', 'slow_event'): [('slow', {})]})
+        for i in range(2):
+            yield self.publish_event(
+                self.mkevent("slow_event", {}), wait=False)
+        self.assertEqual(len(self.slow_handler.pending), 2)
+
+        # The third event waits for one of the others to finish.
+        d = self.publish_event(self.mkevent("slow_event", {}), wait=False)
+        self.assertEqual(len(self.slow_handler.pending), 2)
+        self.slow_handler.pending[0].callback(None)
+        yield d
+        self.assertEqual(len(self.slow_handler.pending), 3)
+        for pending in self.slow_handler.pending[1:]:
+            pending.callback(None)
+        yield self.ed.wait_for_handlers()
+
+    @inlineCallbacks
+    def test_handler_timeout(self):
+        self.set_account_config('acct', {
+            ('conv_key', 'slow_event'): [('slow', {})]})
+        d = self.ed.consume_api_event(self.mkevent("slow_event", {}))
+        self.assertFalse(d.called)
+        with LogCatcher() as lc:
+            self.ed.clock.advance(10)
+            yield d
+            self.assertTrue(any("timed out" in msg for msg in lc.messages()))
+        metrics = self.poll_metrics()
+        self.assertEqual(metrics['slow.timeouts'], [1])
+        self.assertEqual(metrics['slow.errors'], [1])
+
+        # The timed out handler keeps its slot until it really finishes.
+        self.assertEqual(len(self.ed.handlers_in_progress), 1)
+        self.assertEqual(self.ed.handler_semaphore.tokens, 1)
+        [pending] = self.slow_handler.pending
+        pending.callback(None)
+        yield self.ed.wait_for_handlers()
+        self.assertEqual(self.ed.handlers_in_progress, set())
+        self.assertEqual(self.ed.handler_semaphore.tokens, 2)
+        self.assertEqual(self.poll_metrics()['slow.errors'], [])
+
+    @inlineCallbacks
+    def test_handler_error(self):
+        self.set_account_config('acct', {
+            ('conv_key', 'my_event'): [('broken', {}), ('handler1', {})]})
+        event = self.mkevent("my_event", {})
+        yield self.publish_event(event)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.poll_metrics()['broken.errors'], [1])
+
+    @inlineCallbacks
+    def test_account_config_invalidated(self):
+        user_account = yield self.mk_user(self.ed.vumi_api, u'dbacct')
+        user_account.event_handler_config = [
+            [['conv_key', 'my_event'], [('handler1', {})]]
+            ]
+        user_api = self.ed.vumi_api.get_user_api(user_account.key)
+        yield user_api.save_event_handler_config(user_account)
+        event = self.mkevent(
+            "my_event", {"foo": "bar"}, account_key=user_account.key)
+        yield self.publish_event(event)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+
+        user_account.event_handler_config = [
+            [['conv_key', 'my_event'], [('handler2', {})]]
+            ]
+        yield user_api.save_event_handler_config(user_account)
+        yield self.publish_event(event)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+        self.assertEqual([(event, {})], self.handler2.handled_events)
+
+    @inlineCallbacks
+    def test_account_config_invalidated_by_save_account(self):
+        user_account = yield self.mk_user(self.ed.vumi_api, u'dbacct')
+        user_account.event_handler_config = [
+            [['conv_key', 'my_event'], [('handler1', {})]]
+            ]
+        user_api = self.ed.vumi_api.get_user_api(user_account.key)
+        yield user_api.save_account(user_account)
+        event = self.mkevent(
+            "my_event", {"foo": "bar"}, account_key=user_account.key)
+        yield self.publish_event(event)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+
+        user_account.event_handler_config = []
+        yield user_api.save_account(user_account)
+        yield self.publish_event(event)
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+
+    @inlineCallbacks
+    def test_event_consumed_once_handlers_started(self):
+        self.ed.ack_after_handlers = False
+        self.set_account_config('acct', {
+            ('conv_key', 'slow_event'): [('slow', {})]})
+        yield self.ed.consume_api_event(self.mkevent("slow_event", {}))
+        [pending] = self.slow_handler.pending
+        self.assertFalse(pending.called)
+        pending.callback(None)
+        yield self.ed.wait_for_handlers()
+
+    @inlineCallbacks
+    def test_ack_after_handlers(self):
+        self.set_account_config('acct', {
+            ('conv_key', 'slow_event'): [('slow', {}), ('handler1', {})]})
+        event = self.mkevent("slow_event", {})
+        started = self.slow_handler.wait_for_start()
+        d = self.ed.consume_api_event(event)
+        yield started
+        self.assertFalse(d.called)
+        [pending] = self.slow_handler.pending
+        pending.callback(None)
+        yield d
+        self.assertEqual([(event, {})], self.handler1.handled_events)
+        self.assertEqual(self.ed.handlers_in_progress, set())
+
 
 class SendingEventDispatcherTestCase(AppWorkerTestCase):
     application_class = EventDispatcher
@@ -143,8 +325,10 @@ class SendingEventDispatcherTestCase(AppWorkerTestCase):
         self.ed = yield self.get_application(ed_config)
         self.handler1 = self.ed.handlers['handler1']
 
+    @inlineCallbacks
     def publish_event(self, cmd):
-        return self.dispatch(cmd, rkey='vumi.event')
+        yield self.dispatch(cmd, rkey='vumi.event')
+        yield self.ed.wait_for_handlers()
 
     def mkevent(self, event_type, content, conv_key="conv_key",
                 account_key="acct"):
@@ -174,7 +358,7 @@ class SendingEventDispatcherTestCase(AppWorkerTestCase):
                 'conversation_key': 'other_conv',
                 })]]
             ]
-        yield user_account.save()
+        yield self.user_api.save_event_handler_config(user_account)
 
         event = self.mkevent("my_event",
                 {"to_addr": "12345", "content": "hello"},
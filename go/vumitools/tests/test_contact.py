@@ -2,6 +2,8 @@
 
 """Tests for go.vumitools.contact."""
 
+from uuid import uuid4
+
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial.unittest import TestCase
 
@@ -9,6 +11,7 @@ from go.vumitools.tests.utils import model_eq, GoPersistenceMixin
 from go.vumitools.account import AccountStore
 from go.vumitools.contact import (
     ContactStore, ContactError, ContactNotFoundError)
+from go.vumitools.contact.old_models import ContactVNone
 from go.vumitools.opt_out import OptOutStore
 
 
@@ -231,6 +234,96 @@ class TestContactStore(GoPersistenceMixin, TestCase):
         count = yield self.store.count_contacts_for_group(group)
         self.assertEqual(count, 1)
 
+    @inlineCallbacks
+    def test_filter_contacts_on_surname(self):
+        contact1 = yield self.store.new_contact(
+            name=u'J Random', surname=u'Person', msisdn=u'27831234567')
+        contact2 = yield self.store.new_contact(
+            name=u'Other', surname=u'pillay', msisdn=u'27831234568')
+        yield self.store.new_contact(
+            name=u'Another', surname=u'Jackal', msisdn=u'27831234569')
+        yield self.store.new_contact(name=u'Nameless', msisdn=u'27831234560')
+
+        contacts = yield self.store.filter_contacts_on_surname(u'P')
+        self.assertEqual(sorted(c.key for c in contacts),
+                         sorted([contact1.key, contact2.key]))
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'x')), [])
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'')), [])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_for_group(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(
+            name=u'J Random', surname=u'Person', msisdn=u'27831234567',
+            groups=[group])
+        yield self.store.new_contact(
+            name=u'Other', surname=u'Pillay', msisdn=u'27831234568')
+
+        contacts = yield self.store.filter_contacts_on_surname(
+            u'p', group=group)
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_updated(self):
+        contact = yield self.store.new_contact(
+            name=u'Zoë', surname=u'Émile', msisdn=u'27831234567')
+        contacts = yield self.store.filter_contacts_on_surname(u'é')
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+        yield self.store.update_contact(contact.key, surname=u'Person')
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'é')), [])
+        contacts = yield self.store.filter_contacts_on_surname(u'p')
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+    @inlineCallbacks
+    def test_get_contact_vnone(self):
+        old_contacts = self.store.manager.proxy(ContactVNone)
+        contact = old_contacts(
+            uuid4().get_hex(), user_account=self.account.key,
+            name=u'J Random', surname=u'Person', msisdn=u'27831234567')
+        contact.groups.add_key(u'group-a')
+        contact.extra[u'foo'] = u'bar'
+        yield contact.save()
+
+        dbcontact = yield self.store.get_contact_by_key(contact.key)
+        self.assertEqual(dbcontact.was_migrated, True)
+        self.assertEqual(u'Person', dbcontact.surname)
+        self.assertEqual(u'27831234567', dbcontact.msisdn)
+        self.assertEqual([u'group-a'], dbcontact.groups.keys())
+        self.assertEqual(u'bar', dbcontact.extra[u'foo'])
+        self.assertEqual(u'p', dbcontact.surname_initial)
+
+        # Only migrated contacts that have been saved are in the index.
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'p')), [])
+        yield dbcontact.save()
+        contacts = yield self.store.filter_contacts_on_surname(u'p')
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+    @inlineCallbacks
+    def test_get_contact_vnone_index_only_fields(self):
+        old_contacts = self.store.manager.proxy(ContactVNone)
+        contact = old_contacts(
+            uuid4().get_hex(), user_account=self.account.key,
+            surname=u'Person', msisdn=u'27831234567')
+        contact.groups.add_key(u'group-a')
+        # Older contacts only have indexes for `user_account` and `groups`
+        # and don't have fields that were added later.
+        for field in ['user_account', 'groups', 'bbm_pin', 'gtalk_id']:
+            del contact._riak_object._data[field]
+        yield contact.save()
+
+        dbcontact = yield self.store.get_contact_by_key(contact.key)
+        self.assertEqual(dbcontact.was_migrated, True)
+        self.assertEqual(self.account.key, dbcontact.user_account.key)
+        self.assertEqual([u'group-a'], dbcontact.groups.keys())
+        self.assertEqual(None, dbcontact.bbm_pin)
+        self.assertEqual(None, dbcontact.gtalk_id)
+        self.assertEqual(u'p', dbcontact.surname_initial)
+
     @inlineCallbacks
     def test_new_contact_for_addr(self):
         @inlineCallbacks
@@ -43,3 +43,23 @@ class TestCreditManager(TestCase, GoPersistenceMixin):
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 5)
         self.assertEqual((yield self.cm.debit(self.user_id, 5)), True)
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+
+    @inlineCallbacks
+    def test_reserve(self):
+        yield self.cm.credit(self.user_id, 10)
+        reservation = yield self.cm.reserve(self.user_id, 6)
+        self.assertEqual(reservation.remaining, 6)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+        self.assertEqual((yield self.cm.reserve(self.user_id, 6)), None)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+
+    @inlineCallbacks
+    def test_settle(self):
+        yield self.cm.credit(self.user_id, 10)
+        reservation = yield self.cm.reserve(self.user_id, 6)
+        self.assertEqual(reservation.take(2), True)
+        self.assertEqual(reservation.take(5), False)
+        self.assertEqual((yield self.cm.settle(reservation)), 4)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 8)
+        self.assertEqual((yield self.cm.settle(reservation)), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 8)
@@ -0,0 +1,61 @@
+"""Tests for go.vumitools.event_handler_cache."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.event_handler_cache import EventHandlerConfigCache
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestEventHandlerConfigCache(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.metrics = []
+        self.cache = self.mk_cache()
+        self.loads = []
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_cache(self, **kw):
+        kw.setdefault('metric_callback', self.metrics.append)
+        return EventHandlerConfigCache(self.redis, **kw)
+
+    def mk_loader(self, value):
+        def loader():
+            self.loads.append(value)
+            return value
+        return loader
+
+    @inlineCallbacks
+    def test_get_event_handler_config(self):
+        config = yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([['handler', {}]]))
+        self.assertEqual(config, [['handler', {}]])
+        config = yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([]))
+        self.assertEqual(config, [['handler', {}]])
+        self.assertEqual(self.loads, [[['handler', {}]]])
+        self.assertEqual(self.metrics, [
+            'event_handler_config.miss', 'event_handler_config.hit'])
+
+    @inlineCallbacks
+    def test_invalidate_event_handler_config(self):
+        yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([['handler', {}]]))
+        yield self.mk_cache().invalidate_event_handler_config('acc1')
+        config = yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([]))
+        self.assertEqual(config, [])
+
+    @inlineCallbacks
+    def test_clear(self):
+        yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([['handler', {}]]))
+        self.cache.clear()
+        config = yield self.cache.get_event_handler_config(
+            'acc1', self.mk_loader([]))
+        self.assertEqual(config, [])
@@ -28,8 +28,10 @@ class EventHandlerTestCase(AppWorkerTestCase):
         self.conversation = yield self.create_conversation(
             conversation_type=u'survey')
 
+    @inlineCallbacks
     def publish_event(self, event):
-        return self.dispatch(event, rkey='vumi.event')
+        yield self.dispatch(event, rkey='vumi.event')
+        yield self.event_dispatcher.wait_for_handlers()
 
     def mkevent(self, event_type, content, conv_key=None,
                 account_key=None):
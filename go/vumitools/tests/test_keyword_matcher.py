@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from mock import Mock
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.keyword_matcher import (
+    KeywordMatcher, KeywordMatcherCache, normalise_keyword,
+    config_fingerprint, model_fingerprint)
+
+
+class NormaliseKeywordTestCase(TestCase):
+
+    def test_case_insensitive(self):
+        self.assertEqual(normalise_keyword(u'FoO'), u'foo')
+        self.assertEqual(normalise_keyword(u'ÉCOLE'), u'école')
+        self.assertEqual(normalise_keyword('FoO'), u'foo')
+
+    def test_strip_punctuation(self):
+        self.assertEqual(normalise_keyword(u'stop!'), u'stop!')
+        self.assertEqual(
+            normalise_keyword(u'"stop!"', strip_punctuation=True), u'stop')
+        self.assertEqual(
+            normalise_keyword(u'¡hola!', strip_punctuation=True), u'hola')
+        self.assertEqual(
+            normalise_keyword(u'a.b', strip_punctuation=True), u'a.b')
+        self.assertEqual(
+            normalise_keyword(u'...', strip_punctuation=True), u'')
+
+
+class KeywordMatcherTestCase(TestCase):
+
+    def test_match(self):
+        matcher = KeywordMatcher([
+            (u'foo', 'a'), (u'BAR', 'b'), (u'Foo', 'c')])
+        self.assertEqual(matcher.match(u' FOO bar'), ['a', 'c'])
+        self.assertEqual(matcher.match(u'bar'), ['b'])
+        self.assertEqual(matcher.match(u'baz foo'), [])
+        self.assertEqual(matcher.match(u''), [])
+        self.assertEqual(matcher.match(None), [])
+
+    def test_match_first(self):
+        matcher = KeywordMatcher([(u'foo', 'a'), (u'foo', 'b')])
+        self.assertEqual(matcher.match_first(u'foo'), 'a')
+        self.assertEqual(matcher.match_first(u'bar'), None)
+        self.assertEqual(matcher.match_first(u'bar', 'default'), 'default')
+
+    def test_match_strip_punctuation(self):
+        matcher = KeywordMatcher([(u'stop', 'a')], strip_punctuation=True)
+        self.assertEqual(matcher.match(u'STOP!'), ['a'])
+        self.assertEqual(matcher.match(u'stop.please'), [])
+
+    def test_empty_keyword(self):
+        matcher = KeywordMatcher([(u'', 'a')])
+        self.assertEqual(matcher.match(u'   '), ['a'])
+        self.assertEqual(matcher.match(u'foo'), [])
+
+
+class ConfigFingerprintTestCase(TestCase):
+
+    def test_fingerprint(self):
+        config = {'handlers': [{'keyword': u'foo', 'operation': 'a'}]}
+        self.assertEqual(
+            config_fingerprint(config),
+            config_fingerprint(
+                {'handlers': [{'operation': 'a', 'keyword': u'foo'}]}))
+        self.assertNotEqual(
+            config_fingerprint(config),
+            config_fingerprint(
+                {'handlers': [{'keyword': u'foo', 'operation': 'b'}]}))
+
+    def test_model_fingerprint(self):
+        config = {'handlers': [{'keyword': u'foo', 'operation': 'a'}]}
+        modelobj = Mock()
+        modelobj._riak_object.vclock.return_value = 'vclock1'
+        self.assertEqual(model_fingerprint(modelobj, config), 'vclock1')
+
+    def test_model_fingerprint_not_stored(self):
+        config = {'handlers': [{'keyword': u'foo', 'operation': 'a'}]}
+        modelobj = Mock()
+        modelobj._riak_object.vclock.return_value = None
+        self.assertEqual(
+            model_fingerprint(modelobj, config), config_fingerprint(config))
+
+
+class KeywordMatcherCacheTestCase(TestCase):
+
+    def keywords(self, *keywords):
+        def get_keywords():
+            self.built.append(keywords)
+            return keywords
+        return get_keywords
+
+    def setUp(self):
+        self.built = []
+
+    def test_cached(self):
+        cache = KeywordMatcherCache()
+        matcher = cache.get_matcher(
+            'conv1', 'v1', self.keywords((u'foo', 'a')))
+        self.assertTrue(cache.get_matcher(
+            'conv1', 'v1', self.keywords((u'foo', 'a'))) is matcher)
+        self.assertEqual(self.built, [((u'foo', 'a'),)])
+        self.assertFalse(cache.get_matcher(
+            'conv2', 'v1', self.keywords((u'foo', 'a'))) is matcher)
+
+    def test_config_changed(self):
+        cache = KeywordMatcherCache()
+        matcher = cache.get_matcher(
+            'conv1', 'v1', self.keywords((u'foo', 'a')))
+        new_matcher = cache.get_matcher(
+            'conv1', 'v2', self.keywords((u'foo', 'b')))
+        self.assertFalse(new_matcher is matcher)
+        self.assertEqual(new_matcher.match(u'foo'), ['b'])
+
+    def test_options_changed(self):
+        cache = KeywordMatcherCache()
+        matcher = cache.get_matcher(
+            'conv1', 'v1', self.keywords((u'foo', 'a')))
+        new_matcher = cache.get_matcher(
+            'conv1', 'v1', self.keywords((u'foo', 'a')),
+            strip_punctuation=True)
+        self.assertFalse(new_matcher is matcher)
+        self.assertEqual(new_matcher.match(u'foo!'), ['a'])
+
+    def test_least_recently_used_dropped(self):
+        cache = KeywordMatcherCache(max_size=2)
+        get_keywords = self.keywords((u'foo', 'a'))
+        matcher1 = cache.get_matcher('conv1', 'v1', get_keywords)
+        cache.get_matcher('conv2', 'v1', get_keywords)
+        self.assertTrue(
+            cache.get_matcher('conv1', 'v1', get_keywords) is matcher1)
+        cache.get_matcher('conv3', 'v1', get_keywords)
+        self.assertEqual(sorted(cache._matchers.keys()), ['conv1', 'conv3'])
@@ -0,0 +1,77 @@
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.lru import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_set_and_get(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertRaises(KeyError, lambda: cache['b'])
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_oldest(self):
+        cache = LRUCache()
+        self.assertEqual(cache.oldest(), None)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.oldest(), ('a', 1))
+        cache.get('a')
+        self.assertEqual(cache.oldest(), ('b', 2))
+        cache['b'] = 3
+        self.assertEqual(cache.oldest(), ('a', 1))
+
+    def test_popoldest(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.popoldest(), ('a', 1))
+        self.assertEqual(cache.popoldest(), ('b', 2))
+        self.assertEqual(cache.popoldest(), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_and_del(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        self.assertEqual(cache.pop('a', 0), 0)
+        del cache['b']
+        self.assertEqual(cache.oldest(), ('c', 3))
+        self.assertEqual(cache.keys(), ['c'])
+
+    def test_max_size(self):
+        cache = LRUCache(max_size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(cache.keys(), ['a', 'c'])
+        cache['c'] = 4
+        cache['d'] = 5
+        self.assertEqual(cache.keys(), ['c', 'd'])
+
+    def test_stale_order_compacted(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        cache['b'] = 2
+        for i in range(100):
+            cache.get('a')
+        self.assertTrue(len(cache._order) <= 2 * len(cache) + 16)
+        self.assertEqual(cache.oldest(), ('b', 2))
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.oldest(), None)
@@ -1,6 +1,6 @@
 """Tests for go.vumitools.metrics_worker."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock, LoopingCall
 
 from vumi.tests.utils import VumiWorkerTestCase
@@ -136,3 +136,95 @@ class GoMetricsWorkerTestCase(VumiWorkerTestCase, GoPersistenceMixin):
         conv_keys = [c.payload['kwargs']['conversation_key'] for c in cmds]
         self.assertEqual(sorted(conv_keys),
                          sorted(c.key for c in [conv1, conv2, conv3, conv4]))
+
+    @inlineCallbacks
+    def test_metrics_loop_func_with_spread(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({'metrics_spread': 0.5})
+        acc1 = yield self.make_account(u'acc1')
+        yield self.worker.redis.sadd('metrics_accounts', acc1.key)
+        user_api1 = self.worker.vumi_api.get_user_api(acc1.key)
+        conv1 = yield self.make_conv(user_api1, u'conv1')
+        yield self.start_conv(conv1)
+
+        yield self.worker.metrics_loop_func()
+        # Commands are spread over half the metrics interval.
+        self.assertEqual(self._get_dispatched('vumi.api'), [])
+        self.clock.advance(150)
+
+        [cmd] = self._get_dispatched('vumi.api')
+        self.assertEqual(cmd.payload['kwargs']['conversation_key'], conv1.key)
+
+    @inlineCallbacks
+    def test_metrics_loop_func_duration(self):
+        def find_account_keys():
+            self.clock.advance(12)
+            return []
+
+        self.worker.find_account_keys = find_account_keys
+        # Clear the value from the run when the worker started.
+        self.worker.loop_duration_metric.poll()
+        yield self.worker.metrics_loop_func()
+        self.assertEqual(
+            [v for _, v in self.worker.loop_duration_metric.poll()], [12])
+
+    @inlineCallbacks
+    def test_find_conversations_for_accounts_concurrency(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker(
+            {'metrics_concurrency': 2})
+        pending = []
+
+        def find_conversations_for_account(account_key):
+            d = Deferred()
+            pending.append((account_key, d))
+            return d
+
+        self.worker.find_conversations_for_account = (
+            find_conversations_for_account)
+        d = self.worker.find_conversations_for_accounts(['a', 'b', 'c'])
+        self.assertEqual([key for key, _ in pending], ['a', 'b'])
+
+        pending[0][1].callback(['conv-a'])
+        self.assertEqual([key for key, _ in pending], ['a', 'b', 'c'])
+        pending[1][1].callback(['conv-b1', 'conv-b2'])
+        pending[2][1].callback([])
+
+        conversations = yield d
+        self.assertEqual(conversations, ['conv-a', 'conv-b1', 'conv-b2'])
+
+    @inlineCallbacks
+    def test_shard_for_account(self):
+        account_keys = ['account-%s' % (i,) for i in range(20)]
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({'shard_count': 2})
+        shards = dict((key, self.worker.shard_for_account(key))
+                      for key in account_keys)
+        self.assertEqual(set(shards.values()), set([0, 1]))
+
+        # Adding a shard only moves accounts to the new shard.
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({'shard_count': 3})
+        for key in account_keys:
+            shard = self.worker.shard_for_account(key)
+            self.assertTrue(shard in (shards[key], 2))
+
+    @inlineCallbacks
+    def test_metrics_loop_func_sharded(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({
+            'shard_index': 1, 'shard_count': 2})
+        account_keys = []
+        for i in range(6):
+            account = yield self.make_account(u'acc%s' % (i,))
+            yield self.worker.redis.sadd('metrics_accounts', account.key)
+            account_keys.append(account.key)
+
+        found = []
+        self.worker.find_conversations_for_account = (
+            lambda account_key: found.append(account_key) or [])
+        yield self.worker.metrics_loop_func()
+
+        self.assertEqual(sorted(found), sorted(
+            key for key in account_keys
+            if self.worker.shard_for_account(key) == 1))
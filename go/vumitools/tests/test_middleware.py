@@ -11,7 +11,8 @@ from vumi.middleware.tagger import TaggingMiddleware
 from go.vumitools.tests.utils import AppWorkerTestCase, GoRouterWorkerTestMixin
 from go.vumitools.middleware import (NormalizeMsisdnMiddleware,
     OptOutMiddleware, MetricsMiddleware, ConversationStoringMiddleware,
-    RouterStoringMiddleware)
+    RouterStoringMiddleware, DebitAccountMiddleware, InsufficientCredit,
+    BadTagPool)
 
 
 class MiddlewareTestCase(AppWorkerTestCase):
@@ -168,6 +169,94 @@ class OptOutMiddlewareTestCase(MiddlewareTestCase):
         })
 
 
+class DebitAccountMiddlewareTestCase(MiddlewareTestCase):
+
+    @inlineCallbacks
+    def get_debit_middleware(self, **config_extras):
+        config = self.default_config.copy()
+        config.update(config_extras)
+        mw = yield self.create_middleware(DebitAccountMiddleware,
+            config=config)
+        self._persist_redis_managers.append(mw.redis)
+        yield mw.tpm.declare_tags([("pool", "tag1")])
+        yield mw.tpm.set_metadata("pool", {"credits_per_message": 2})
+        returnValue(mw)
+
+    def mk_outbound(self):
+        msg = self.mk_msg(to_addr='to@domain.org', from_addr='from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(msg, ("pool", "tag1"))
+        DebitAccountMiddleware.add_user_to_message(msg, "user-1")
+        return msg
+
+    @inlineCallbacks
+    def test_debit(self):
+        mw = yield self.get_debit_middleware()
+        yield mw.cm.credit("user-1", 5)
+        msg = self.mk_outbound()
+        result = yield mw.handle_outbound(msg, 'dummy_endpoint')
+        self.assertEqual(result, msg)
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 3)
+
+    @inlineCallbacks
+    def test_insufficient_credit(self):
+        mw = yield self.get_debit_middleware()
+        yield mw.cm.credit("user-1", 1)
+        yield self.assertFailure(
+            mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint'),
+            InsufficientCredit)
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 1)
+
+    @inlineCallbacks
+    def test_bad_tagpool(self):
+        mw = yield self.get_debit_middleware()
+        yield mw.tpm.set_metadata("pool", {})
+        yield self.assertFailure(
+            mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint'),
+            BadTagPool)
+
+    @inlineCallbacks
+    def test_credits_per_message_cached(self):
+        mw = yield self.get_debit_middleware()
+        yield mw.cm.credit("user-1", 10)
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        yield mw.tpm.set_metadata("pool", {"credits_per_message": 3})
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 6)
+
+    @inlineCallbacks
+    def test_reservation(self):
+        mw = yield self.get_debit_middleware(reservation_size=3)
+        yield mw.cm.credit("user-1", 10)
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 4)
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 4)
+        yield mw.teardown_middleware()
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 4)
+
+    @inlineCallbacks
+    def test_reservation_settled(self):
+        mw = yield self.get_debit_middleware(reservation_size=3)
+        yield mw.cm.credit("user-1", 10)
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 4)
+        yield mw.teardown_middleware()
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 8)
+
+    @inlineCallbacks
+    def test_reservation_falls_back_to_single_debit(self):
+        mw = yield self.get_debit_middleware(reservation_size=3)
+        yield mw.cm.credit("user-1", 3)
+        yield mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint')
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 1)
+        yield self.assertFailure(
+            mw.handle_outbound(self.mk_outbound(), 'dummy_endpoint'),
+            InsufficientCredit)
+        yield mw.teardown_middleware()
+        self.assertEqual((yield mw.cm.get_credit("user-1")), 1)
+
+
 class MetricsMiddlewareTestCase(MiddlewareTestCase):
 
     @inlineCallbacks
@@ -270,6 +359,78 @@ class MetricsMiddlewareTestCase(MiddlewareTestCase):
         [timestamp, value] = timer_metric
         self.assertTrue(value > 10)
 
+    @inlineCallbacks
+    def test_response_time_inbound_expiry(self):
+        mw = yield self.get_middleware({
+            'op_mode': 'passive', 'max_response_time': 60})
+        msg = self.mk_msg(transport_name='endpoint_0')
+        yield mw.handle_inbound(msg, 'dummy_endpoint')
+        ttl = yield mw.redis.ttl(mw.key('dummy_endpoint', msg['message_id']))
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_local_response_time_comparison_on_outbound(self):
+        mw = yield self.get_middleware({
+            'op_mode': 'passive', 'local_response_times': True})
+        inbound_msg = self.mk_msg(transport_name='endpoint_0')
+        yield mw.handle_inbound(inbound_msg, 'dummy_endpoint')
+        key = mw.key('dummy_endpoint', inbound_msg['message_id'])
+        self.assertEqual((yield mw.redis.get(key)), None)
+        # Fake it to be 10 seconds in the past
+        mw.local_timestamps[key] -= 10
+        outbound_msg = self.mk_msg(transport_name='endpoint_0',
+            in_reply_to=inbound_msg['message_id'])
+        yield mw.handle_outbound(outbound_msg, 'dummy_endpoint')
+        [timer_metric] = mw.metric_manager['dummy_endpoint.timer'].poll()
+        [timestamp, value] = timer_metric
+        self.assertTrue(value > 10)
+        self.assertEqual(len(mw.local_timestamps), 0)
+
+    @inlineCallbacks
+    def test_local_response_time_eviction(self):
+        mw = yield self.get_middleware({
+            'op_mode': 'passive', 'local_response_times': True,
+            'max_local_timestamps': 2, 'max_response_time': 60})
+        now = [time.time()]
+        self.patch(time, 'time', lambda: now[0])
+        msgs = [self.mk_msg(transport_name='endpoint_0') for _ in range(4)]
+        for msg in msgs[:3]:
+            yield mw.handle_inbound(msg, 'dummy_endpoint')
+            now[0] += 10
+        keys = [mw.key('dummy_endpoint', msg['message_id']) for msg in msgs]
+        self.assertEqual(mw.local_timestamps.keys(), keys[1:3])
+
+        # Move the oldest timestamp past the maximum response time.
+        now[0] += 41
+        yield mw.handle_inbound(msgs[3], 'dummy_endpoint')
+        self.assertEqual(mw.local_timestamps.keys(), keys[2:4])
+
+    @inlineCallbacks
+    def test_response_time_percentiles(self):
+        mw = yield self.get_middleware({'op_mode': 'passive'})
+        for response_time in range(1, 101):
+            mw.set_response_time('dummy_endpoint', response_time)
+
+        def percentile(percent):
+            metric_name = 'dummy_endpoint.timer.p%s' % (percent,)
+            [(timestamp, value)] = mw.metric_manager[metric_name].poll()
+            return value
+
+        self.assertEqual(percentile(50), 50)
+        self.assertEqual(percentile(95), 95)
+        self.assertEqual(percentile(99), 99)
+
+    @inlineCallbacks
+    def test_response_time_percentiles_without_samples(self):
+        mw = yield self.get_middleware({
+            'op_mode': 'passive', 'percentile_window': 60})
+        mw.set_response_time('dummy_endpoint', 1)
+        samples = mw.response_time_samples['dummy_endpoint']
+        [(timestamp, value)] = samples.samples
+        samples.samples[0] = (timestamp - 61, value)
+        self.assertEqual(
+            mw.metric_manager['dummy_endpoint.timer.p50'].poll(), [])
+
     @inlineCallbacks
     def test_ack_event(self):
         mw = yield self.get_middleware({'op_mode': 'passive'})
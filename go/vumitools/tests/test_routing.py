@@ -565,3 +565,30 @@ class TestRoutingTableDispatcher(AppWorkerTestCase):
             ['TRANSPORT_TAG:pool1:1234', 'default'],
         ])
         self.assertEqual([msg], self.get_dispatched_outbound('sphex'))
+
+    @inlineCallbacks
+    def test_routing_table_cached(self):
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        user_account = yield self.user_api.get_user_account()
+        user_account.routing_table["TRANSPORT_TAG:pool1:1234"] = {
+            "default": ["CONVERSATION:app2:conv2", "default"]}
+        # Saving without invalidation leaves the cached table in use.
+        yield user_account.save()
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(2, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual([], self.get_dispatched_inbound('app2'))
+
+    @inlineCallbacks
+    def test_routing_table_cache_invalidated(self):
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        user_account = yield self.user_api.get_user_account()
+        user_account.routing_table["TRANSPORT_TAG:pool1:1234"] = {
+            "default": ["CONVERSATION:app2:conv2", "default"]}
+        yield self.user_api.save_routing_table(user_account)
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual(1, len(self.get_dispatched_inbound('app2')))
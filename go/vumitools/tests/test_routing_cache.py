@@ -0,0 +1,133 @@
+"""Tests for go.vumitools.routing_cache."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.routing_cache import RoutingTableCache
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestRoutingTableCache(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.metrics = []
+        self.cache = self.mk_cache()
+        self.loads = []
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_cache(self, **kw):
+        kw.setdefault('metric_callback', self.metrics.append)
+        return RoutingTableCache(self.redis, **kw)
+
+    def mk_loader(self, value):
+        def loader():
+            self.loads.append(value)
+            return value
+        return loader
+
+    @inlineCallbacks
+    def test_get_routing_table_miss_then_hit(self):
+        rt = yield self.cache.get_routing_table(
+            'acc1', self.mk_loader({'a': {}}))
+        self.assertEqual(rt, {'a': {}})
+        rt = yield self.cache.get_routing_table(
+            'acc1', self.mk_loader({'b': {}}))
+        self.assertEqual(rt, {'a': {}})
+        self.assertEqual(self.loads, [{'a': {}}])
+        self.assertEqual(self.metrics, [
+            'routing_table.miss', 'routing_table.hit'])
+
+    @inlineCallbacks
+    def test_invalidate_routing_table(self):
+        yield self.cache.get_routing_table('acc1', self.mk_loader({'a': {}}))
+        yield self.cache.invalidate_routing_table('acc1')
+        rt = yield self.cache.get_routing_table(
+            'acc1', self.mk_loader({'b': {}}))
+        self.assertEqual(rt, {'b': {}})
+
+    @inlineCallbacks
+    def test_invalidate_routing_table_from_other_cache(self):
+        other_cache = self.mk_cache()
+        yield self.cache.get_routing_table('acc1', self.mk_loader({'a': {}}))
+        yield other_cache.invalidate_routing_table('acc1')
+        rt = yield self.cache.get_routing_table(
+            'acc1', self.mk_loader({'b': {}}))
+        self.assertEqual(rt, {'b': {}})
+
+    @inlineCallbacks
+    def test_ttl_zero_disables_caching(self):
+        cache = self.mk_cache(ttl=0)
+        yield cache.get_routing_table('acc1', self.mk_loader({'a': {}}))
+        rt = yield cache.get_routing_table('acc1', self.mk_loader({'b': {}}))
+        self.assertEqual(rt, {'b': {}})
+
+    @inlineCallbacks
+    def test_expired_entries_reloaded(self):
+        yield self.cache.get_routing_table('acc1', self.mk_loader({'a': {}}))
+        generation, _expires_at, value = self.cache._routing_tables['acc1']
+        self.cache._routing_tables['acc1'] = (generation, 0, value)
+        rt = yield self.cache.get_routing_table(
+            'acc1', self.mk_loader({'b': {}}))
+        self.assertEqual(rt, {'b': {}})
+
+    @inlineCallbacks
+    def test_get_compiled_routing_table(self):
+        routing_table = {'CONVERSATION:app:conv1': {
+            'default': ['TRANSPORT_TAG:pool:tag1', 'default']}}
+        compiled = yield self.cache.get_compiled_routing_table(
+            'acc1', self.mk_loader(routing_table))
+        self.assertEqual(
+            compiled.lookup_source('TRANSPORT_TAG:pool:tag1', 'default'),
+            ['CONVERSATION:app:conv1', 'default'])
+        cached = yield self.cache.get_compiled_routing_table(
+            'acc1', self.mk_loader({}))
+        self.assertTrue(cached is compiled)
+        self.assertEqual(self.metrics, [
+            'compiled_routing_table.miss', 'compiled_routing_table.hit'])
+
+    @inlineCallbacks
+    def test_invalidate_compiled_routing_table(self):
+        yield self.cache.get_compiled_routing_table(
+            'acc1', self.mk_loader({'CONVERSATION:app:conv1': {
+                'default': ['TRANSPORT_TAG:pool:tag1', 'default']}}))
+        yield self.mk_cache().invalidate_routing_table('acc1')
+        compiled = yield self.cache.get_compiled_routing_table(
+            'acc1', self.mk_loader({}))
+        self.assertEqual(
+            compiled.lookup_source('TRANSPORT_TAG:pool:tag1', 'default'),
+            None)
+
+    @inlineCallbacks
+    def test_get_tag_owner(self):
+        owner = yield self.cache.get_tag_owner(
+            ['pool', 'tag'], self.mk_loader(u'acc1'))
+        self.assertEqual(owner, u'acc1')
+        owner = yield self.cache.get_tag_owner(
+            ('pool', 'tag'), self.mk_loader(u'acc2'))
+        self.assertEqual(owner, u'acc1')
+        self.assertEqual(self.metrics, ['tag_owner.miss', 'tag_owner.hit'])
+
+    @inlineCallbacks
+    def test_invalidate_tag(self):
+        yield self.cache.get_tag_owner(('pool', 'tag'), self.mk_loader(None))
+        yield self.mk_cache().invalidate_tag(('pool', 'tag'))
+        owner = yield self.cache.get_tag_owner(
+            ('pool', 'tag'), self.mk_loader(u'acc1'))
+        self.assertEqual(owner, u'acc1')
+
+    @inlineCallbacks
+    def test_max_size_evicts_least_recently_used(self):
+        cache = self.mk_cache(max_size=2)
+        yield cache.get_routing_table('acc1', self.mk_loader({'a': {}}))
+        yield cache.get_routing_table('acc2', self.mk_loader({'b': {}}))
+        yield cache.get_routing_table('acc1', self.mk_loader({'x': {}}))
+        yield cache.get_routing_table('acc3', self.mk_loader({'c': {}}))
+        self.assertEqual(
+            sorted(cache._routing_tables.keys()), ['acc1', 'acc3'])
+        rt = yield cache.get_routing_table('acc1', self.mk_loader({'x': {}}))
+        self.assertEqual(rt, {'a': {}})
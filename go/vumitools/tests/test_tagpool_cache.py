@@ -0,0 +1,90 @@
+"""Tests for go.vumitools.tagpool_cache."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.components.tagpool import TagpoolManager
+
+from go.vumitools.tagpool_cache import TagpoolMetadataCache
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestTagpoolMetadataCache(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.tpm = TagpoolManager(self.redis.sub_manager('tagpool_store'))
+        yield self.tpm.declare_tags([('pool', 'tag1')])
+        yield self.tpm.set_metadata('pool', {'transport_name': 'foo'})
+        self.cache = self.mk_cache()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_cache(self, **kw):
+        return TagpoolMetadataCache(self.tpm, **kw)
+
+    @inlineCallbacks
+    def test_get_metadata_miss_then_hit(self):
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'foo'})
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'foo'})
+
+    @inlineCallbacks
+    def test_get_metadata_unknown_pool(self):
+        metadata = yield self.cache.get_metadata('unknown')
+        self.assertEqual(metadata, {})
+
+    @inlineCallbacks
+    def test_ttl_zero_disables_caching(self):
+        cache = self.mk_cache(ttl=0)
+        yield cache.get_metadata('pool')
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        metadata = yield cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'bar'})
+
+    @inlineCallbacks
+    def test_expired_metadata_reloaded(self):
+        yield self.cache.get_metadata('pool')
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        loaded_at, metadata = self.cache._metadata['pool']
+        self.cache._metadata['pool'] = (loaded_at - self.cache.ttl, metadata)
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'bar'})
+
+    @inlineCallbacks
+    def test_metadata_refreshed_ahead_of_expiry(self):
+        yield self.cache.get_metadata('pool')
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        loaded_at, metadata = self.cache._metadata['pool']
+        self.cache._metadata['pool'] = (
+            loaded_at - self.cache.ttl * 0.8, metadata)
+        # The cached copy is still returned while it is refreshed.
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'foo'})
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'bar'})
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        yield self.cache.get_metadata('pool')
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        yield self.cache.invalidate()
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'bar'})
+
+    @inlineCallbacks
+    def test_invalidate_from_other_cache(self):
+        yield self.cache.get_metadata('pool')
+        yield self.tpm.set_metadata('pool', {'transport_name': 'bar'})
+        yield self.mk_cache().invalidate()
+        # The generation is only checked every so often.
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'foo'})
+        yield self.cache.check_generation()
+        metadata = yield self.cache.get_metadata('pool')
+        self.assertEqual(metadata, {'transport_name': 'bar'})
@@ -161,7 +161,7 @@ class WizardCreateView(BaseWizardView):
         tag_conn = str(GoConnector.for_transport_tag(tag[0], tag[1]))
         rt_helper.add_entry(conv_conn, "default", tag_conn, "default")
         rt_helper.add_entry(tag_conn, "default", conv_conn, "default")
-        user_account.save()
+        request.user_api.save_routing_table(user_account)
 
     def _setup_keyword_routing(self, request, conv, tag, router, endpoint):
         user_account = request.user_api.get_user_account()
@@ -184,7 +184,7 @@ class WizardCreateView(BaseWizardView):
         rt_helper.add_entry(conv_conn, "default", rout_conn, endpoint)
         rt_helper.add_entry(rout_conn, endpoint, conv_conn, "default")
 
-        user_account.save()
+        request.user_api.save_routing_table(user_account)
 
 
 @login_required